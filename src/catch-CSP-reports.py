@@ -3,38 +3,1275 @@
 # csp_report_logger.py
 #
 # companion script to catch CSP reports generated from zm_generate_CSP.py
-# output is via syslog
+# output is via syslog and/or a JSON-lines file (--jsonl)
 #
 # install flask: pip3 install flask
 #
+# Examples:
+#   ./catch-CSP-reports.py                                  # syslog only
+#   ./catch-CSP-reports.py --jsonl /var/log/csp/reports.jsonl
+#   ./catch-CSP-reports.py --jsonl /var/log/csp/reports.jsonl --no-syslog \
+#       --jsonl-max-bytes 33554432 --jsonl-rotate 3600
+#
+# The JSON-lines sink writes one compact object per report, buffered, and
+# rotates the file by size or age. Rotated segments are renamed to
+# <file>.YYYYmmdd-HHMMSS and gzipped by a background thread.
+#
+# Spike detection keeps a fast and a slow exponentially weighted rate per
+# (directive, document path). When the fast rate exceeds --spike-threshold
+# times the slow baseline a single LOG_ALERT line is written (or
+# --alert-command is run), at most once per --alert-cooldown per key.
+#   ./catch-CSP-reports.py --spike-threshold 5 --alert-command /usr/local/bin/page-admin
+#
+# When the policy was generated with --report-sample-rate, the
+# "# Report-Sample-Rate:" header of --csp-config is read (and re-read when the
+# file changes) so JSON-lines records carry a weight of 1/rate and spike
+# rates are scaled back up to real traffic.
+#
+# Policies generated by zm_generate_CSP3.py report to /csp-violation/<version>;
+# violations are counted per version (the "# Policy-Version:" lines of
+# --csp-config name the scope, e.g. a Report-Only canary, and give the canary
+# its own sample rate). GET /versions returns the counts as JSON:
+#   curl -s http://127.0.0.1:7777/versions
+#
+# GET /stats lists the live top offenders (blocked-uri, document path,
+# source file or directive) over a sliding 1m, 1h or 1d window. Counts come
+# from space-saving summaries in fixed memory (--top-capacity counters per
+# dimension and time bucket); "error" is the most a count may be overstated.
+#   curl -s 'http://127.0.0.1:7777/stats?dim=blocked&window=1m&k=10'
+#
+# With several proxy nodes, run an edge forwarder on each node and one
+# central collector. The edge accepts reports on 127.0.0.1:7777 as usual and
+# ships them as gzipped JSON-lines batches over one keep-alive connection to
+# the central /csp-batch route. Batches the central collector does not take
+# are spooled to --spool and replayed in order once it is back.
+#   central: ./catch-CSP-reports.py --host 0.0.0.0 --port 7777 --jsonl /var/log/csp/reports.jsonl \
+#                --batch-token s3cret
+#   edge:    ./catch-CSP-reports.py --forward http://central:7777/csp-batch --batch-token s3cret
+#   (on one host: central on --port 7780, edge with --forward http://127.0.0.1:7780/csp-batch)
+# A central collector listening on anything but loopback requires
+# --batch-token. Batches are capped at 8MB on the wire and 32MB inflated.
+# ./test-csp-forwarding.sh runs an edge and a central collector locally and
+# checks that a report makes it through, including a central outage.
+#
+# Most noise comes from browser extensions, injected ad/AV scripts and about:
+# pages. --noise-rules FILE drops such reports before anything else is done
+# with them, or downgrades them (LOG_DEBUG, marked in JSON lines, left out of
+# spike detection and statistics). The file is re-read when it changes; GET
+# /noise shows the hits per rule. In --forward mode the edge drops, the
+# central collector applies its own rules.
+#   ./catch-CSP-reports.py --noise-rules-example > /etc/csp-noise.rules
+#   ./catch-CSP-reports.py --noise-rules /etc/csp-noise.rules
+#   curl -s http://127.0.0.1:7777/noise
+#
+# Reports logged to syslog before the JSON-lines sink existed can be loaded
+# into it. Files are read oldest first and parsed by a process pool:
+#   ./catch-CSP-reports.py --jsonl /var/log/csp/reports.jsonl \
+#       --backfill /var/log/syslog.*.gz /var/log/syslog.1 /var/log/syslog
+#
 
 from flask import Flask, request
+import argparse
+import atexit
+import glob
+import gzip
+import hmac
+import http.client
+import ipaddress
 import json
+import math
+import os
+import queue
+import re
+import shlex
+import shutil
+import socket
+import subprocess
+import sys
 import syslog
+import threading
+import time
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from urllib.parse import urlsplit
 
 app = Flask(__name__)
+# Limits on POST /csp-batch: request body as sent, and the batch once inflated
+MAX_BATCH_BODY = 8 * 1024 * 1024
+MAX_BATCH_BYTES = 32 * 1024 * 1024
+app.config['MAX_CONTENT_LENGTH'] = MAX_BATCH_BODY
 
-@app.route('/csp-violation', methods=['POST'])
-def csp_violation():
-    try:
-        report_data = request.get_json()
-        if report_data and 'csp-report' in report_data:
-            csp_report = report_data['csp-report']
-            violated_directive = csp_report.get('violated-directive', 'unknown')
-            blocked_uri = csp_report.get('blocked-uri', 'unknown')
-            document_uri = csp_report.get('document-uri', 'unknown')
-            syslog.syslog(syslog.LOG_WARNING,
+# Output configuration, filled in from the command line in __main__
+sink = None           # JsonLinesSink when --jsonl is given
+use_syslog = True
+spikes = None         # SpikeDetector unless --spike-threshold 0
+sample_rate = None    # SampleRate reading the generated CSP config header
+versions = None       # VersionCounts per policy version tag
+hitters = None        # HeavyHitters behind GET /stats
+forwarder = None      # Forwarder in --forward mode: reports go to a central collector
+batch_token = None    # shared secret required on POST /csp-batch
+noise = None          # NoiseFilter with --noise-rules
+
+
+class JsonLinesSink:
+    """Buffered JSON-lines writer with size/time rotation and gzip of old segments"""
+
+    def __init__(self, path, max_bytes=64 * 1024 * 1024, rotate_seconds=86400,
+                 buffer_size=64 * 1024, flush_interval=1.0):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.rotate_seconds = rotate_seconds
+        self.buffer_size = buffer_size
+        self.lock = threading.Lock()
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._open()
+
+        # Segments left uncompressed by a previous run (crash, kill -9)
+        for segment in glob.glob(f"{glob.escape(path)}.[0-9]*"):
+            if '.gz' not in segment[len(path):]:
+                self._compress_async(segment)
+
+        # Buffered writes still reach the disk within flush_interval seconds
+        self._closed = threading.Event()
+        flusher = threading.Thread(target=self._flush_loop, args=(flush_interval,), daemon=True)
+        flusher.start()
+        atexit.register(self.close)
+
+    def _open(self):
+        self.fh = open(self.path, 'ab', buffering=self.buffer_size)
+        self.size = self.fh.tell()
+        self.opened_at = time.time()
+
+    def write(self, record):
+        line = (json.dumps(record, separators=(',', ':'), ensure_ascii=False) + '\n').encode('utf-8')
+        with self.lock:
+            if (self.size + len(line) > self.max_bytes and self.size > 0) or \
+               (time.time() - self.opened_at >= self.rotate_seconds):
+                self._rotate()
+            self.fh.write(line)
+            self.size += len(line)
+
+    def _rotate(self):
+        """Close the current file, rename it aside and start a new one (lock held)"""
+        self.fh.close()
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        segment = f"{self.path}.{stamp}"
+        n = 1
+        while os.path.exists(segment) or os.path.exists(segment + '.gz'):
+            segment = f"{self.path}.{stamp}-{n}"
+            n += 1
+        os.rename(self.path, segment)
+        self._open()
+        self._compress_async(segment)
+
+    def _compress_async(self, segment):
+        threading.Thread(target=self._compress, args=(segment,), daemon=True).start()
+
+    @staticmethod
+    def _compress(segment):
+        try:
+            with open(segment, 'rb') as src, gzip.open(segment + '.gz.tmp', 'wb') as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+            os.rename(segment + '.gz.tmp', segment + '.gz')
+            os.remove(segment)
+        except Exception as e:
+            syslog.syslog(syslog.LOG_ERR, f'Error compressing CSP report segment {segment}: {e}')
+
+    def _flush_loop(self, interval):
+        while not self._closed.wait(interval):
+            with self.lock:
+                if not self.fh.closed:
+                    self.fh.flush()
+
+    def write_encoded(self, data):
+        """Append already encoded, newline-terminated JSON lines (bulk loads)"""
+        with self.lock:
+            if (self.size + len(data) > self.max_bytes and self.size > 0) or \
+               (time.time() - self.opened_at >= self.rotate_seconds):
+                self._rotate()
+            self.fh.write(data)
+            self.size += len(data)
+
+    def close(self):
+        self._closed.set()
+        with self.lock:
+            if not self.fh.closed:
+                self.fh.close()
+
+
+class SpikeDetector:
+    """Constant-memory EWMA rate tracking per (directive, path) with rate-limited alerts"""
+
+    def __init__(self, threshold=5.0, min_rate=0.1, fast_halflife=60, slow_halflife=3600,
+                 baseline_floor=0.01, max_keys=1024, cooldown=600, max_alerts=10,
+                 alert_command=None):
+        self.threshold = threshold
+        self.min_rate = min_rate                  # events/sec the fast rate must reach
+        self.fast_decay = math.log(2) / fast_halflife
+        self.slow_decay = math.log(2) / slow_halflife
+        self.baseline_floor = baseline_floor      # keeps brand-new keys from alerting on one hit
+        # A key seen for less than this has no baseline yet: it alerts only when the
+        # fast rate clears the absolute floor (threshold * baseline_floor and
+        # min_rate), so first-ever violations on a page are not silenced (all keys
+        # are new after a restart). After it, the slow rate is scaled by the share
+        # of its steady state it can have reached in the time seen
+        self.warmup = 10 * fast_halflife
+        self.max_keys = max_keys
+        self.cooldown = cooldown
+        self.max_alerts = max_alerts              # global cap per cooldown period
+        self.alert_command = shlex.split(alert_command) if alert_command else None
+        self.lock = threading.Lock()
+        # key -> [last_seen, fast_rate, slow_rate, last_alert, first_seen]
+        self.state = OrderedDict()
+        self.recent_alerts = []
+
+    def observe(self, directive, page, weight=1.0, now=None):
+        """Account one report; returns True when an alert was raised"""
+        now = time.time() if now is None else now
+        key = (directive, urlsplit(page).path or page)
+        with self.lock:
+            entry = self.state.get(key)
+            if entry is None:
+                entry = [now, 0.0, 0.0, 0.0, now]
+                self.state[key] = entry
+                if len(self.state) > self.max_keys:
+                    self.state.popitem(last=False)
+            else:
+                self.state.move_to_end(key)
+
+            dt = max(now - entry[0], 0.0)
+            entry[0] = now
+            entry[1] = entry[1] * math.exp(-self.fast_decay * dt) + weight * self.fast_decay
+            entry[2] = entry[2] * math.exp(-self.slow_decay * dt) + weight * self.slow_decay
+
+            fast, baseline = entry[1], self.baseline_floor
+            if now - entry[4] >= self.warmup:
+                warmed = 1.0 - math.exp(-self.slow_decay * (now - entry[4]))
+                baseline = max(entry[2] / warmed, self.baseline_floor)
+            if fast < self.min_rate or fast < self.threshold * baseline:
+                return False
+            if now - entry[3] < self.cooldown:
+                return False
+            self.recent_alerts = [t for t in self.recent_alerts if now - t < self.cooldown]
+            if len(self.recent_alerts) >= self.max_alerts:
+                return False
+            entry[3] = now
+            self.recent_alerts.append(now)
+
+        self._alert(key[0], key[1], fast, baseline)
+        return True
+
+    def _alert(self, directive, path, rate, baseline):
+        message = (f'CSP violation spike - directive: {directive}, page: {path}, '
+                   f'rate: {rate * 60:.1f}/min, baseline: {baseline * 60:.1f}/min '
+                   f'({rate / baseline:.0f}x)')
+        if not self.alert_command:
+            syslog.syslog(syslog.LOG_ALERT, message)
+            return
+        env = dict(os.environ, CSP_ALERT_DIRECTIVE=directive, CSP_ALERT_PAGE=path,
+                   CSP_ALERT_RATE=f'{rate * 60:.1f}', CSP_ALERT_MESSAGE=message)
+        threading.Thread(target=self._run_command, args=(env, message), daemon=True).start()
+
+    def _run_command(self, env, message):
+        try:
+            subprocess.run(self.alert_command + [message], env=env, timeout=60,
+                           stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL)
+        except Exception as e:
+            syslog.syslog(syslog.LOG_ALERT, message)
+            syslog.syslog(syslog.LOG_ERR, f'Error running CSP alert command: {e}')
+
+
+class SpaceSaving:
+    """Approximate top-k counter in fixed memory (Metwally et al. space-saving)
+
+    At most capacity items are tracked. A new item replaces the one with the
+    smallest count and inherits that count as its error, so count - error is
+    a guaranteed lower bound and any item with a true count above the
+    smallest counter is always present.
+    """
+
+    def __init__(self, capacity=64):
+        self.capacity = capacity
+        self.counts = {}            # item -> [count, error]
+        self.total = 0.0
+
+    def add(self, item, weight=1.0):
+        self.total += weight
+        entry = self.counts.get(item)
+        if entry is not None:
+            entry[0] += weight
+        elif len(self.counts) < self.capacity:
+            self.counts[item] = [weight, 0.0]
+        else:
+            victim = min(self.counts, key=lambda key: self.counts[key][0])
+            floor = self.counts.pop(victim)[0]
+            self.counts[item] = [floor + weight, floor]
+
+
+class HeavyHitters:
+    """Top offenders per report field over sliding windows, in fixed memory
+
+    Each window is a ring of buckets, each bucket a SpaceSaving summary per
+    dimension; expired buckets are dropped as time moves on. A query merges
+    the window's buckets (a bounded amount of work whatever the traffic)
+    and the result is cached for a second.
+    """
+
+    # window -> (span, bucket width) in seconds
+    WINDOWS = {'1m': (60, 5), '1h': (3600, 60), '1d': (86400, 3600)}
+    DIMENSIONS = ('blocked', 'page', 'source', 'directive')
+
+    def __init__(self, capacity=64, cache_seconds=1.0):
+        self.capacity = capacity
+        self.cache_seconds = cache_seconds
+        self.lock = threading.Lock()
+        # window -> deque of (bucket number, {dimension: SpaceSaving})
+        self.rings = {window: deque() for window in self.WINDOWS}
+        self.cache = {}             # (dimension, window, k) -> (expires, result)
+
+    def observe(self, values, weight=1.0, now=None):
+        """Count one report; values maps dimension -> field value (None skips it)"""
+        now = time.time() if now is None else now
+        with self.lock:
+            for window, ring in self.rings.items():
+                bucket = self._bucket(window, ring, now)
+                for dimension, value in values.items():
+                    if value is not None:
+                        bucket[dimension].add(value, weight)
+
+    def _bucket(self, window, ring, now):
+        span, width = self.WINDOWS[window]
+        number = int(now // width)
+        while ring and ring[0][0] <= number - span // width:
+            ring.popleft()
+        if not ring or ring[-1][0] != number:
+            ring.append((number, {d: SpaceSaving(self.capacity) for d in self.DIMENSIONS}))
+        return ring[-1][1]
+
+    def top(self, dimension, window, k=10, now=None):
+        """{'total', 'items': [{'value', 'count', 'error'}]} for the last window"""
+        now = time.time() if now is None else now
+        key = (dimension, window, k)
+        cached = self.cache.get(key)
+        if cached and cached[0] > now:
+            return cached[1]
+        span, width = self.WINDOWS[window]
+        oldest = int(now // width) - span // width
+        merged = {}
+        total = 0.0
+        with self.lock:
+            for number, summaries in self.rings[window]:
+                if number <= oldest:
+                    continue
+                summary = summaries[dimension]
+                total += summary.total
+                for item, (count, error) in summary.counts.items():
+                    entry = merged.setdefault(item, [0.0, 0.0])
+                    entry[0] += count
+                    entry[1] += error
+        items = sorted(merged.items(), key=lambda item: -item[1][0])[:k]
+        result = {'total': round(total, 1),
+                  'items': [{'value': item, 'count': round(count, 1), 'error': round(error, 1)}
+                            for item, (count, error) in items]}
+        self.cache[key] = (now + self.cache_seconds, result)
+        return result
+
+
+class SampleRate:
+    """Report-Sample-Rate and Policy-Version headers of the generated nginx CSP
+    config, re-read when it changes"""
+
+    header = re.compile(r'^#\s*Report-Sample-Rate:\s*([0-9.]+)\s*$', re.MULTILINE)
+    # "# Policy-Version: <tag> <scope> [report-only [<canary sample rate>]]"
+    version_header = re.compile(r'^#\s*Policy-Version:\s*([0-9a-f]+)\s+(\S+)'
+                                r'(\s+report-only(?:\s+([0-9.]+))?)?\s*$', re.MULTILINE)
+
+    def __init__(self, config_file, check_interval=30):
+        self.config_file = config_file
+        self.check_interval = check_interval
+        self.checked_at = 0.0
+        self.mtime = None
+        self.weight = 1.0
+        self.versions = {}          # tag -> (scope, report_only, weight)
+
+    def current_weight(self, version=None):
+        """Multiplier that scales one sampled report back to real traffic"""
+        now = time.time()
+        if now - self.checked_at >= self.check_interval:
+            self.checked_at = now
+            try:
+                mtime = os.stat(self.config_file).st_mtime
+            except OSError:
+                mtime = None
+            if mtime != self.mtime:
+                self.mtime = mtime
+                self._read()
+        # The Report-Only canary has its own sample rate
+        if version in self.versions and self.versions[version][1]:
+            return self.versions[version][2]
+        return self.weight
+
+    def scope(self, version):
+        """Scope name of a policy version, None when the config does not list it"""
+        self.current_weight()
+        entry = self.versions.get(version)
+        return entry[0] if entry else None
+
+    def report_only(self, version):
+        self.current_weight()
+        entry = self.versions.get(version)
+        return bool(entry and entry[1])
+
+    @staticmethod
+    def _weight(rate):
+        return 1.0 / rate if 0 < rate <= 1 else 1.0
+
+    def _read(self):
+        self.weight = 1.0
+        self.versions = {}
+        try:
+            with open(self.config_file, 'r') as f:
+                text = f.read(8192)
+            match = self.header.search(text)
+            self.weight = self._weight(float(match.group(1))) if match else 1.0
+            for tag, scope, report_only, rate in self.version_header.findall(text):
+                self.versions[tag] = (scope, bool(report_only), self._weight(float(rate)) if rate else 1.0)
+        except (OSError, ValueError):
+            pass
+
+
+class VersionCounts:
+    """Violation counts per policy version (the <version> of /csp-violation/<version>)"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}            # version -> {'reports', 'weighted', 'first', 'last'}
+
+    def add(self, version, weight=1.0, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            entry = self.counts.get(version)
+            if entry is None:
+                entry = self.counts[version] = {'reports': 0, 'weighted': 0.0, 'first': now}
+            entry['reports'] += 1
+            entry['weighted'] += weight
+            entry['last'] = now
+
+    def snapshot(self):
+        with self.lock:
+            return {version: dict(entry) for version, entry in self.counts.items()}
+
+
+class NoiseFilter:
+    """Rules that drop or downgrade reports caused by extensions, injected
+    ad/AV scripts and the like, re-read when the rules file changes
+
+    One rule per line: <action> <field> <match> <pattern>
+      action  drop (not logged, only counted), downgrade (syslog LOG_DEBUG,
+              kept out of spike detection, /stats and /versions; JSON-lines
+              records get "noise": <rule>) or keep (exception to later rules)
+      field   blocked, source, page, directive, sample or raw (unparsed body)
+      match   prefix, exact or regex (searched; anchor with ^; no group
+              names, backreferences or global flags such as (?i))
+    Matching is case-insensitive and the first matching rule wins. All rules
+    on a field are compiled into one regex, so a report costs one match per
+    field whatever the number of rules.
+    """
+
+    ACTIONS = ('drop', 'downgrade', 'keep')
+    # field -> CSP report keys tried in order
+    FIELDS = {'blocked': ('blocked-uri',), 'source': ('source-file',),
+              'page': ('document-uri',), 'directive': ('effective-directive', 'violated-directive'),
+              'sample': ('script-sample',), 'raw': ()}
+    MATCHES = ('prefix', 'exact', 'regex')
+    # Constructs that break or change meaning once a regex rule is merged
+    # with the others: group names, backreferences, conditionals on a group
+    # and global inline flags (scoped flags like (?i:...) are fine)
+    UNMERGEABLE = re.compile(r'\\(?:[1-9]|g<)|\(\?P[<=]|\(\?<(?![=!])|\(\?\(|\(\?[aiLmsux]+\)|\\.', re.S)
+
+    EXAMPLE = """\
+# catch-CSP-reports.py --noise-rules: <action> <field> <match> <pattern>
+# Browser extensions and built-in pages
+drop       blocked  prefix  chrome-extension://
+drop       blocked  prefix  moz-extension://
+drop       blocked  prefix  safari-extension://
+drop       blocked  prefix  safari-web-extension://
+drop       blocked  prefix  ms-browser-extension://
+drop       source   prefix  chrome-extension://
+drop       source   prefix  moz-extension://
+drop       source   prefix  safari-extension://
+drop       source   prefix  safari-web-extension://
+drop       blocked  exact   about
+drop       blocked  prefix  about:
+drop       source   exact   about
+drop       source   prefix  about:
+# Scripts injected by ad networks, AV products and translation tools
+downgrade  blocked  regex   ^https?://([^/]*\\.)?(doubleclick\\.net|googlesyndication\\.com|adnxs\\.com)/
+downgrade  blocked  regex   ^https?://([^/]*\\.)?(kaspersky-labs\\.com|avast\\.com|norton\\.com)/
+downgrade  blocked  regex   ^https?://translate\\.(googleapis|google)\\.com/
+downgrade  sample   prefix  (function injectPageScriptAPI
+"""
+
+    def __init__(self, rules_file, check_interval=5):
+        self.rules_file = rules_file
+        self.check_interval = check_interval
+        self.checked_at = 0.0
+        self.mtime = None
+        self.lock = threading.Lock()
+        # (rules, compiled), swapped as one so a reader never pairs new rules with
+        # old regexes: rules are (text, action, field), compiled is (field, regex
+        # with one group r<index> per rule)
+        self.ruleset = ([], [])
+        self.hits = {}              # rule text -> [hits, last hit]; survives reloads
+        self.checked = 0
+        self.loaded_at = None
+
+    @classmethod
+    def compile_rules(cls, text):
+        """(rules, compiled) from rules file text; ValueError names the bad line"""
+        rules = []
+        by_field = {}
+        for number, line in enumerate(text.splitlines(), 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            parts = line.split(None, 3)
+            if len(parts) != 4 or parts[0] not in cls.ACTIONS or parts[1] not in cls.FIELDS \
+                    or parts[2] not in cls.MATCHES:
+                raise ValueError(f'line {number}: expected <{"|".join(cls.ACTIONS)}> '
+                                 f'<{"|".join(cls.FIELDS)}> <{"|".join(cls.MATCHES)}> <pattern>')
+            action, field, match, pattern = parts
+            if match == 'prefix':
+                expression = re.escape(pattern)
+            elif match == 'exact':
+                expression = re.escape(pattern) + r'\Z'
+            else:
+                try:
+                    re.compile(pattern)
+                except re.error as e:
+                    raise ValueError(f'line {number}: {e}')
+                for unsafe in cls.UNMERGEABLE.finditer(pattern):
+                    if len(unsafe.group()) > 2 or unsafe.group()[1] in '123456789':
+                        raise ValueError(f'line {number}: {unsafe.group()} not allowed in a regex rule '
+                                         f'(no group names, backreferences or global flags; '
+                                         f'matching is already case-insensitive)')
+                expression = r'(?s:.*?)(?:' + pattern + ')'
+            by_field.setdefault(field, []).append(f'(?P<r{len(rules)}>{expression})')
+            rules.append((' '.join(parts), action, field))
+        try:
+            compiled = [(field, re.compile('|'.join(alternatives), re.IGNORECASE))
+                        for field, alternatives in by_field.items()]
+        except re.error as e:
+            raise ValueError(f'regex rules cannot be combined: {e}')
+        return rules, compiled
+
+    def _reload(self):
+        now = time.time()
+        if now - self.checked_at < self.check_interval:
+            return
+        self.checked_at = now
+        try:
+            mtime = os.stat(self.rules_file).st_mtime
+        except OSError:
+            mtime = None
+        if mtime == self.mtime:
+            return
+        self.mtime = mtime
+        try:
+            with open(self.rules_file, 'r') as f:
+                rules, compiled = self.compile_rules(f.read())
+        except (OSError, ValueError) as e:
+            # Keep filtering with the rules we have
+            syslog.syslog(syslog.LOG_ERR, f'Error loading CSP noise rules {self.rules_file}: {e}')
+            return
+        with self.lock:
+            self.ruleset = (rules, compiled)
+            self.hits = {text: self.hits.get(text, [0, None]) for text, _, _ in rules}
+            self.loaded_at = now
+
+    def classify(self, csp_report=None, raw_data=None):
+        """(action, rule text) of the first matching rule, (None, None) otherwise"""
+        self._reload()
+        rules, compiled = self.ruleset
+        first = None
+        for field, regex in compiled:
+            if field == 'raw':
+                value = raw_data if csp_report is None else None
+            elif csp_report is not None:
+                value = next((csp_report[key] for key in self.FIELDS[field] if csp_report.get(key)), None)
+            else:
+                value = None
+            if not isinstance(value, str):
+                continue
+            match = regex.match(value)
+            if match:
+                index = int(match.lastgroup[1:])
+                if first is None or index < first:
+                    first = index
+        with self.lock:
+            self.checked += 1
+            if first is None:
+                return None, None
+            text, action, _ = rules[first]
+            entry = self.hits.get(text)
+            if entry is not None:
+                entry[0] += 1
+                entry[1] = time.time()
+        return action, text
+
+    def snapshot(self):
+        with self.lock:
+            return {'file': self.rules_file,
+                    'loaded': round(self.loaded_at, 3) if self.loaded_at else None,
+                    'checked': self.checked,
+                    'rules': [{'rule': text, 'action': action, 'hits': self.hits[text][0],
+                               'last': round(self.hits[text][1], 3) if self.hits[text][1] else None}
+                              for text, action, _ in self.ruleset[0]]}
+
+
+class Spool:
+    """Ordered on-disk queue of gzipped batches: <dir>/<sequence>.jsonl.gz"""
+
+    def __init__(self, directory, max_bytes=256 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        # Temporary files of an interrupted push are incomplete
+        for leftover in glob.glob(os.path.join(directory, '*.tmp')):
+            os.remove(leftover)
+        self.files = sorted(glob.glob(os.path.join(directory, '[0-9]*.jsonl.gz')))
+        self.sequence = int(os.path.basename(self.files[-1]).split('.')[0]) if self.files else 0
+        self.size = sum(os.path.getsize(path) for path in self.files)
+
+    def __len__(self):
+        return len(self.files)
+
+    def push(self, payload):
+        self.sequence += 1
+        path = os.path.join(self.directory, f"{self.sequence:012d}.jsonl.gz")
+        with open(path + '.tmp', 'wb') as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+        self.files.append(path)
+        self.size += len(payload)
+        dropped = 0
+        while self.size > self.max_bytes and len(self.files) > 1:
+            oldest = self.files.pop(0)
+            self.size -= os.path.getsize(oldest)
+            os.remove(oldest)
+            dropped += 1
+        if dropped:
+            syslog.syslog(syslog.LOG_ERR, f'CSP forwarder spool full, dropped {dropped} oldest batches')
+
+    def peek(self):
+        with open(self.files[0], 'rb') as f:
+            return f.read()
+
+    def pop(self):
+        oldest = self.files.pop(0)
+        self.size -= os.path.getsize(oldest)
+        os.remove(oldest)
+
+
+class Forwarder:
+    """Ships reports to a central collector in gzipped JSON-lines batches
+
+    Reports are queued in memory and sent by one thread over a single
+    keep-alive connection, every batch_size reports or batch_interval
+    seconds. A batch that cannot be delivered goes to the disk spool; while
+    the spool holds anything, new batches are appended behind it and the
+    spool is replayed oldest first (with backoff), so the central collector
+    receives batches in order.
+    """
+
+    def __init__(self, url, spool_dir, token=None, batch_size=500, batch_interval=2.0,
+                 spool_max_bytes=256 * 1024 * 1024, timeout=10):
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise ValueError(f'unsupported forward URL: {url}')
+        self.parts = parts
+        self.path = (parts.path or '/csp-batch') + (f'?{parts.query}' if parts.query else '')
+        self.headers = {'Content-Type': 'application/x-ndjson', 'Content-Encoding': 'gzip',
+                        'X-CSP-Node': socket.gethostname()}
+        if token:
+            self.headers['X-CSP-Token'] = token
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.timeout = timeout
+        self.spool = Spool(spool_dir, spool_max_bytes)
+        self.queue = queue.Queue()
+        self.connection = None
+        self.backoff = 0.0
+        self.retry_at = 0.0
+        self._closed = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def submit(self, item):
+        self.queue.put(item)
+
+    def _collect(self):
+        """Up to batch_size queued items, waiting at most batch_interval for the first"""
+        items = []
+        deadline = time.time() + self.batch_interval
+        while len(items) < self.batch_size:
+            remaining = deadline - time.time()
+            try:
+                items.append(self.queue.get(timeout=max(remaining, 0.01)) if remaining > 0
+                             else self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return items
+
+    @staticmethod
+    def _encode(items):
+        lines = ''.join(json.dumps(item, separators=(',', ':'), ensure_ascii=False) + '\n'
+                        for item in items)
+        return gzip.compress(lines.encode('utf-8'), compresslevel=6)
+
+    def _run(self):
+        while not self._closed.is_set():
+            items = self._collect()
+            if items:
+                payload = self._encode(items)
+                # Behind anything already spooled, to keep the order
+                if len(self.spool) or not self._deliver(payload):
+                    self._spool(payload)
+            self._replay()
+
+    def _replay(self):
+        while len(self.spool) and time.time() >= self.retry_at and not self._closed.is_set():
+            try:
+                payload = self.spool.peek()
+            except OSError as e:
+                syslog.syslog(syslog.LOG_ERR, f'Error reading CSP forwarder spool: {e}')
+                self.spool.pop()
+                continue
+            if not self._deliver(payload):
+                return
+            self.spool.pop()
+
+    def _spool(self, payload):
+        try:
+            self.spool.push(payload)
+        except OSError as e:
+            syslog.syslog(syslog.LOG_ERR, f'Error spooling CSP reports, batch lost: {e}')
+
+    def _connect(self):
+        cls = http.client.HTTPSConnection if self.parts.scheme == 'https' else http.client.HTTPConnection
+        return cls(self.parts.hostname, self.parts.port, timeout=self.timeout)
+
+    def _deliver(self, payload):
+        """POST one batch; False (and backoff) when it should be retried later"""
+        if time.time() < self.retry_at:
+            return False
+        # A kept-alive connection the server has since closed gets one fresh retry
+        for attempt in range(2):
+            reused = self.connection is not None
+            try:
+                if self.connection is None:
+                    self.connection = self._connect()
+                self.connection.request('POST', self.path, body=payload, headers=self.headers)
+                response = self.connection.getresponse()
+                response.read()
+                status = response.status
+                break
+            except (OSError, http.client.HTTPException) as e:
+                if self.connection is not None:
+                    self.connection.close()
+                    self.connection = None
+                if not reused or attempt:
+                    return self._failed(f'{type(e).__name__}: {e}')
+        if status >= 500 or status in (408, 429):
+            return self._failed(f'HTTP {status}')
+        if status >= 400:
+            # Retrying cannot help; keep the queue moving
+            syslog.syslog(syslog.LOG_ERR, f'CSP collector rejected a batch: HTTP {status}, dropped')
+        self.backoff = 0.0
+        return True
+
+    def _failed(self, reason):
+        if not self.backoff:
+            syslog.syslog(syslog.LOG_WARNING, f'CSP collector unreachable ({reason}), spooling reports')
+        self.backoff = min(max(self.backoff * 2, 1.0), 60.0)
+        self.retry_at = time.time() + self.backoff
+        return False
+
+    def close(self):
+        """Spool whatever is still queued (one delivery attempt first)"""
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        self.thread.join(timeout=self.batch_interval + self.timeout)
+        items = []
+        while True:
+            try:
+                items.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        if items:
+            payload = self._encode(items)
+            self.retry_at = 0.0
+            if len(self.spool) or not self._deliver(payload):
+                self._spool(payload)
+
+
+def _without_query(uri):
+    """uri without query string and fragment (tokens, cache busters)"""
+    if not uri:
+        return None
+    return uri.split('#', 1)[0].split('?', 1)[0]
+
+
+def record_report(csp_report=None, raw_data=None, version=None, ts=None, weight=None, node=None):
+    """Send one report to syslog and/or the JSON-lines sink (or to the forwarder)
+
+    ts, weight and node come with reports forwarded by an edge collector.
+    Noise rules run first: dropped reports cost one classification only.
+    """
+    noise_rule = None
+    if noise:
+        action, noise_rule = noise.classify(csp_report, raw_data)
+        if action == 'drop':
+            return
+        if action != 'downgrade':
+            noise_rule = None
+    ts = time.time() if ts is None else ts
+    if weight is None:
+        weight = sample_rate.current_weight(version) if sample_rate else 1.0
+    if forwarder:
+        item = {'ts': round(ts, 3)}
+        if csp_report is not None:
+            item['report'] = csp_report
+        else:
+            item['raw'] = raw_data
+        if version:
+            item['version'] = version
+        if weight != 1.0:
+            item['weight'] = round(weight, 3)
+        forwarder.submit(item)
+        return
+    if csp_report is not None:
+        violated_directive = csp_report.get('violated-directive', 'unknown')
+        blocked_uri = csp_report.get('blocked-uri', 'unknown')
+        document_uri = csp_report.get('document-uri', 'unknown')
+        if use_syslog:
+            syslog.syslog(syslog.LOG_DEBUG if noise_rule else syslog.LOG_WARNING,
                          f'CSP violation - directive: {violated_directive}, '
-                         f'blocked: {blocked_uri}, page: {document_uri}')
+                         f'blocked: {blocked_uri}, page: {document_uri}'
+                         + (f', version: {version}' if version else '')
+                         + (f', node: {node}' if node else ''))
+        if versions is not None and version and not noise_rule:
+            versions.add(version, weight)
+        if hitters and not noise_rule:
+            hitters.observe({'blocked': _without_query(blocked_uri),
+                             'page': urlsplit(document_uri).path or document_uri,
+                             'source': _without_query(csp_report.get('source-file')),
+                             'directive': csp_report.get('effective-directive')
+                                          or violated_directive.split(' ', 1)[0]}, weight)
+        if sink:
+            record = {'ts': round(ts, 3),
+                      'directive': violated_directive,
+                      'blocked': blocked_uri,
+                      'page': document_uri}
+            if version:
+                record['version'] = version
+            if node:
+                record['node'] = node
+            if weight != 1.0:
+                record['weight'] = round(weight, 3)
+            if noise_rule:
+                record['noise'] = noise_rule
+            for key, field in (('source', 'source-file'), ('line', 'line-number'),
+                               ('disposition', 'disposition')):
+                if csp_report.get(field) is not None:
+                    record[key] = csp_report[field]
+            sink.write(record)
+        # A canary is expected to report a lot when it is rolled out
+        if spikes and not noise_rule and not (sample_rate and sample_rate.report_only(version)):
+            directive = csp_report.get('effective-directive') or violated_directive.split(' ', 1)[0]
+            spikes.observe(directive, document_uri, weight)
+    else:
+        if use_syslog:
+            syslog.syslog(syslog.LOG_DEBUG if noise_rule else syslog.LOG_WARNING,
+                          f'CSP violation (raw): {raw_data}')
+        if sink:
+            record = {'ts': round(ts, 3), 'raw': raw_data}
+            if version:
+                record['version'] = version
+            if node:
+                record['node'] = node
+            if noise_rule:
+                record['noise'] = noise_rule
+            sink.write(record)
+
+
+# Lines written by record_report() (and the one-liner from the generator's
+# config header) as they appear in syslog files
+SYSLOG_VIOLATION = re.compile(
+    r'CSP violation - directive: (?P<directive>.*?), blocked: (?P<blocked>.*?), '
+    r'page: (?P<page>.*?)(?:, version: (?P<version>[0-9a-f]+))?(?:, node: (?P<node>\S+))?\s*$')
+SYSLOG_RAW = re.compile(r'CSP [Vv]iolation(?: \(raw\))?: (?P<raw>.*?)\s*$')
+SYSLOG_ISO_TIME = re.compile(r'^(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d(?:\.\d+)?(?:Z|[+-]\d\d:?\d\d)?)\s')
+SYSLOG_BSD_TIME = re.compile(r'^([A-Z][a-z]{2}) +(\d{1,2}) (\d\d):(\d\d):(\d\d)\s')
+MONTHS = {name: number for number, name in enumerate(
+    ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'), 1)}
+
+
+def _syslog_time(line, year, month):
+    """Epoch seconds of a syslog line; BSD stamps carry no year, the file's
+    mtime (year, month) supplies it"""
+    match = SYSLOG_ISO_TIME.match(line)
+    if match:
+        try:
+            return datetime.fromisoformat(match.group(1).replace('Z', '+00:00')).timestamp()
+        except ValueError:
+            return None
+    match = SYSLOG_BSD_TIME.match(line)
+    if match and match.group(1) in MONTHS:
+        line_month = MONTHS[match.group(1)]
+        line_year = year - 1 if line_month > month else year
+        try:
+            return time.mktime((line_year, line_month, int(match.group(2)), int(match.group(3)),
+                                int(match.group(4)), int(match.group(5)), 0, 0, -1))
+        except (OverflowError, ValueError):
+            return None
+    return None
+
+
+def parse_syslog_chunk(lines, year, month):
+    """Parse syslog lines into JSON-lines bytes for the sink (runs in a worker)
+
+    Returns (encoded records, violation records, raw records).
+    """
+    out = []
+    violations = raw = 0
+    for line in lines:
+        if 'CSP' not in line:
+            continue
+        match = SYSLOG_VIOLATION.search(line)
+        if match:
+            record = {'ts': None, 'directive': match.group('directive'),
+                      'blocked': match.group('blocked'), 'page': match.group('page')}
+            if match.group('version'):
+                record['version'] = match.group('version')
+            if match.group('node'):
+                record['node'] = match.group('node')
+            violations += 1
+        else:
+            match = SYSLOG_RAW.search(line)
+            if not match:
+                continue
+            record = {'ts': None, 'raw': match.group('raw')}
+            raw += 1
+        ts = _syslog_time(line, year, month)
+        record['ts'] = round(ts, 3) if ts is not None else None
+        out.append(json.dumps(record, separators=(',', ':'), ensure_ascii=False))
+    data = ('\n'.join(out) + '\n').encode('utf-8') if out else b''
+    return data, violations, raw
+
+
+def _read_chunks(path, chunk_lines):
+    """Lists of lines from a plain or gzipped file, chunk_lines at a time"""
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8', errors='replace') as f:
+        chunk = []
+        for line in f:
+            chunk.append(line)
+            if len(chunk) >= chunk_lines:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+def backfill(paths, target, workers=None, chunk_lines=20000):
+    """Load historical syslog violation lines into the JSON-lines sink
+
+    Files are read oldest first (by mtime) and cut into chunks that worker
+    processes parse; results are written in input order. At most two
+    chunks per worker are in flight, so memory stays bounded whatever the
+    file sizes. Returns (lines, violations, raw, seconds).
+    """
+    workers = workers or os.cpu_count() or 1
+    files = sorted(paths, key=lambda path: os.path.getmtime(path))
+    lines = violations = raw = 0
+    started = last_progress = time.time()
+    pending = deque()
+
+    def drain(limit):
+        nonlocal violations, raw
+        while len(pending) > limit:
+            data, found, raw_found = pending.popleft().result()
+            if data:
+                target.write_encoded(data)
+            violations += found
+            raw += raw_found
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for path in files:
+            stamp = time.localtime(os.path.getmtime(path))
+            try:
+                for chunk in _read_chunks(path, chunk_lines):
+                    lines += len(chunk)
+                    pending.append(pool.submit(parse_syslog_chunk, chunk, stamp.tm_year, stamp.tm_mon))
+                    drain(2 * workers)
+                    now = time.time()
+                    if now - last_progress >= 5:
+                        last_progress = now
+                        print(f"  {lines} lines, {lines / (now - started):,.0f} lines/sec", file=sys.stderr)
+            except (OSError, EOFError) as e:
+                print(f"Warning: Error reading {path}: {e}", file=sys.stderr)
+        drain(0)
+    return lines, violations, raw, time.time() - started
+
+
+# zm_generate_CSP3.py versions the report path: /csp-violation/<policy version>
+VERSION_TAG = re.compile(r'^[0-9a-f]{1,64}$')
+
+
+@app.route('/csp-violation', methods=['POST'], defaults={'version': None})
+@app.route('/csp-violation/<version>', methods=['POST'])
+def csp_violation(version):
+    if version is not None and not VERSION_TAG.match(version):
+        return '', 404
+    try:
+        report_data = request.get_json(force=True, silent=True)
+        if isinstance(report_data, dict) and 'csp-report' in report_data:
+            record_report(csp_report=report_data['csp-report'], version=version)
         else:
             # Fallback to raw data
-            raw_data = request.get_data(as_text=True)
-            syslog.syslog(syslog.LOG_WARNING, f'CSP violation (raw): {raw_data}')
+            record_report(raw_data=request.get_data(as_text=True), version=version)
     except Exception as e:
         syslog.syslog(syslog.LOG_ERR, f'Error processing CSP report: {e}')
     return '', 204
 
+
+# Forwarded reports: the edge's node name, and at most a 1/10000 sample rate
+NODE_NAME = re.compile(r'^[\w.:-]{1,255}$')
+MAX_WEIGHT = 10000.0
+
+
+def is_loopback(host):
+    """True when --host only accepts connections from this machine"""
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+@app.route('/csp-batch', methods=['POST'])
+def csp_batch():
+    """Gzipped JSON-lines batch from an edge collector running with --forward"""
+    if forwarder is not None:
+        # An edge does not relay other edges' batches
+        return '', 404
+    if batch_token is not None and not hmac.compare_digest(
+            request.headers.get('X-CSP-Token', '').encode('utf-8'), batch_token.encode('utf-8')):
+        return '', 403
+    try:
+        body = request.get_data()
+        if request.headers.get('Content-Encoding', '').lower() == 'gzip':
+            inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            body = inflater.decompress(body, MAX_BATCH_BYTES)
+            if inflater.unconsumed_tail:
+                syslog.syslog(syslog.LOG_ERR, f'CSP report batch from {request.remote_addr} '
+                                              f'inflates beyond {MAX_BATCH_BYTES} bytes, rejected')
+                return '', 413
+            if not inflater.eof:
+                raise ValueError('truncated gzip stream')
+        items = [json.loads(line) for line in body.decode('utf-8').splitlines() if line.strip()]
+    except (zlib.error, ValueError) as e:
+        syslog.syslog(syslog.LOG_ERR, f'Malformed CSP report batch: {e}')
+        return '', 400
+    node = request.headers.get('X-CSP-Node', '')
+    if not NODE_NAME.match(node):
+        node = request.remote_addr
+    for item in items:
+        try:
+            version = item.get('version')
+            if version is not None and not VERSION_TAG.match(str(version)):
+                version = None
+            weight = float(item.get('weight', 1.0))
+            if not 0 < weight <= MAX_WEIGHT:
+                raise ValueError(f'weight {weight} out of range')
+            ts = float(item.get('ts', time.time()))
+            if not math.isfinite(ts):
+                raise ValueError(f'timestamp {ts} out of range')
+            record_report(csp_report=item.get('report'), raw_data=item.get('raw'), version=version,
+                          ts=ts, weight=weight, node=node)
+        except Exception as e:
+            syslog.syslog(syslog.LOG_ERR, f'Error processing forwarded CSP report from {node}: {e}')
+    return '', 204
+
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    """Top offenders: /stats?dim=blocked|page|source|directive&window=1m|1h|1d&k=10"""
+    if hitters is None:
+        return {'error': 'heavy hitters disabled (--top-capacity 0)'}, 404
+    dimension = request.args.get('dim', 'blocked')
+    window = request.args.get('window', '1h')
+    try:
+        k = min(max(int(request.args.get('k', 10)), 1), hitters.capacity)
+    except ValueError:
+        k = 10
+    if dimension not in HeavyHitters.DIMENSIONS or window not in HeavyHitters.WINDOWS:
+        return {'error': 'unknown dim or window',
+                'dims': list(HeavyHitters.DIMENSIONS), 'windows': list(HeavyHitters.WINDOWS)}, 400
+    result = hitters.top(dimension, window, k)
+    return dict(result, dim=dimension, window=window)
+
+
+@app.route('/versions', methods=['GET'])
+def version_counts():
+    """Violations per policy version, with the scope named in the CSP config"""
+    counts = versions.snapshot() if versions is not None else {}
+    result = {}
+    for version, entry in sorted(counts.items(), key=lambda item: -item[1]['weighted']):
+        scope = sample_rate.scope(version) if sample_rate else None
+        result[version] = {'scope': scope or 'unknown',
+                           'reports': entry['reports'],
+                           'estimated': round(entry['weighted'], 1),
+                           'first': round(entry['first'], 3),
+                           'last': round(entry['last'], 3)}
+    return result
+
+
+@app.route('/noise', methods=['GET'])
+def noise_hits():
+    """Hit counters of the noise rules (--noise-rules)"""
+    if noise is None:
+        return {'error': 'no noise rules (--noise-rules)'}, 404
+    return noise.snapshot()
+
 if __name__ == '__main__':
-    print("Starting CSP violation report logger on port 7777...")
-    print("Violation reports will be logged to syslog")
-    app.run(host='127.0.0.1', port=7777, debug=False)
+    parser = argparse.ArgumentParser(description='Collect CSP violation reports')
+    parser.add_argument('--host', default='127.0.0.1', help='Listen address (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=7777, help='Listen port (default: 7777)')
+    parser.add_argument('--jsonl', metavar='FILE',
+                        help='Also write reports as JSON lines to FILE')
+    parser.add_argument('--jsonl-max-bytes', type=int, default=64 * 1024 * 1024,
+                        help='Rotate the JSON-lines file at this size (default: 64MB)')
+    parser.add_argument('--jsonl-rotate', type=int, default=86400, metavar='SECONDS',
+                        help='Rotate the JSON-lines file at this age (default: 86400)')
+    parser.add_argument('--no-syslog', action='store_true',
+                        help='Do not log reports to syslog (requires --jsonl)')
+    parser.add_argument('--spike-threshold', type=float, default=5.0,
+                        help='Alert when a rate exceeds this multiple of its baseline (0 disables)')
+    parser.add_argument('--spike-min-rate', type=float, default=6.0, metavar='PER_MINUTE',
+                        help='Minimum reports/minute before a spike can alert (default: 6)')
+    parser.add_argument('--alert-cooldown', type=int, default=600, metavar='SECONDS',
+                        help='Minimum seconds between alerts for the same page (default: 600)')
+    parser.add_argument('--alert-command', metavar='CMD',
+                        help='Run CMD with the alert message instead of logging LOG_ALERT')
+    parser.add_argument('--top-capacity', type=int, default=64, metavar='N',
+                        help='Counters per dimension and time bucket for GET /stats (0 disables)')
+    parser.add_argument('--csp-config', default='/opt/zimbra/conf/nginx/includes/csp-header.conf',
+                        help='Generated CSP config to read Report-Sample-Rate and Policy-Version from')
+    parser.add_argument('--forward', metavar='URL',
+                        help='Edge mode: batch reports to a central collector (http://host:7777/csp-batch)')
+    parser.add_argument('--spool', default='/var/spool/csp-reports', metavar='DIR',
+                        help='Disk queue for batches the central collector has not taken yet')
+    parser.add_argument('--spool-max-bytes', type=int, default=256 * 1024 * 1024,
+                        help='Drop the oldest spooled batches beyond this size (default: 256MB)')
+    parser.add_argument('--batch-size', type=int, default=500,
+                        help='Reports per forwarded batch (default: 500)')
+    parser.add_argument('--batch-interval', type=float, default=2.0, metavar='SECONDS',
+                        help='Send a partial batch after this long (default: 2)')
+    parser.add_argument('--batch-token', metavar='TOKEN',
+                        help='Shared secret sent with forwarded batches / required on /csp-batch')
+    parser.add_argument('--noise-rules', metavar='FILE',
+                        help='Drop or downgrade extension/injected-script reports by these rules '
+                             '(re-read when changed)')
+    parser.add_argument('--noise-rules-example', action='store_true',
+                        help='Print a starting --noise-rules file and exit')
+    parser.add_argument('--backfill', nargs='+', metavar='FILE',
+                        help='Load CSP lines from (rotated, gzipped) syslog files into --jsonl and exit')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Parser processes for --backfill (default: CPU count)')
+    args = parser.parse_args()
+
+    if args.noise_rules_example:
+        print(NoiseFilter.EXAMPLE, end='')
+        sys.exit(0)
+
+    if args.no_syslog and not args.jsonl and not args.forward:
+        parser.error('--no-syslog requires --jsonl')
+
+    if args.noise_rules:
+        try:
+            with open(args.noise_rules, 'r') as f:
+                count = len(NoiseFilter.compile_rules(f.read())[0])
+        except (OSError, ValueError) as e:
+            parser.error(f'--noise-rules {args.noise_rules}: {e}')
+        noise = NoiseFilter(args.noise_rules)
+        print(f"Noise filter: {count} rules from {args.noise_rules}")
+
+    if args.backfill:
+        if not args.jsonl:
+            parser.error('--backfill requires --jsonl')
+        sink = JsonLinesSink(args.jsonl, max_bytes=args.jsonl_max_bytes,
+                             rotate_seconds=args.jsonl_rotate)
+        missing = [path for path in args.backfill if not os.path.isfile(path)]
+        for path in missing:
+            print(f"Warning: {path} not found, skipped", file=sys.stderr)
+        print(f"Backfilling {len(args.backfill) - len(missing)} files into {args.jsonl}...")
+        lines, found, raw, seconds = backfill([p for p in args.backfill if p not in missing], sink,
+                                              args.workers)
+        sink.close()
+        print(f"Lines read:   {lines}")
+        print(f"Violations:   {found}")
+        print(f"Raw reports:  {raw}")
+        print(f"Throughput:   {lines / max(seconds, 1e-9):,.0f} lines/sec ({seconds:.1f}s)")
+        sys.exit(0)
+
+    if args.forward:
+        # Everything else happens on the central collector
+        sample_rate = SampleRate(args.csp_config)
+        try:
+            forwarder = Forwarder(args.forward, args.spool, token=args.batch_token,
+                                  batch_size=args.batch_size, batch_interval=args.batch_interval,
+                                  spool_max_bytes=args.spool_max_bytes)
+        except (ValueError, OSError) as e:
+            parser.error(f'--forward: {e}')
+        print(f"Starting CSP violation report forwarder on port {args.port}...")
+        print(f"Reports will be batched to {args.forward} (spool: {args.spool}, "
+              f"{len(forwarder.spool)} batches pending)")
+        app.run(host=args.host, port=args.port, debug=False)
+        sys.exit(0)
+
+    if not args.batch_token and not is_loopback(args.host):
+        parser.error(f'--host {args.host} accepts /csp-batch from other hosts, --batch-token is required')
+    batch_token = args.batch_token
+
+    use_syslog = not args.no_syslog
+    if args.jsonl:
+        sink = JsonLinesSink(args.jsonl, max_bytes=args.jsonl_max_bytes,
+                             rotate_seconds=args.jsonl_rotate)
+    sample_rate = SampleRate(args.csp_config)
+    versions = VersionCounts()
+    if args.top_capacity > 0:
+        hitters = HeavyHitters(capacity=args.top_capacity)
+    if args.spike_threshold > 0:
+        spikes = SpikeDetector(threshold=args.spike_threshold,
+                               min_rate=args.spike_min_rate / 60.0,
+                               cooldown=args.alert_cooldown,
+                               alert_command=args.alert_command)
+
+    print(f"Starting CSP violation report logger on port {args.port}...")
+    if use_syslog:
+        print("Violation reports will be logged to syslog")
+    if sink:
+        print(f"Violation reports will be written to {args.jsonl}")
+    app.run(host=args.host, port=args.port, debug=False)
@@ -0,0 +1,366 @@
+#!/usr/bin/python3
+#
+# csp_index.py
+#
+# Resident scan index for the zm_generate_CSP3.py inline-script scan. The
+# server loads the scan index (--scan-index, building or refreshing it
+# incrementally from the webapp tree first), keeps it in lookup tables and
+# answers queries over a local Unix socket, so questions about the inline
+# surface no longer need a cold BeautifulSoup scan.
+#
+#   ./csp_index.py --serve                      # /opt/zimbra/data/tmp/csp-index.sock
+#   ./csp_index.py hash "'sha256-...'"          # which files carry this inline hash (exit 1: none)
+#   ./csp_index.py file h/search.jsp            # scan record and rendered surface of one file
+#   ./csp_index.py prefix /zimbra/h/ --has handlers
+#   ./csp_index.py stats /zimbra/h/             # totals and the busiest directories
+#   ./csp_index.py reload                       # rescan files changed on disk (or: kill -HUP)
+#
+# Paths are URL paths when they start with '/' (served files only), webapp
+# relative paths otherwise (WEB-INF fragments included).
+#
+# Protocol: one JSON object per line each way on a stream socket, e.g.
+#   {"q": "hash", "hash": "'sha256-...'"}  ->  {"ok": true, "legit": true, ...}
+# Other scripts can use IndexClient:
+#   from csp_index import IndexClient
+#   IndexClient().query('hash', hash=value)['legit']
+#
+# Only the client runs without bs4; the server imports zm_generate_CSP3.py
+# from the directory it lives in.
+
+__version__ = "1.0.0"
+
+import argparse
+import bisect
+import json
+import os
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import time
+
+DEFAULT_SOCKET = '/opt/zimbra/data/tmp/csp-index.sock'
+DEFAULT_INDEX = '/opt/zimbra/conf/nginx/includes/csp-scan-index.json'
+MAX_REQUEST_BYTES = 64 * 1024
+KINDS = ('script', 'handler')
+# What a file can be filtered on in prefix queries: (scripts, dynamic, handlers) columns
+HAS = {'scripts': (0,), 'dynamic': (1,), 'handlers': (2,), 'any': (0, 1, 2)}
+
+
+def normalize_hash(value):
+    """'sha256-...' as it appears in policies, from a quoted or bare hash"""
+    value = value.strip().strip("'\"")
+    if '-' not in value:
+        value = f"sha256-{value}"
+    return f"'{value}'"
+
+
+class IndexTables:
+    """Read-only lookup structures over one ScanIndex
+
+    Files are numbered in relpath order; hashes map to compact occurrence
+    tuples, and cumulative counts over the relpath and URL orders answer
+    prefix aggregates with two binary searches.
+    """
+
+    def __init__(self, index, url_for):
+        self.index = index
+        self.loaded_at = time.time()
+        self.paths = sorted(index.files)
+        self.ids = {path: i for i, path in enumerate(self.paths)}
+        self.urls = [url_for(os.path.join(index.root, path)) for path in self.paths]
+        self.counts = []            # (static scripts, dynamic scripts, handlers) per file
+        self.hashes = {}            # hash -> [(file id, kind, line, col, dynamic reason)]
+        for i, path in enumerate(self.paths):
+            record = index.files[path]['record']
+            dynamic = 0
+            for kind, items in (('script', record['scripts']), ('handler', record['handlers'])):
+                for item in items:
+                    if kind == 'script' and item.get('dynamic'):
+                        dynamic += 1
+                    self.hashes.setdefault(item['hash'], []).append(
+                        (i, kind, item['line'], item['col'], item.get('dynamic')))
+            self.counts.append((len(record['scripts']) - dynamic, dynamic, len(record['handlers'])))
+
+        self.by_url = sorted((url, i) for i, url in enumerate(self.urls) if url is not None)
+        self.url_ids = {url: i for url, i in self.by_url}
+        self.url_keys = [url for url, _ in self.by_url]
+        self.path_totals = self._cumulative(range(len(self.paths)))
+        self.url_totals = self._cumulative(i for _, i in self.by_url)
+
+    def _cumulative(self, ids):
+        totals = [(0, 0, 0, 0)]
+        for i in ids:
+            files, scripts, dynamic, handlers = totals[-1]
+            s, d, h = self.counts[i]
+            totals.append((files + 1, scripts + s, dynamic + d, handlers + h))
+        return totals
+
+    def _range(self, prefix):
+        """(cumulative totals, lo, hi, file ids) of the files under prefix"""
+        if prefix.startswith('/'):
+            lo = bisect.bisect_left(self.url_keys, prefix)
+            hi = bisect.bisect_left(self.url_keys, prefix + '\uffff')
+            return self.url_totals, lo, hi, [self.by_url[j][1] for j in range(lo, hi)]
+        lo = bisect.bisect_left(self.paths, prefix)
+        hi = bisect.bisect_left(self.paths, prefix + '\uffff')
+        return self.path_totals, lo, hi, range(lo, hi)
+
+    def _file(self, i):
+        scripts, dynamic, handlers = self.counts[i]
+        return {'file': self.paths[i], 'url': self.urls[i], 'scripts': scripts,
+                'dynamic': dynamic, 'handlers': handlers}
+
+    def lookup_hash(self, value):
+        occurrences = self.hashes.get(normalize_hash(value), [])
+        result = []
+        for i, kind, line, col, dynamic in occurrences:
+            entry = {'file': self.paths[i], 'url': self.urls[i], 'kind': kind, 'line': line, 'col': col}
+            if dynamic:
+                entry['dynamic'] = dynamic
+            result.append(entry)
+        # Dynamic items never make it into a policy, their source hash is not what is served
+        return {'hash': normalize_hash(value), 'legit': bool(occurrences),
+                'in_policy': any(not o[4] for o in occurrences), 'occurrences': result}
+
+    def lookup_file(self, path):
+        i = self.url_ids.get(path) if path.startswith('/') else self.ids.get(path)
+        if i is None:
+            raise KeyError(f"not in the index: {path}")
+        record = self.index.files[self.paths[i]]['record']
+        result = self._file(i)
+        result.update(items={kind: [dict(item) for item in record[kind + 's']] for kind in KINDS},
+                      sources=record['sources'], refs=record.get('refs'),
+                      surface=self.index.surface(self.paths[i]))
+        return result
+
+    def prefix(self, prefix, has='any', limit=1000):
+        if has not in HAS:
+            raise ValueError(f"has must be one of {', '.join(HAS)}")
+        _, _, _, ids = self._range(prefix)
+        columns = HAS[has]
+        files = [self._file(i) for i in ids if any(self.counts[i][c] for c in columns)]
+        return {'prefix': prefix, 'has': has, 'matches': len(files), 'files': files[:limit]}
+
+    def stats(self, prefix='', top=10):
+        totals, lo, hi, ids = self._range(prefix)
+        files, scripts, dynamic, handlers = (a - b for a, b in zip(totals[hi], totals[lo]))
+        directories = {}
+        for i in ids:
+            key = (self.urls[i] if prefix.startswith('/') else self.paths[i]).rpartition('/')[0] + '/'
+            entry = directories.setdefault(key, [0, 0, 0, 0])
+            entry[0] += 1
+            for column in range(3):
+                entry[column + 1] += self.counts[i][column]
+        busiest = sorted(directories.items(), key=lambda item: -(item[1][1] + item[1][2] + item[1][3]))
+        result = {'prefix': prefix, 'files': files, 'scripts': scripts, 'dynamic': dynamic,
+                  'handlers': handlers,
+                  'directories': [{'directory': d, 'files': c[0], 'scripts': c[1], 'dynamic': c[2],
+                                   'handlers': c[3]} for d, c in busiest[:top]]}
+        if not prefix:
+            result.update(unique_hashes=len(self.hashes), root=self.index.root,
+                          loaded=round(self.loaded_at, 3))
+        return result
+
+
+class IndexServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, build):
+        self.build = build          # () -> IndexTables, rescanning what changed
+        self.reload_lock = threading.Lock()
+        if os.path.exists(socket_path):
+            # A live server still answers; a stale socket file does not
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(socket_path)
+                raise OSError(f"another index server is listening on {socket_path}")
+            except (ConnectionRefusedError, FileNotFoundError):
+                os.unlink(socket_path)
+            finally:
+                probe.close()
+        self.tables = build()
+        super().__init__(socket_path, IndexRequestHandler)
+        os.chmod(socket_path, 0o660)
+
+    def reload(self):
+        """Swap in tables rebuilt from disk; queries keep using the old ones meanwhile"""
+        with self.reload_lock:
+            self.tables = self.build()
+        return {'files': len(self.tables.paths), 'loaded': round(self.tables.loaded_at, 3)}
+
+    def answer(self, request):
+        tables = self.tables
+        q = request.get('q')
+        if q == 'ping':
+            return {'version': __version__}
+        if q == 'hash':
+            return tables.lookup_hash(str(request['hash']))
+        if q == 'file':
+            return tables.lookup_file(str(request['path']))
+        if q == 'prefix':
+            return tables.prefix(str(request.get('prefix', '')), request.get('has', 'any'),
+                                 int(request.get('limit', 1000)))
+        if q == 'stats':
+            return tables.stats(str(request.get('prefix', '')), int(request.get('top', 10)))
+        if q == 'reload':
+            return self.reload()
+        raise ValueError(f"unknown query {q!r} (ping, hash, file, prefix, stats, reload)")
+
+
+class IndexRequestHandler(socketserver.StreamRequestHandler):
+    """Newline-delimited JSON requests on one connection until it closes"""
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline(MAX_REQUEST_BYTES + 1)
+            if not line:
+                return
+            started = time.perf_counter()
+            try:
+                if len(line) > MAX_REQUEST_BYTES:
+                    raise ValueError('request too long')
+                response = dict(self.server.answer(json.loads(line)), ok=True)
+            except KeyError as e:
+                response = {'ok': False, 'error': e.args[0] if e.args else 'missing field'}
+            except (ValueError, TypeError, AttributeError) as e:
+                response = {'ok': False, 'error': str(e)}
+            response['elapsed_us'] = round((time.perf_counter() - started) * 1e6)
+            try:
+                self.wfile.write(json.dumps(response, separators=(',', ':')).encode('utf-8') + b'\n')
+            except OSError:
+                return
+
+
+class IndexClient:
+    """Keep-alive connection to a running index server"""
+
+    def __init__(self, socket_path=DEFAULT_SOCKET, timeout=5):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.sock = None
+
+    def query(self, q, **fields):
+        """Response dict of one query; OSError when the server is not running"""
+        request = json.dumps(dict(fields, q=q), separators=(',', ':')).encode('utf-8') + b'\n'
+        for attempt in (0, 1):
+            if self.sock is None:
+                self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self.sock.settimeout(self.timeout)
+                self.sock.connect(self.socket_path)
+                self.reader = self.sock.makefile('rb')
+            try:
+                self.sock.sendall(request)
+                line = self.reader.readline()
+                if line:
+                    return json.loads(line)
+            except OSError:
+                if attempt:
+                    raise
+            # The server restarted since the last query: reconnect once
+            self.close()
+        raise OSError(f"no response from {self.socket_path}")
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+def serve(args):
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from zm_generate_CSP3 import ScanIndex, ZimbraCSPGenerator
+
+    def build():
+        started = time.time()
+        index = ScanIndex(args.scan_index, args.root)
+        generator = ZimbraCSPGenerator()
+        if index.root or args.root:
+            generator.set_webapp_root(index.root or args.root)
+        index.root = generator.webapp_root
+        if not args.no_update:
+            rescanned, removed = index.update([f for _, f in generator.find_scan_files()], args.workers)
+            if rescanned or removed:
+                index.save()
+            print(f"Scan index {args.scan_index}: {len(index.files)} files, {rescanned} rescanned, "
+                  f"{removed} removed", file=sys.stderr)
+        tables = IndexTables(index, generator.url_for)
+        print(f"Loaded {len(tables.paths)} files, {len(tables.hashes)} unique hashes "
+              f"in {time.time() - started:.1f}s", file=sys.stderr)
+        return tables
+
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(args.socket)), exist_ok=True)
+        server = IndexServer(args.socket, build)
+    except OSError as e:
+        print(f"ERROR: Cannot start index server: {e}", file=sys.stderr)
+        return 1
+    signal.signal(signal.SIGHUP, lambda *_: threading.Thread(target=server.reload, daemon=True).start())
+    signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=server.shutdown, daemon=True).start())
+    print(f"CSP scan index server listening on {args.socket}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if os.path.exists(args.socket):
+            os.unlink(args.socket)
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Resident CSP scan index server and client')
+    parser.add_argument('command', nargs='?', choices=('ping', 'hash', 'file', 'prefix', 'stats', 'reload'),
+                        help='Query to send to a running server')
+    parser.add_argument('argument', nargs='?', help='Hash, file path or prefix for the query')
+    parser.add_argument('--serve', action='store_true', help='Run the index server')
+    parser.add_argument('--socket', default=DEFAULT_SOCKET, help=f'Unix socket (default: {DEFAULT_SOCKET})')
+    parser.add_argument('--scan-index', default=DEFAULT_INDEX, metavar='FILE',
+                        help='Scan index written by zm_generate_CSP3.py --scan-index')
+    parser.add_argument('--root', metavar='DIR',
+                        help='Webapp root (default: the one recorded in the index, else the live install)')
+    parser.add_argument('--workers', type=int, default=None, help='Parallel scan processes')
+    parser.add_argument('--no-update', action='store_true',
+                        help='Serve the index file as is, without checking the tree for changes')
+    parser.add_argument('--has', default='any', choices=tuple(HAS),
+                        help='prefix: only files with these inline items (default: any)')
+    parser.add_argument('--limit', type=int, default=1000, help='prefix: files to list (default: 1000)')
+    parser.add_argument('--top', type=int, default=10, help='stats: directories to list (default: 10)')
+    args = parser.parse_args()
+
+    if args.serve:
+        return serve(args)
+    if not args.command:
+        parser.error('give a query or --serve')
+
+    fields = {}
+    if args.command == 'hash':
+        if not args.argument:
+            parser.error('hash needs a hash')
+        fields['hash'] = args.argument
+    elif args.command == 'file':
+        if not args.argument:
+            parser.error('file needs a path')
+        fields['path'] = args.argument
+    elif args.command == 'prefix':
+        fields.update(prefix=args.argument or '', has=args.has, limit=args.limit)
+    elif args.command == 'stats':
+        fields.update(prefix=args.argument or '', top=args.top)
+
+    try:
+        response = IndexClient(args.socket).query(args.command, **fields)
+    except OSError as e:
+        print(f"ERROR: Cannot query index server on {args.socket}: {e}", file=sys.stderr)
+        return 2
+    print(json.dumps(response, indent=2))
+    if not response.get('ok'):
+        return 2
+    if args.command == 'hash' and not response['legit']:
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
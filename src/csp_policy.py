@@ -0,0 +1,214 @@
+#!/usr/bin/python3
+#
+# Content-Security-Policy model and compiler shared by the zm_generate_CSP*.py
+# generators (they import it from the directory they live in).
+#
+# A policy is a set of directives, each an ordered, de-duplicated list of
+# sources. compile() drops sources that cannot change what the browser
+# allows and serializes to one canonical string: directives and keywords in
+# a fixed order, hashes sorted, "; " between directives, no trailing ";".
+#
+#     policy = CSPPolicy().add('script-src', "'self'", "'unsafe-inline'", hashes)
+#     header = policy.compile().serialize()
+#
+# Redundancies removed:
+# - duplicate sources (keywords and hosts compare case-insensitively)
+# - 'none' next to any other source (browsers ignore it then)
+# - hashes, nonces and 'unsafe-hashes' next to 'unsafe-inline' without
+#   'strict-dynamic': the directive is meant to allow all inline code, and
+#   hashes would make CSP2+ browsers ignore 'unsafe-inline' instead
+# - host sources covered by '*' or by a scheme source (https: covers
+#   https://cdn.example.com)
+# - fetch directives identical to default-src, their fallback
+
+__version__ = "1.0.0"
+
+import copy
+
+# Canonical directive order; anything else follows in insertion order,
+# reporting directives always come last
+DIRECTIVE_ORDER = (
+    'default-src', 'script-src', 'script-src-elem', 'script-src-attr',
+    'style-src', 'style-src-elem', 'style-src-attr', 'img-src', 'font-src',
+    'connect-src', 'media-src', 'object-src', 'frame-src', 'child-src',
+    'worker-src', 'manifest-src', 'base-uri', 'form-action', 'frame-ancestors',
+    'sandbox', 'upgrade-insecure-requests', 'block-all-mixed-content',
+)
+REPORT_DIRECTIVES = ('report-uri', 'report-to')
+
+KEYWORD_ORDER = (
+    "'none'", "'self'", "'strict-dynamic'", "'unsafe-inline'", "'unsafe-eval'",
+    "'wasm-unsafe-eval'", "'unsafe-hashes'", "'report-sample'",
+    "'inline-speculation-rules'",
+)
+
+# Directives that fall back to default-src when absent
+DEFAULT_SRC_FALLBACK = (
+    'script-src', 'style-src', 'img-src', 'font-src', 'connect-src',
+    'media-src', 'object-src', 'child-src', 'manifest-src',
+)
+
+# Directives where 'unsafe-inline' makes hashes and nonces redundant
+INLINE_DIRECTIVES = (
+    'default-src', 'script-src', 'script-src-elem', 'script-src-attr',
+    'style-src', 'style-src-elem', 'style-src-attr',
+)
+
+HASH_PREFIXES = ("'sha256-", "'sha384-", "'sha512-")
+
+
+def source_kind(source):
+    """Classify a source expression: keyword, nonce, hash, scheme, wildcard or host"""
+    lower = source.lower()
+    if lower.startswith(HASH_PREFIXES):
+        return 'hash'
+    if lower.startswith("'nonce-"):
+        return 'nonce'
+    if lower.startswith("'"):
+        return 'keyword'
+    if lower.endswith(':') and '/' not in lower:
+        return 'scheme'
+    if lower == '*':
+        return 'wildcard'
+    return 'host'
+
+
+def canonical_source(source):
+    """Spelling used for comparison and output: keywords, schemes and host names
+    are case-insensitive; paths, hashes and nonces keep their case"""
+    kind = source_kind(source)
+    if kind in ('hash', 'nonce'):
+        return source
+    if kind == 'host':
+        scheme, sep, rest = source.partition('://') if '://' in source else ('', '', source)
+        host, slash, path = rest.partition('/')
+        return (scheme + sep + host).lower() + slash + path
+    return source.lower()
+
+
+class CSPPolicy:
+    """Directives mapped to ordered, de-duplicated source lists"""
+
+    def __init__(self, directives=None):
+        self.directives = {}
+        self.dropped = []           # (directive, source, reason) from compile()
+        for directive, sources in (directives or {}).items():
+            self.add(directive, *sources)
+
+    @classmethod
+    def parse(cls, value):
+        """Policy from a header value (first occurrence of a directive wins)"""
+        policy = cls()
+        for part in value.split(';'):
+            tokens = part.split()
+            if tokens and tokens[0].lower() not in policy.directives:
+                policy.add(tokens[0], *tokens[1:])
+        return policy
+
+    def add(self, directive, *sources):
+        """Append sources to a directive (created when missing); iterables are flattened"""
+        current = self.directives.setdefault(directive.lower(), [])
+        seen = set(current)
+        for source in sources:
+            for item in ([source] if isinstance(source, str) else source):
+                item = canonical_source(item)
+                if item not in seen:
+                    seen.add(item)
+                    current.append(item)
+        return self
+
+    def set(self, directive, *sources):
+        """Replace a directive's sources"""
+        self.directives.pop(directive.lower(), None)
+        return self.add(directive, *sources)
+
+    def remove(self, directive):
+        self.directives.pop(directive.lower(), None)
+        return self
+
+    def sources(self, directive):
+        return list(self.directives.get(directive.lower(), []))
+
+    def copy(self):
+        return copy.deepcopy(self)
+
+    def override(self, other):
+        """Per-location policy: other's directives replace ours, the rest is kept"""
+        result = self.copy()
+        for directive, sources in other.directives.items():
+            result.set(directive, sources)
+        return result
+
+    def merge(self, other):
+        """Union of both policies' sources, directive by directive"""
+        result = self.copy()
+        for directive, sources in other.directives.items():
+            result.add(directive, sources)
+        return result
+
+    def _drop(self, directive, sources, keep, reason):
+        kept = []
+        for source in sources:
+            if keep(source):
+                kept.append(source)
+            else:
+                self.dropped.append((directive, source, reason))
+        return kept
+
+    def _optimize(self, directive, sources):
+        if "'none'" in sources and len(sources) > 1:
+            sources = self._drop(directive, sources, lambda s: s != "'none'",
+                                 "ignored next to other sources")
+        if directive in INLINE_DIRECTIVES and "'unsafe-inline'" in sources \
+                and "'strict-dynamic'" not in sources:
+            sources = self._drop(directive, sources,
+                                 lambda s: source_kind(s) not in ('hash', 'nonce')
+                                 and s != "'unsafe-hashes'",
+                                 "redundant with 'unsafe-inline'")
+        if '*' in sources:
+            sources = self._drop(directive, sources, lambda s: source_kind(s) != 'host',
+                                 "covered by '*'")
+        schemes = {s for s in sources if source_kind(s) == 'scheme'}
+        if schemes:
+            sources = self._drop(directive, sources,
+                                 lambda s: source_kind(s) != 'host'
+                                 or s.split('//', 1)[0] not in schemes,
+                                 "covered by its scheme source")
+        return sources
+
+    @staticmethod
+    def _source_order(source):
+        kind = source_kind(source)
+        if kind == 'keyword':
+            rank = KEYWORD_ORDER.index(source) if source in KEYWORD_ORDER else len(KEYWORD_ORDER)
+            return (0, rank, 0)
+        # Hashes sort among themselves, everything else keeps its order
+        return ({'wildcard': 1, 'scheme': 2, 'host': 3, 'nonce': 4, 'hash': 5}[kind],
+                0, source if kind == 'hash' else 0)
+
+    def compile(self):
+        """Optimized copy in canonical order; what was removed is in .dropped"""
+        result = CSPPolicy()
+        ranked = {name: i for i, name in enumerate(DIRECTIVE_ORDER)}
+        names = sorted(self.directives,
+                       key=lambda d: (d in REPORT_DIRECTIVES, ranked.get(d, len(ranked))))
+        for directive in names:
+            sources = result._optimize(directive, self.directives[directive])
+            result.directives[directive] = sorted(sources, key=self._source_order)
+
+        default = result.directives.get('default-src')
+        if default is not None:
+            for directive in DEFAULT_SRC_FALLBACK:
+                if result.directives.get(directive) == default:
+                    del result.directives[directive]
+                    result.dropped.append((directive, None, "same as default-src"))
+        return result
+
+    def serialize(self, tail=""):
+        """Header value; tail is appended verbatim (e.g. an nginx variable holding
+        "; report-uri ...")"""
+        parts = [' '.join([directive] + sources) for directive, sources in self.directives.items()]
+        return '; '.join(parts) + tail
+
+    def __str__(self):
+        return self.serialize()
@@ -0,0 +1,111 @@
+#!/bin/bash
+
+#
+# usage: test-csp-forwarding.sh [central port] [edge port]
+#
+# Runs catch-CSP-reports.py twice on this host, a central collector and an
+# edge forwarding to it, and checks the edge-to-central path:
+#   1. a report posted to the edge shows up in the central JSON-lines file
+#   2. a report posted while the central collector is down is spooled by the
+#      edge and delivered once the central collector is back
+#   3. the central collector rejects batches without the token and batches
+#      that inflate beyond its limit
+#
+# Needs python3 with flask and curl. Exits non-zero on the first failure.
+#
+
+CENTRAL_PORT=${1:-7780}
+EDGE_PORT=${2:-7781}
+TOKEN=test-$$
+HERE=$(cd "$(dirname "$0")" && pwd)
+COLLECTOR="python3 ${HERE}/catch-CSP-reports.py"
+WORK=$(mktemp -d /tmp/csp-forwarding.XXXXXX)
+CENTRAL_PID=
+EDGE_PID=
+
+function cleanup {
+    [ -n "${EDGE_PID}" ] && kill ${EDGE_PID} 2>/dev/null
+    [ -n "${CENTRAL_PID}" ] && kill ${CENTRAL_PID} 2>/dev/null
+    wait 2>/dev/null
+    rm -rf "${WORK}"
+}
+trap cleanup EXIT
+
+function fail {
+    echo "FAIL: $1"
+    echo "--- central log"; cat "${WORK}/central.log" 2>/dev/null
+    echo "--- edge log"; cat "${WORK}/edge.log" 2>/dev/null
+    exit 1
+}
+
+function wait_port {
+    for i in $(seq 1 50); do
+        curl -s -o /dev/null "http://127.0.0.1:$1/" && return 0
+        sleep 0.2
+    done
+    fail "nothing listening on port $1"
+}
+
+function start_central {
+    ${COLLECTOR} --port ${CENTRAL_PORT} --jsonl "${WORK}/central.jsonl" --no-syslog \
+        --batch-token ${TOKEN} --csp-config "${WORK}/none.conf" >>"${WORK}/central.log" 2>&1 &
+    CENTRAL_PID=$!
+    wait_port ${CENTRAL_PORT}
+}
+
+function stop_central {
+    kill ${CENTRAL_PID}
+    wait ${CENTRAL_PID} 2>/dev/null
+    CENTRAL_PID=
+}
+
+function post_report {
+    curl -s -o /dev/null -w '%{http_code}' -H 'Content-Type: application/csp-report' \
+        --data "{\"csp-report\": {\"document-uri\": \"https://mail.example.com/$1\", \"violated-directive\": \"script-src-elem\", \"blocked-uri\": \"https://evil.example.com/$1.js\"}}" \
+        "http://127.0.0.1:${EDGE_PORT}/csp-violation"
+}
+
+# Wait until the central JSON-lines file has a record for $1
+function wait_record {
+    for i in $(seq 1 $2); do
+        grep -qs "evil.example.com/$1.js" "${WORK}"/central.jsonl* && return 0
+        sleep 1
+    done
+    return 1
+}
+
+start_central
+${COLLECTOR} --port ${EDGE_PORT} --forward "http://127.0.0.1:${CENTRAL_PORT}/csp-batch" \
+    --spool "${WORK}/spool" --batch-interval 0.5 --batch-token ${TOKEN} \
+    --csp-config "${WORK}/none.conf" --no-syslog >>"${WORK}/edge.log" 2>&1 &
+EDGE_PID=$!
+wait_port ${EDGE_PORT}
+
+[ "$(post_report first)" = "204" ] || fail "edge did not accept the report"
+wait_record first 10 || fail "report did not reach the central collector"
+grep -s "evil.example.com/first.js" "${WORK}"/central.jsonl* | grep -q '"node"' \
+    || fail "forwarded record carries no node"
+echo "✓ edge -> central delivery"
+
+stop_central
+[ "$(post_report spooled)" = "204" ] || fail "edge did not accept the report"
+for i in $(seq 1 20); do
+    [ -n "$(ls -A "${WORK}/spool" 2>/dev/null)" ] && break
+    sleep 0.5
+done
+[ -n "$(ls -A "${WORK}/spool" 2>/dev/null)" ] || fail "edge did not spool the batch"
+start_central
+wait_record spooled 40 || fail "spooled batch was not replayed"
+echo "✓ spool and replay after a central outage"
+
+code=$(printf '{"report": {}}\n' | gzip | curl -s -o /dev/null -w '%{http_code}' \
+    -H 'Content-Encoding: gzip' -H 'X-CSP-Token: wrong' --data-binary @- \
+    "http://127.0.0.1:${CENTRAL_PORT}/csp-batch")
+[ "${code}" = "403" ] || fail "batch with a wrong token got ${code}, expected 403"
+code=$(head -c 64000000 /dev/zero | gzip | curl -s -o /dev/null -w '%{http_code}' \
+    -H 'Content-Encoding: gzip' -H "X-CSP-Token: ${TOKEN}" --data-binary @- \
+    "http://127.0.0.1:${CENTRAL_PORT}/csp-batch")
+[ "${code}" = "413" ] || fail "oversized batch got ${code}, expected 413"
+echo "✓ central rejects bad tokens and oversized batches"
+
+exit 0
@@ -0,0 +1,78 @@
+#!/usr/bin/python3
+#
+# test-csp-spikes.py
+#
+# Replays synthetic report streams through the SpikeDetector of
+# catch-CSP-reports.py on a simulated clock and checks when it alerts:
+#   1. a never-seen (directive, page) bursting from its first report alerts
+#      on the absolute floor (first-ever violations on a strict page)
+#   2. a key with a slow steady baseline alerts once it bursts
+#   3. a single stray report and the steady baseline itself never alert
+#
+# Needs python3 with flask (catch-CSP-reports.py imports it). Exits non-zero
+# on the first failure.
+#
+
+import importlib.util
+import os
+import sys
+
+spec = importlib.util.spec_from_file_location(
+    'catch_csp_reports', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'catch-CSP-reports.py'))
+collector = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(collector)
+
+PAGE = 'https://mail.example.com/zimbra/h/printcalendar?id=1'
+START = 1_000_000.0
+
+
+def detector(alerts):
+    """SpikeDetector as the collector's defaults build it, recording alerts"""
+    spikes = collector.SpikeDetector(threshold=5.0, min_rate=6.0 / 60.0, cooldown=600)
+    spikes._alert = lambda directive, path, rate, baseline: alerts.append((directive, path))
+    return spikes
+
+
+def first_alert(spikes, times):
+    """Seconds after START of the first report that raised an alert, or None"""
+    for now in times:
+        if spikes.observe('script-src', PAGE, now=now):
+            return now - START
+    return None
+
+
+def fail(message):
+    print(f"FAIL: {message}")
+    sys.exit(1)
+
+
+# 1. Never seen before, then 2 reports/s for an hour
+alerts = []
+seconds = first_alert(detector(alerts), (START + i * 0.5 for i in range(2 * 3600)))
+if seconds is None:
+    fail('a burst on a never-seen key did not alert')
+if seconds > 60:
+    fail(f'a burst on a never-seen key took {seconds:.0f}s to alert')
+if alerts != [('script-src', '/zimbra/h/printcalendar')]:
+    fail(f'unexpected alerts {alerts}')
+print(f"✓ new key bursting from first sight alerts after {seconds:.1f}s")
+
+# 2. One report every 5 minutes for two hours, then 2 reports/s
+alerts = []
+spikes = detector(alerts)
+steady = [START + i * 300 for i in range(24)]
+if first_alert(spikes, steady) is not None:
+    fail('a steady key at 1 report per 5 minutes alerted')
+burst_start = steady[-1] + 300
+seconds = first_alert(spikes, (burst_start + i * 0.5 for i in range(600)))
+if seconds is None:
+    fail('a burst on a key with a baseline did not alert')
+print(f"✓ key with a baseline alerts {seconds - (burst_start - START):.1f}s into a burst")
+
+# 3. A single stray report on a new key
+alerts = []
+if detector(alerts).observe('script-src', PAGE, now=START):
+    fail('a single report on a new key alerted')
+print("✓ a single report on a new key does not alert")
+
+sys.exit(0)
@@ -56,6 +56,7 @@ import base64
 import sys
 import argparse
 from bs4 import BeautifulSoup
+from csp_policy import CSPPolicy
 
 def generate_csp_hashes_from_html(directory):
     if not os.path.exists(directory):
@@ -189,16 +190,13 @@ def write_nginx_csp_config(hashes, output_file, report_uri=None):
     #     print(f"Error: No write permission to {output_dir}", file=sys.stderr)
     #     sys.exit(1)
     
-    # Build the CSP policy
-    csp_policy = "script-src 'self'"
-    for h in hashes:
-        csp_policy += f" {h}"
+    # Build the CSP policy (canonical form, duplicate hashes removed)
+    policy = CSPPolicy().add('script-src', "'self'", hashes)
     
     # Add report-uri if specified
     if report_uri:
-        csp_policy += f"; report-uri {report_uri}"
-    else:
-        csp_policy += ";"
+        policy.add('report-uri', report_uri)
+    csp_policy = policy.compile().serialize()
     
     # Calculate policy size
     full_header = f'add_header Content-Security-Policy "{csp_policy}";'
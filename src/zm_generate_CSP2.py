@@ -40,6 +40,7 @@ import base64
 import sys
 import argparse
 from bs4 import BeautifulSoup
+from csp_policy import CSPPolicy
 
 def generate_csp_hashes_from_html(directories):
     all_hashes = set()
@@ -188,29 +189,21 @@ def write_nginx_csp_config(hashes, output_file, report_uri=None, max_line_length
             print(f"Error creating directory {output_dir}: {e}", file=sys.stderr)
             sys.exit(1)
     
-    # Split hashes into chunks that fit reasonable line lengths
-    chunks = []
-    current_chunk = []
-    current_length = len("add_header Content-Security-Policy \"script-src 'self'")
-    
-    for hash_val in hashes:
-        hash_size = len(hash_val) + 1  # +1 for space
-        if current_length + hash_size > max_line_length and current_chunk:
-            chunks.append(current_chunk)
-            current_chunk = []
-            current_length = len("add_header Content-Security-Policy \"script-src")
-        
-        current_chunk.append(hash_val)
-        current_length += hash_size
-    
-    if current_chunk:
-        chunks.append(current_chunk)
+    # Build the CSP policy. 'unsafe-inline' already allows every inline script,
+    # so the compiler drops the hashes: CSP2+ browsers would otherwise ignore
+    # 'unsafe-inline' and block the dynamic JSP scripts the hashes miss.
+    # One header only: browsers enforce every CSP header separately, they do
+    # not merge them.
+    policy = CSPPolicy().add('script-src', "'self'", "'unsafe-inline'", "'unsafe-eval'", hashes)
+    if report_uri:
+        policy.add('report-uri', report_uri)
+    compiled = policy.compile()
+    header = f'add_header Content-Security-Policy "{compiled}";'
     
     try:
         with open(output_file, 'w') as f:
             f.write("# Zimbra Content Security Policy Configuration\n")
-            f.write(f"# Generated with {len(hashes)} script hashes in {len(chunks)} chunks\n")
-            f.write(f"# Each chunk is a separate CSP header (browsers will merge them)\n")
+            f.write(f"# Generated from {len(hashes)} script hashes ({len(compiled.dropped)} redundant with 'unsafe-inline')\n")
             f.write("# NOTE: 'unsafe-inline' and 'unsafe-eval' included for dynamic JSP content\n")
             f.write("# This allows legitimate inline scripts and eval() while still blocking most XSS\n")
             if report_uri:
@@ -221,25 +214,13 @@ def write_nginx_csp_config(hashes, output_file, report_uri=None, max_line_length
             f.write("# client_header_buffer_size 16k;\n")
             f.write("# \n")
             f.write("\n")
-            
-            # Write first chunk with 'self', 'unsafe-inline', 'unsafe-eval', and report-uri
-            if chunks:
-                first_chunk = chunks[0]
-                policy = f"script-src 'self' 'unsafe-inline' 'unsafe-eval' {' '.join(first_chunk)}"
-                if report_uri:
-                    policy += f"; report-uri {report_uri}"
-                policy += ";"
-                f.write(f'add_header Content-Security-Policy "{policy}";\n')
-                
-                # Write additional chunks as script-src only (with unsafe directives)
-                for i, chunk in enumerate(chunks[1:], 2):
-                    policy = f"script-src 'unsafe-inline' 'unsafe-eval' {' '.join(chunk)};"
-                    f.write(f'add_header Content-Security-Policy "{policy}";\n')
+            f.write(header + "\n")
         
-        total_size = sum(len(chunk) * 50 for chunk in chunks)  # rough estimate
         print(f"Successfully wrote nginx CSP config to {output_file}")
-        print(f"Policy contains {len(hashes)} script hashes in {len(chunks)} chunks")
-        print(f"Max line length: ~{max_line_length} characters")
+        print(f"Policy contains {len(compiled.sources('script-src'))} script sources ({len(header)} bytes), "
+              f"{len(compiled.dropped)} redundant hashes dropped")
+        if len(header) > max_line_length:
+            print(f"WARNING: Header line exceeds {max_line_length} characters", file=sys.stderr)
         print("NOTE: 'unsafe-inline' and 'unsafe-eval' included for Zimbra compatibility")
         if report_uri:
             print(f"CSP reporting enabled: {report_uri}")
@@ -22,6 +22,7 @@ Usage Examples:
   ./zm_generate_CSP3.py --init                 # Setup nginx include
   ./zm_generate_CSP3.py                        # Generate and install CSP
   ./zm_generate_CSP3.py --report --dry-run     # Preview with reporting
+  ./zm_generate_CSP3.py --report --report-sample-rate 0.1   # Report from 10% of clients
   ./zm_generate_CSP3.py --uninstall            # Remove CSP protection
 """
 
@@ -29,13 +30,1491 @@ __version__ = "3.1.1"
 __author__ = "Zimbra FOSS Community"
 
 import os
+import posixpath
 import hashlib
 import base64
+import gzip
+import json
+import mmap
 import sys
 import argparse
+import asyncio
+import re
 import shutil
+import ssl
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
+from urllib.parse import urlsplit
 from bs4 import BeautifulSoup
+from csp_policy import CSPPolicy
+
+# File types that can carry inline scripts, and the event handler attributes we hash
+SCAN_EXTENSIONS = ('.html', '.htm', '.jsp', '.jspf', '.tag', '.jspx')
+JSP_EXTENSIONS = ('.jsp', '.jspf', '.tag', '.jspx')
+# Files served as pages (the rest are fragments included by them)
+PAGE_EXTENSIONS = ('.html', '.htm', '.jsp', '.jspx')
+EVENT_HANDLER_ATTRIBUTES = ('onclick', 'onload', 'onerror', 'onsubmit', 'onchange',
+                            'onfocus', 'onblur', 'onmouseover', 'onmouseout', 'onkeydown', 'onkeyup')
+# Bump when scan records change shape so cached records are not reused
+SCAN_FORMAT = 3
+
+CSP_HEADER_NAMES = ('content-security-policy', 'content-security-policy-report-only')
+# Server-side constructs whose output differs from the source text, so the
+# source hash can never match what the browser receives
+JSP_DYNAMIC_PATTERNS = (
+    ('scriptlet', re.compile(r'<%|%>')),
+    ('EL expression', re.compile(r'[$#]\{')),
+    ('JSP tag', re.compile(r'</?[A-Za-z][\w-]*:[A-Za-z]')),
+)
+
+
+def jsp_dynamic(content):
+    """Name of the first JSP construct found in inline content, or None"""
+    for reason, pattern in JSP_DYNAMIC_PATTERNS:
+        if pattern.search(content):
+            return reason
+    return None
+
+
+# JSP references that pull more markup into a page: static includes share the
+# page's translation unit (and its taglib prefixes), <jsp:include> pages and
+# tag files are rendered on their own
+JSP_STATIC_INCLUDE = re.compile(
+    r'<(?:%@\s*include|jsp:directive\.include)\s+file\s*=\s*["\']([^"\']+)["\']')
+JSP_DYNAMIC_INCLUDE = re.compile(r'<jsp:include\s[^>]*?page\s*=\s*["\']([^"\']+)["\']')
+JSP_TAGLIB = re.compile(r'<%@\s*taglib\s([^%]*)%>')
+JSP_TAGLIB_ATTRIBUTE = re.compile(r'(prefix|uri|tagdir)\s*=\s*["\']([^"\']+)["\']')
+JSP_CUSTOM_TAG = re.compile(r'<([A-Za-z][\w-]*):([A-Za-z][\w.-]*)')
+
+
+def jsp_references(content):
+    """Includes, taglib declarations and custom tags used by JSP source
+
+    Returns {'static': [...], 'dynamic': [...], 'taglibs': {prefix: [kind,
+    value]}, 'tags': ['prefix:name', ...]} with kind 'tagdir' or 'uri'.
+    """
+    taglibs = {}
+    for match in JSP_TAGLIB.finditer(content):
+        attributes = dict(JSP_TAGLIB_ATTRIBUTE.findall(match.group(1)))
+        if 'prefix' in attributes:
+            kind = 'tagdir' if 'tagdir' in attributes else 'uri'
+            taglibs[attributes['prefix']] = [kind, attributes.get(kind, '')]
+    tags = {f"{prefix}:{name}" for prefix, name in JSP_CUSTOM_TAG.findall(content)
+            if prefix != 'jsp'}
+    return {'static': sorted(set(JSP_STATIC_INCLUDE.findall(content))),
+            'dynamic': sorted(set(JSP_DYNAMIC_INCLUDE.findall(content))),
+            'taglibs': taglibs, 'tags': sorted(tags)}
+
+
+def csp_hash(content):
+    """CSP source expression ('sha256-...') for an inline script or handler"""
+    hash_obj = hashlib.sha256(content.encode('utf-8'))
+    b64_hash = base64.b64encode(hash_obj.digest()).decode('utf-8')
+    return f"'sha256-{b64_hash}'"
+
+
+def extract_inline(markup, jsp=False):
+    """Extract inline scripts, event handlers and external script sources from markup
+
+    Shared by the file scan and the simulator so both see exactly the same
+    inline content. Positions are the (line, column) reported by html.parser.
+    With jsp=True, items containing scriptlets, EL or JSP tags are marked
+    'dynamic' with the construct found.
+    """
+    soup = BeautifulSoup(markup, 'html.parser')
+    found = {'scripts': [], 'handlers': [], 'sources': []}
+
+    for script in soup.find_all('script'):
+        if script.get('src'):
+            found['sources'].append(script['src'])
+        elif script.string:
+            content = script.string.strip()
+            if content:
+                item = {'hash': csp_hash(content), 'size': len(content.encode('utf-8')),
+                        'line': script.sourceline, 'col': script.sourcepos}
+                if jsp and jsp_dynamic(content):
+                    item['dynamic'] = jsp_dynamic(content)
+                found['scripts'].append(item)
+
+    for tag in soup.find_all():
+        for attr in EVENT_HANDLER_ATTRIBUTES:
+            if tag.get(attr):
+                content = tag[attr].strip()
+                if content:
+                    item = {'attr': attr, 'hash': csp_hash(content), 'size': len(content.encode('utf-8')),
+                            'line': tag.sourceline, 'col': tag.sourcepos}
+                    if jsp and jsp_dynamic(content):
+                        item['dynamic'] = jsp_dynamic(content)
+                    found['handlers'].append(item)
+    return found
+
+
+def scan_file(filepath):
+    """Scan one file (runs in a worker process); errors are returned, not raised"""
+    try:
+        with open(filepath, 'r', encoding='utf-8') as f:
+            content = f.read()
+        jsp = filepath.lower().endswith(JSP_EXTENSIONS)
+        record = extract_inline(content, jsp=jsp)
+        if jsp:
+            record['refs'] = jsp_references(content)
+        return record
+    except Exception as e:
+        return {'error': str(e)}
+
+
+def parse_csp_policy(value):
+    """Split a CSP header value into {directive: [sources]} (first occurrence wins)"""
+    return CSPPolicy.parse(value).directives
+
+
+# nginx split_clients only accepts percentages with up to two decimals
+SPLIT_CLIENTS_STEP = 0.0001
+
+
+def split_clients_rate(rate):
+    """rate rounded to the 0.01% steps of split_clients, None when that is 0"""
+    steps = round(rate / SPLIT_CLIENTS_STEP)
+    return round(steps * SPLIT_CLIENTS_STEP, 4) if steps else None
+
+
+def policy_version(policy, report_only=False):
+    """Version tag of a compiled policy: short hash of its canonical form
+
+    The same policy sent as Report-Only gets a different tag, so a canary
+    equal to an enforced scope is still counted on its own.
+    """
+    header = 'content-security-policy-report-only' if report_only else 'content-security-policy'
+    return hashlib.sha256(f"{header}: {policy.serialize()}".encode('utf-8')).hexdigest()[:8]
+
+
+def nginx_tokens(text):
+    """Tokenize nginx configuration: words, quoted strings, '{', '}' and ';'"""
+    for match in re.finditer(r'#[^\n]*|"((?:[^"\\]|\\.)*)"|\'((?:[^\'\\]|\\.)*)\'|([{};])|([^\s{};"\'#]+)', text):
+        if match.group(0).startswith('#'):
+            continue
+        if match.group(3):
+            yield match.group(3)
+        elif match.group(4) is not None:
+            yield match.group(4)
+        else:
+            yield match.group(1) if match.group(1) is not None else match.group(2)
+
+
+class NginxCSPConfig:
+    """The CSP-relevant parts of a generated csp-header.conf (and csp-http.conf)
+
+    Understands top level add_header lines and location blocks (=, ^~, ~, ~*
+    and plain prefixes) with nginx's add_header inheritance: a location with
+    its own add_header lines replaces the server level ones entirely.
+    Variables set by a map block are resolved per URI, whether the map is
+    keyed on $uri or on another map or split_clients variable (the sampled
+    $csp_report_uri_<version> maps of csp-http.conf). A split_clients
+    variable takes its sampled (first non-empty) value, except in
+    header_bytes(), which weighs every outcome by its share; $request_id
+    becomes a fixed placeholder of the same length and any other variable
+    is dropped. A sub_filter that adds nonce= to
+    <script tags is recorded in nonce_injection, and proxy_set_header
+    Accept-Encoding "" (uncompressed upstream responses, which sub_filter
+    needs) in upstream_uncompressed.
+    """
+
+    def __init__(self, text):
+        self.server_headers = []
+        self.locations = []         # (modifier, pattern, headers)
+        self.maps = {}              # variable -> (source variable, default, [(kind, key, value)])
+        self.splits = {}            # split_clients variable -> [(share, value)]
+        self.nonce_injection = False
+        self.upstream_uncompressed = False
+        self._parse(list(nginx_tokens(text)))
+
+    def _parse(self, tokens):
+        stack = []                  # open blocks: None for blocks we ignore
+        statement = []
+        for token in tokens:
+            if token == '{':
+                if statement and statement[0] == 'location':
+                    args = statement[1:]
+                    modifier, pattern = (args[0], args[1]) if len(args) > 1 else ('', args[0])
+                    stack.append(('location', modifier, pattern, []))
+                elif len(statement) == 3 and statement[0] == 'map' and statement[1].startswith('$'):
+                    stack.append(('map', statement[2].lstrip('$'), [], statement[1].lstrip('$')))
+                elif len(statement) == 3 and statement[0] == 'split_clients':
+                    stack.append(('split_clients', statement[2].lstrip('$'), [], []))
+                else:
+                    stack.append(None)
+                statement = []
+            elif token == '}':
+                block = stack.pop() if stack else None
+                if block is not None and block[0] == 'location':
+                    self.locations.append(block[1:])
+                elif block is not None and block[0] == 'split_clients':
+                    shares = []
+                    for key, value in block[2]:
+                        share = max(1.0 - sum(p for p, _ in shares), 0.0) if key == '*' \
+                            else float(key.rstrip('%')) / 100
+                        shares.append((share, value))
+                    self.splits[block[1]] = shares
+                elif block is not None:
+                    default = next((v for k, v in block[2] if k == 'default'), '')
+                    entries = []
+                    for key, value in block[2]:
+                        if key.startswith('~*'):
+                            entries.append(('~*', key[2:], value))
+                        elif key.startswith('~'):
+                            entries.append(('~', key[1:], value))
+                        elif key != 'default':
+                            entries.append(('=', key, value))
+                    self.maps[block[1]] = (block[3], default, entries)
+                statement = []
+            elif token == ';':
+                current = stack[-1] if stack else ('server',)
+                if current is not None and current[0] in ('map', 'split_clients') and len(statement) == 2:
+                    current[2].append((statement[0], statement[1]))
+                elif current is not None and len(statement) >= 3 and statement[0] == 'add_header':
+                    header = (statement[1].lower(), statement[2])
+                    if current[0] == 'server':
+                        self.server_headers.append(header)
+                    elif current[0] == 'location':
+                        current[3].append(header)
+                elif len(statement) >= 3 and statement[0] == 'sub_filter' \
+                        and statement[1].lower().startswith('<script') and 'nonce=' in statement[2]:
+                    self.nonce_injection = True
+                elif len(statement) == 3 and statement[0] == 'proxy_set_header' \
+                        and statement[1].lower() == 'accept-encoding' and not statement[2]:
+                    self.upstream_uncompressed = True
+                statement = []
+            else:
+                statement.append(token)
+
+    def map_value(self, variable, uri, choices=None):
+        """Value of a map variable for uri (its default when the key is unknown)
+
+        choices fixes the outcome of split_clients variables, see resolve().
+        """
+        source, default, entries = self.maps[variable]
+        key = uri if source == 'uri' else self.variable(source, uri, choices)
+        if key is not None:
+            for kind, pattern, value in entries:
+                if kind == '=' and key == pattern:
+                    return value
+            for kind, pattern, value in entries:
+                if kind != '=' and re.search(pattern, key, re.IGNORECASE if kind == '~*' else 0):
+                    return value
+        return default
+
+    def variable(self, name, uri=None, choices=None):
+        """Value of $name for uri, None for variables the config does not set"""
+        if choices and name in choices:
+            return choices[name]
+        if name in self.splits:
+            return next((value for _, value in self.splits[name] if value), '')
+        if name in self.maps:
+            return self.resolve(self.map_value(name, uri, choices), uri, choices)
+        return None
+
+    def resolve(self, value, uri=None, choices=None):
+        """Header value with nginx variables substituted as described above
+
+        choices ({split_clients variable: value}) picks a sampling outcome.
+        """
+        def substitute(match):
+            name = match.group(1)
+            if name == 'request_id':
+                return '0' * 32
+            resolved = self.variable(name, uri, choices)
+            return resolved if resolved is not None else ''
+        return re.sub(r'\$\{?(\w+)\}?', substitute, value)
+
+    def outcomes(self):
+        """[(probability, {split_clients variable: value})] over every sampling outcome"""
+        outcomes = [(1.0, {})]
+        for name, shares in self.splits.items():
+            outcomes = [(probability * share, dict(choices, **{name: value}))
+                        for probability, choices in outcomes for share, value in shares if share > 0]
+        return outcomes
+
+    def expected_bytes(self, headers, uri=None):
+        """Mean bytes the CSP headers among headers add (name, ': ', value, CRLF),
+        each split_clients outcome weighed by its share of clients"""
+        return sum(probability * sum(len(name) + len(self.resolve(value, uri, choices)) + 4
+                                     for name, value in headers if name in CSP_HEADER_NAMES)
+                   for probability, choices in self.outcomes())
+
+    def match(self, uri):
+        """Return (location label, parsed CSP policies) nginx would use for uri"""
+        label, headers = self.select(uri)
+        return label, [(name, parse_csp_policy(value)) for name, value in headers
+                       if name in CSP_HEADER_NAMES]
+
+    def select(self, uri):
+        """Return (location label, resolved add_header list) nginx would use for uri"""
+        label, headers = self._locate(uri)
+        return label, [(name, self.resolve(value, uri)) for name, value in headers]
+
+    def _locate(self, uri):
+        best_prefix = None
+        for modifier, pattern, headers in self.locations:
+            if modifier == '=' and uri == pattern:
+                return self._result(modifier, pattern, headers)
+            if modifier in ('', '^~') and uri.startswith(pattern):
+                if best_prefix is None or len(pattern) > len(best_prefix[1]):
+                    best_prefix = (modifier, pattern, headers)
+        if best_prefix is None or best_prefix[0] != '^~':
+            for modifier, pattern, headers in self.locations:
+                if modifier in ('~', '~*'):
+                    flags = re.IGNORECASE if modifier == '~*' else 0
+                    if re.search(pattern, uri, flags):
+                        return self._result(modifier, pattern, headers)
+        if best_prefix is not None:
+            return self._result(*best_prefix)
+        return 'server', self.server_headers
+
+    def _result(self, modifier, pattern, headers):
+        label = f"location {modifier} {pattern}".replace('  ', ' ')
+        return label, headers if headers else self.server_headers
+
+    def header_bytes(self, uri):
+        """Mean bytes the CSP response headers add for uri, see expected_bytes()"""
+        _, headers = self._locate(uri)
+        return self.expected_bytes(headers, uri)
+
+
+def _script_sources(policy, directive):
+    """Source list governing directive, following the CSP fallback chain"""
+    for name in (directive, 'script-src', 'default-src'):
+        if name in policy:
+            return policy[name]
+    return None
+
+
+def inline_allowed(sources, content_hash, handler=False, nonced=False):
+    """Would this source list allow an inline script (or event handler) with this hash?
+
+    nonced means the script tag carries the policy's nonce (injected by
+    sub_filter); handlers can never be allowed by a nonce.
+    """
+    if sources is None:
+        return True
+    lowered = [s.lower() for s in sources]
+    if nonced and not handler and any(s.startswith("'nonce-") for s in lowered):
+        return True
+    hashed = any(s.startswith(("'sha256-", "'sha384-", "'sha512-")) for s in lowered)
+    if hashed and content_hash in sources and (not handler or "'unsafe-hashes'" in lowered):
+        return True
+    # 'unsafe-inline' is ignored once a hash, nonce or 'strict-dynamic' is present
+    if "'unsafe-inline'" in lowered and not hashed and "'strict-dynamic'" not in lowered \
+            and not any(s.startswith("'nonce-") for s in lowered):
+        return True
+    return False
+
+
+def source_allowed(sources, src):
+    """Would this source list allow loading an external script from src?"""
+    if sources is None:
+        return True
+    lowered = [s.lower() for s in sources]
+    if "'strict-dynamic'" in lowered:
+        return False                 # only nonce/hash trusted parser-inserted scripts load
+    if '*' in lowered:
+        return True
+    # Relative and JSP generated URLs (${...}, <c:url>) are served by Zimbra itself
+    if '://' not in src and not src.startswith('//') and not re.match(r'^[a-z][a-z0-9+.-]*:', src, re.I):
+        return "'self'" in lowered
+    scheme = src.split(':', 1)[0].lower() + ':' if not src.startswith('//') else 'https:'
+    host = re.sub(r'^(?:[a-z][a-z0-9+.-]*:)?//', '', src, flags=re.I).split('/', 1)[0].lower()
+    for source in lowered:
+        if source == scheme:
+            return True
+        pattern = re.sub(r'^[a-z][a-z0-9+.-]*://', '', source).split('/', 1)[0]
+        if pattern.startswith('*.') and host.endswith(pattern[1:]):
+            return True
+        if pattern and host == pattern:
+            return True
+    return False
+
+
+def _item_line(item):
+    """Line of an inline item, prefixed with its file when it comes from an include"""
+    return f"{item['file']}:{item['line']}" if item.get('file') else item['line']
+
+
+def evaluate_page(record, csp_headers, nonced=False):
+    """List the inline scripts, handlers and sources csp_headers would block on a page"""
+    findings = []
+    for header, policy in csp_headers:
+        disposition = 'REPORT' if header.endswith('report-only') else 'BLOCK'
+        elem = _script_sources(policy, 'script-src-elem')
+        attr = _script_sources(policy, 'script-src-attr')
+        for script in record.get('scripts', []):
+            if not inline_allowed(elem, script['hash'], nonced=nonced):
+                kind = 'script (dynamic)' if script.get('dynamic') else 'script'
+                findings.append((disposition, kind, _item_line(script), script['hash']))
+        for handler in record.get('handlers', []):
+            if not inline_allowed(attr, handler['hash'], handler=True):
+                kind = f"{handler['attr']} (dynamic)" if handler.get('dynamic') else handler['attr']
+                findings.append((disposition, kind, _item_line(handler), handler['hash']))
+        for src in record.get('sources', []):
+            if not source_allowed(elem, src):
+                findings.append((disposition, 'src', None, src))
+    return findings
+
+
+# Zimbra nginx access log: ip:port - - [29/Apr/2019:06:04:23 -0700]  "POST /path HTTP/1.1" 400 567 ...
+ACCESS_LOG_LINE = re.compile(r'\[(\d{1,2}/\w{3}/\d{4}):[^\]]*\]\s+"[A-Z]+ (\S+)')
+# Requests that are never rendered as a document, so a CSP header on them is dead weight
+RESOURCE_EXTENSIONS = ('.js', '.css', '.png', '.gif', '.jpg', '.jpeg', '.svg', '.ico',
+                       '.woff', '.woff2', '.ttf', '.zgz', '.json', '.xml', '.wav', '.map')
+
+
+def open_log(path):
+    """Open a plain or gzipped (rotated) log for line-by-line text reading"""
+    with open(path, 'rb') as f:
+        gzipped = f.read(2) == b'\x1f\x8b'
+    if gzipped:
+        return gzip.open(path, 'rt', encoding='utf-8', errors='replace')
+    return open(path, 'r', encoding='utf-8', errors='replace')
+
+
+class AccessLogAnalyzer:
+    """Streaming per-day/per-location CSP header cost from nginx access logs
+
+    Memory is bounded: URL areas beyond max_areas are folded into '(other)'
+    and the URI -> location cache is reset when it grows past cache_size.
+    """
+
+    def __init__(self, config, area_depth=2, max_areas=2000, cache_size=100000):
+        self.config = config
+        self.area_depth = area_depth
+        self.max_areas = max_areas
+        self.cache_size = cache_size
+        self.cache = {}
+        self.daily = {}          # (day, location) -> [hits, header bytes]
+        self.areas = {}          # (area, location) -> [hits, resource hits]
+        self.area_names = set()
+        self.lines = 0
+        self.skipped = 0
+
+    def area_of(self, path):
+        parts = [p for p in path.split('/') if p][:self.area_depth]
+        area = '/' + '/'.join(parts)
+        if area not in self.area_names:
+            if len(self.area_names) >= self.max_areas:
+                return '(other)'
+            self.area_names.add(area)
+        return area
+
+    def lookup(self, path):
+        cached = self.cache.get(path)
+        if cached is None:
+            if len(self.cache) >= self.cache_size:
+                self.cache.clear()
+            label, _ = self.config.select(path)
+            cached = self.cache[path] = (label, self.config.header_bytes(path))
+        return cached
+
+    def feed(self, path):
+        with open_log(path) as f:
+            for line in f:
+                self.lines += 1
+                match = ACCESS_LOG_LINE.search(line)
+                if not match:
+                    self.skipped += 1
+                    continue
+                day, uri = match.groups()
+                uri_path = uri.split('?', 1)[0]
+                location, header_bytes = self.lookup(uri_path)
+
+                daily = self.daily.setdefault((day, location), [0, 0])
+                daily[0] += 1
+                daily[1] += header_bytes
+
+                area = self.areas.setdefault((self.area_of(uri_path), location), [0, 0])
+                area[0] += 1
+                if uri_path.lower().endswith(RESOURCE_EXTENSIONS) or uri_path.startswith('/service/'):
+                    area[1] += 1
+
+    def days(self):
+        return sorted({day for day, _ in self.daily}, key=lambda d: datetime.strptime(d, '%d/%b/%Y'))
+
+    def scope_wins(self):
+        """Rank (area, change, bytes saved per day) for header-size wins
+
+        Two kinds of win: dropping the header on non-document requests
+        (scripts, images, SOAP) and moving an area to another configured
+        scope whose headers are shorter.
+        """
+        days = max(len(self.days()), 1)
+        scopes = {'server': self.config.server_headers}
+        for modifier, pattern, headers in self.config.locations:
+            scopes[f"location {modifier} {pattern}".replace('  ', ' ')] = headers or self.config.server_headers
+        sizes = {label: self.config.expected_bytes(headers) for label, headers in scopes.items()}
+        scopes = {label: [(n, self.config.resolve(v)) for n, v in headers] for label, headers in scopes.items()}
+        strict = {label: not any("'unsafe-inline'" in v for n, v in headers if n == 'content-security-policy')
+                  for label, headers in scopes.items()}
+
+        wins = []
+        for (area, location), (hits, resources) in self.areas.items():
+            current = sizes.get(location, 0)
+            if resources and current:
+                wins.append((area, f"no CSP header on {resources} non-document requests ({location})",
+                             int(resources * current // days)))
+            for label, size in sizes.items():
+                if label != location and size < current:
+                    kind = 'strict' if strict[label] else 'relaxed'
+                    wins.append((area, f"{location} -> {label} ({kind})", int(hits * (current - size) // days)))
+        return sorted(wins, key=lambda w: -w[2])
+
+
+class AsyncHTTPPool:
+    """Small keep-alive HTTP/1.1 client on asyncio streams (no extra dependencies)
+
+    At most max_connections requests run at once; idle connections are
+    reused for later requests to the same server.
+    """
+
+    def __init__(self, base_url, max_connections=4, timeout=15, verify_tls=True, headers=None):
+        parts = urlsplit(base_url)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise ValueError(f"Unsupported crawl URL: {base_url}")
+        self.scheme = parts.scheme
+        self.host = parts.hostname
+        self.port = parts.port or (443 if parts.scheme == 'https' else 80)
+        self.host_header = parts.netloc
+        self.timeout = timeout
+        self.headers = headers or {}
+        self.ssl = None
+        if self.scheme == 'https':
+            self.ssl = ssl.create_default_context()
+            if not verify_tls:
+                self.ssl.check_hostname = False
+                self.ssl.verify_mode = ssl.CERT_NONE
+        self.slots = asyncio.Semaphore(max_connections)
+        self.idle = []
+        self.opened = 0
+
+    async def _connect(self):
+        self.opened += 1
+        return await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port, ssl=self.ssl), self.timeout)
+
+    async def get(self, path, redirects=5):
+        """GET path; returns (status, headers, body bytes) after same-server redirects"""
+        async with self.slots:
+            for _ in range(redirects + 1):
+                status, headers, body = await self._request(path)
+                location = headers.get('location')
+                if status not in (301, 302, 303, 307, 308) or not location:
+                    break
+                target = urlsplit(location)
+                if target.netloc and target.netloc != self.host_header:
+                    break
+                path = target.path or '/'
+                if target.query:
+                    path += '?' + target.query
+            return status, headers, body
+
+    async def _request(self, path):
+        # A reused connection may have been closed by the server; retry once on a fresh one
+        for attempt in range(2):
+            reused = bool(self.idle)
+            reader, writer = self.idle.pop() if reused else await self._connect()
+            try:
+                result, keep_alive = await asyncio.wait_for(self._exchange(reader, writer, path), self.timeout)
+            except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError, ValueError):
+                writer.close()
+                if reused and attempt == 0:
+                    continue
+                raise
+            if keep_alive:
+                self.idle.append((reader, writer))
+            else:
+                writer.close()
+            return result
+
+    async def _exchange(self, reader, writer, path):
+        lines = [f"GET {path} HTTP/1.1", f"Host: {self.host_header}",
+                 "Connection: keep-alive", "Accept-Encoding: identity",
+                 f"User-Agent: zm_generate_CSP3/{__version__}"]
+        lines.extend(f"{name}: {value}" for name, value in self.headers.items())
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        await writer.drain()
+
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionError("connection closed by server")
+        version, status = status_line.decode('latin-1').split(None, 2)[:2]
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readline()
+            body = b''.join(chunks)
+        elif 'content-length' in headers:
+            body = await reader.readexactly(int(headers['content-length']))
+        else:
+            body = await reader.read()
+            keep_alive = False
+        return (int(status), headers, body), keep_alive
+
+    def close(self):
+        while self.idle:
+            self.idle.pop()[1].close()
+
+
+async def crawl_pages(base_url, paths, concurrency=4, verify_tls=True, headers=None):
+    """Fetch rendered pages and extract their inline content; returns {path: record}"""
+    pool = AsyncHTTPPool(base_url, max_connections=concurrency, verify_tls=verify_tls, headers=headers)
+
+    async def fetch(path):
+        try:
+            status, response_headers, body = await pool.get(path)
+        except Exception as e:
+            return path, {'error': f"{type(e).__name__}: {e}"}
+        if status != 200:
+            return path, {'error': f"HTTP {status}"}
+        charset = re.search(r'charset=([\w-]+)', response_headers.get('content-type', ''))
+        try:
+            markup = body.decode(charset.group(1) if charset else 'utf-8', errors='replace')
+        except LookupError:
+            markup = body.decode('utf-8', errors='replace')
+        return path, extract_inline(markup)
+
+    try:
+        results = await asyncio.gather(*(fetch(path) for path in paths))
+    finally:
+        pool.close()
+    return dict(results), pool.opened
+
+
+MANIFEST_HEADER = "# zm_generate_CSP3 inline manifest v1"
+
+
+def manifest_entries(records, root):
+    """Sorted manifest entries (hash, kind, locations) for scan records
+
+    kind is 'script' or 'handler', with '-dynamic' appended for JSP-dynamic
+    items; locations are sorted 'relpath:line:col' strings.
+    """
+    entries = {}
+    for filepath, record in records.items():
+        relpath = os.path.relpath(filepath, root).replace(os.sep, '/')
+        for kind, items in (('script', record['scripts']), ('handler', record['handlers'])):
+            for item in items:
+                key = (item['hash'], kind + '-dynamic' if item.get('dynamic') else kind)
+                entries.setdefault(key, []).append(f"{relpath}:{item['line']}:{item['col']}")
+    return [(h, kind, tuple(sorted(locations))) for (h, kind), locations in sorted(entries.items())]
+
+
+def write_manifest(entries, path, root):
+    with open(path, 'w') as f:
+        f.write(f"{MANIFEST_HEADER}\n# root: {root}\n# entries: {len(entries)}\n")
+        for h, kind, locations in entries:
+            f.write(f"{h}\t{kind}\t{','.join(locations)}\n")
+
+
+def read_manifest(path):
+    """Stream manifest entries from a file written by write_manifest (already sorted)"""
+    with open(path, 'r') as f:
+        first = f.readline().rstrip('\n')
+        if first != MANIFEST_HEADER:
+            raise ValueError(f"{path} is not an inline manifest")
+        for line in f:
+            if line.startswith('#') or not line.strip():
+                continue
+            h, kind, locations = line.rstrip('\n').split('\t')
+            yield h, kind, tuple(locations.split(','))
+
+
+def diff_manifests(old, new):
+    """Merge-join two sorted entry streams in one pass
+
+    Returns (added, removed, moved) lists; moved entries carry both the old
+    and the new locations.
+    """
+    added, removed, moved = [], [], []
+    old_iter, new_iter = iter(old), iter(new)
+    a, b = next(old_iter, None), next(new_iter, None)
+    while a is not None or b is not None:
+        if b is None or (a is not None and a[:2] < b[:2]):
+            removed.append(a)
+            a = next(old_iter, None)
+        elif a is None or b[:2] < a[:2]:
+            added.append(b)
+            b = next(new_iter, None)
+        else:
+            if a[2] != b[2]:
+                moved.append((b[0], b[1], a[2], b[2]))
+            a, b = next(old_iter, None), next(new_iter, None)
+    return added, removed, moved
+
+
+def policy_hashes(entries):
+    """Hashes that would end up in a policy (dynamic items never do)"""
+    return {h for h, kind, _ in entries if not kind.endswith('-dynamic')}
+
+
+class ScanCache:
+    """Content-addressed scan results: identical files are parsed once
+
+    Keys are the sha256 of the file bytes (plus whether JSP rules apply), so
+    files shared by several extracted builds or mailbox images hit the same
+    entry. With a path the cache is loaded from and saved to a JSON file;
+    entries not used by the current run are dropped on save.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.entries = {}
+        self.used = set()
+        self.hits = 0
+        self.misses = 0
+        if path and os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    data = json.load(f)
+                if data.get('format') == SCAN_FORMAT:
+                    self.entries = data.get('entries', {})
+            except Exception as e:
+                print(f"Warning: Ignoring scan cache {path}: {e}", file=sys.stderr)
+
+    @staticmethod
+    def key_for(filepath):
+        with open(filepath, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        return digest + (':jsp' if filepath.lower().endswith(JSP_EXTENSIONS) else '')
+
+    def save(self):
+        if not self.path:
+            return
+        entries = {key: self.entries[key] for key in self.used if key in self.entries}
+        tmp = f"{self.path}.tmp"
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            with open(tmp, 'w') as f:
+                json.dump({'format': SCAN_FORMAT, 'entries': entries}, f, separators=(',', ':'))
+            os.replace(tmp, self.path)
+        except OSError as e:
+            print(f"Warning: Cannot save scan cache {self.path}: {e}", file=sys.stderr)
+
+
+def scan_paths(paths, workers=None, cache=None):
+    """Scan files in a process pool; returns {filepath: record} (errors included)
+
+    With a cache, files are keyed by content first and only content not
+    seen before is sent to the pool.
+    """
+    results = {}
+    if cache is None:
+        todo = list(paths)
+    else:
+        with ThreadPoolExecutor(max_workers=8) as readers:
+            keys = {}
+            for filepath, key in zip(paths, readers.map(_safe_key, paths)):
+                keys[filepath] = key
+        todo, pending = [], set()
+        for filepath in paths:
+            key = keys[filepath]
+            if key is None:
+                todo.append(filepath)
+            elif key not in cache.entries and key not in pending:
+                pending.add(key)
+                todo.append(filepath)
+
+    if todo:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            chunksize = max(1, len(todo) // ((workers or os.cpu_count() or 1) * 4))
+            for filepath, record in zip(todo, pool.map(scan_file, todo, chunksize=chunksize)):
+                results[filepath] = record
+                if cache is not None and keys.get(filepath) and 'error' not in record:
+                    cache.entries[keys[filepath]] = record
+
+    if cache is not None:
+        for filepath in paths:
+            key = keys[filepath]
+            if filepath in results or key is None:
+                cache.misses += 1
+                if key is not None:
+                    cache.used.add(key)
+                continue
+            if key in cache.entries:
+                cache.hits += 1
+                cache.used.add(key)
+                results[filepath] = cache.entries[key]
+    return results
+
+
+def _safe_key(filepath):
+    try:
+        return ScanCache.key_for(filepath)
+    except OSError:
+        return None
+
+
+TLD_URI = re.compile(r'<uri>\s*(.*?)\s*</uri>', re.DOTALL)
+TLD_TAG_FILE = re.compile(r'<tag-file>.*?<name>\s*(.*?)\s*</name>.*?<path>\s*(.*?)\s*</path>.*?</tag-file>',
+                          re.DOTALL)
+
+
+def read_tag_libraries(root):
+    """Tag files declared by the TLDs under root/WEB-INF: {uri: {tag name: relpath}}
+
+    Tags of a TLD that are not listed here are Java tag handlers.
+    """
+    libraries = {}
+    for dirpath, _, filenames in os.walk(os.path.join(root, 'WEB-INF')):
+        for filename in filenames:
+            if not filename.endswith('.tld'):
+                continue
+            try:
+                with open(os.path.join(dirpath, filename), 'r', encoding='utf-8', errors='replace') as f:
+                    text = f.read()
+            except OSError:
+                continue
+            uri = TLD_URI.search(text)
+            if uri:
+                libraries.setdefault(uri.group(1), {}).update(
+                    (name, path.lstrip('/')) for name, path in TLD_TAG_FILE.findall(text))
+    return libraries
+
+
+class ScanIndex:
+    """Scan records of one webapp tree by relative path, kept on disk
+
+    update() only rescans files whose size or mtime changed since the last
+    run, so the index follows a Zimbra upgrade without a full rescan.
+    surface() follows static and dynamic includes and custom tags backed by
+    tag files (tagdir= or a TLD <tag-file>) to total what a page renders.
+    """
+
+    FORMAT = 1
+
+    def __init__(self, path, root=None):
+        """Without a root, the webapp root recorded in the index file is used"""
+        self.path = path
+        self.root = os.path.abspath(root) if root else None
+        self.files = {}             # relpath -> {'stat': [size, mtime_ns], 'record': scan record}
+        self.tag_libraries = {}
+        if path and os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    data = json.load(f)
+                if data.get('format') == self.FORMAT and data.get('scan_format') == SCAN_FORMAT \
+                        and self.root in (None, data.get('root')):
+                    self.root = data.get('root')
+                    self.files = data.get('files', {})
+                    self.tag_libraries = data.get('tag_libraries', {})
+            except Exception as e:
+                print(f"Warning: Ignoring scan index {path}: {e}", file=sys.stderr)
+
+    def relpath(self, filepath):
+        return os.path.relpath(filepath, self.root).replace(os.sep, '/')
+
+    def update(self, filepaths, workers=None, cache=None):
+        """Bring the index in line with filepaths; returns (rescanned, removed)"""
+        current = {}
+        todo = []
+        for filepath in filepaths:
+            try:
+                st = os.stat(filepath)
+            except OSError:
+                continue
+            relpath = self.relpath(filepath)
+            current[relpath] = [st.st_size, st.st_mtime_ns]
+            entry = self.files.get(relpath)
+            if entry is None or entry['stat'] != current[relpath]:
+                todo.append(filepath)
+        removed = [relpath for relpath in self.files if relpath not in current]
+        for relpath in removed:
+            del self.files[relpath]
+        for filepath, record in scan_paths(todo, workers, cache).items():
+            relpath = self.relpath(filepath)
+            if 'error' in record:
+                print(f"Warning: Error reading {filepath}: {record['error']}", file=sys.stderr)
+                self.files.pop(relpath, None)
+            else:
+                self.files[relpath] = {'stat': current[relpath], 'record': record}
+        self.tag_libraries = read_tag_libraries(self.root)
+        return len(todo), len(removed)
+
+    def save(self):
+        if not self.path:
+            return
+        data = {'format': self.FORMAT, 'scan_format': SCAN_FORMAT, 'root': self.root,
+                'updated': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                'tag_libraries': self.tag_libraries, 'files': self.files}
+        tmp = f"{self.path}.tmp"
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            with open(tmp, 'w') as f:
+                json.dump(data, f, separators=(',', ':'))
+            os.replace(tmp, self.path)
+        except OSError as e:
+            print(f"Warning: Cannot save scan index {self.path}: {e}", file=sys.stderr)
+
+    def records(self):
+        """{filepath: scan record} like scan_tree()"""
+        return {os.path.join(self.root, relpath): entry['record'] for relpath, entry in self.files.items()}
+
+    @staticmethod
+    def _target(relpath, target):
+        """Relative path an include refers to, None when computed at runtime"""
+        if '${' in target or '<%' in target:
+            return None
+        target = target.split('?', 1)[0]
+        joined = target.lstrip('/') if target.startswith('/') else \
+            posixpath.join(posixpath.dirname(relpath), target)
+        joined = posixpath.normpath(joined)
+        return None if joined.startswith('../') else joined
+
+    def _tag_file(self, taglib, name):
+        """relpath of the tag file behind prefix:name, '' for a Java tag handler"""
+        kind, value = taglib
+        if kind == 'tagdir':
+            directory = value.strip('/')
+            for extension in ('.tag', '.tagx'):
+                if f"{directory}/{name}{extension}" in self.files:
+                    return f"{directory}/{name}{extension}"
+            return None
+        return self.tag_libraries.get(value, {}).get(name, '')
+
+    def _walk(self, relpath):
+        """Files a page renders and the references that could not be followed
+
+        Returns ([(relpath, scan record)] with the page first, [unresolved]).
+        """
+        reached, unresolved = [], []
+        seen = set()
+        stack = [(relpath, {})]
+        while stack:
+            current, inherited = stack.pop()
+            if current in seen:
+                continue
+            seen.add(current)
+            entry = self.files.get(current)
+            if entry is None:
+                unresolved.append(current)
+                continue
+            record = entry['record']
+            reached.append((current, record))
+            refs = record.get('refs')
+            if not refs:
+                continue
+            taglibs = dict(inherited, **refs['taglibs'])
+            for kind in ('static', 'dynamic'):
+                for target in refs[kind]:
+                    resolved = self._target(current, target)
+                    if resolved is None:
+                        unresolved.append(f"{current}: {target}")
+                    else:
+                        stack.append((resolved, taglibs if kind == 'static' else {}))
+            for tag in refs['tags']:
+                prefix, name = tag.split(':', 1)
+                if prefix not in taglibs:
+                    continue        # markup namespace (svg:, o:) or no taglib in scope
+                tag_file = self._tag_file(taglibs[prefix], name)
+                if tag_file is None:
+                    unresolved.append(f"{current}: <{tag}>")
+                elif tag_file:
+                    stack.append((tag_file, {}))
+        return reached, unresolved
+
+    def surface(self, relpath):
+        """Inline content a page renders, its includes and tag files resolved
+
+        Returns {'scripts', 'dynamic', 'handlers', 'files', 'unresolved'}:
+        counts summed over every file reached, the files themselves, and
+        references that could not be followed (which make the page unknown).
+        """
+        reached, unresolved = self._walk(relpath)
+        totals = {'scripts': 0, 'dynamic': 0, 'handlers': 0, 'files': [], 'unresolved': unresolved}
+        for current, record in reached:
+            totals['files'].append(current)
+            totals['scripts'] += sum(1 for item in record['scripts'] if not item.get('dynamic'))
+            totals['dynamic'] += sum(1 for item in record['scripts'] if item.get('dynamic'))
+            totals['handlers'] += len(record['handlers'])
+        totals['files'].sort()
+        return totals
+
+    def rendered(self, relpath):
+        """One scan record for everything a page renders (the files surface() counts)
+
+        Items from included files and tag files carry their 'file'; the
+        record's 'unresolved' lists what could not be followed.
+        """
+        reached, unresolved = self._walk(relpath)
+        combined = {'scripts': [], 'handlers': [], 'sources': [], 'unresolved': unresolved}
+        for current, record in reached:
+            for kind in ('scripts', 'handlers'):
+                combined[kind].extend(item if current == relpath else dict(item, file=current)
+                                      for item in record[kind])
+            combined['sources'].extend(record['sources'])
+        return combined
+
+
+def merge_url_scopes(pages):
+    """One anchored regex matching exactly the given URL paths
+
+    Paths are merged in a trie of their segments and names sharing an
+    extension are grouped ("^/zimbra/h/(?:a|b)\\.jsp$"). Every page is
+    matched with a trailing $: a directory prefix would also cover URLs
+    that were never scanned (servlet paths, extensionless JSP views, files
+    added later). Returns None for no pages.
+    """
+    trie = {}
+    for path in pages:
+        node = trie
+        segments = path.strip('/').split('/')
+        for segment in segments[:-1]:
+            node = node.setdefault(segment + '/', {})
+        node[segments[-1]] = None
+
+    def group(alternatives):
+        return alternatives[0] if len(alternatives) == 1 else f"(?:{'|'.join(alternatives)})"
+
+    def emit(node):
+        alternatives = []
+        leaves = {}
+        for name in sorted(node):
+            child = node[name]
+            if isinstance(child, dict):
+                alternatives.append(re.escape(name) + group(emit(child)))
+            else:
+                stem, dot, extension = name.rpartition('.')
+                stem, extension = (stem, dot + extension) if dot and stem else (name, '')
+                leaves.setdefault(extension, []).append(re.escape(stem))
+        for extension, stems in sorted(leaves.items()):
+            alternatives.append(group(stems) + re.escape(extension) + '$')
+        return alternatives
+
+    if not trie:
+        return None
+    return '^/' + group(emit(trie))
+
+
+def batch_names(roots):
+    """Short distinct names for webapp roots: the path parts that differ"""
+    if len(roots) == 1:
+        return [os.path.basename(os.path.abspath(roots[0]).rstrip('/')) or 'root']
+    parts = [os.path.abspath(r).strip('/').split('/') for r in roots]
+    prefix = 0
+    while all(len(p) > prefix for p in parts) and len({p[prefix] for p in parts}) == 1:
+        prefix += 1
+    suffix = 0
+    while all(len(p) - suffix > prefix for p in parts) and len({p[-1 - suffix] for p in parts}) == 1:
+        suffix += 1
+    names = ['_'.join(p[prefix:len(p) - suffix]) or 'root' for p in parts]
+    if len(set(names)) != len(names):
+        names = [f"{i + 1}_{name}" for i, name in enumerate(names)]
+    return names
+
+
+# Markup that replaces an externalized inline script: <script src="/js/csp/0123456789ab.js"></script>
+EXTERNAL_SCRIPT_TAG_BYTES = 47
+
+
+def externalization_candidates(records):
+    """Group identical inline bodies across files and rank them for externalization
+
+    Returns (kind, hash, size, pages, saved per page, header bytes) sorted by
+    occurrences x size. A script moved to a cacheable .js file still costs
+    a <script src> tag per page; a handler moved into an external listener
+    takes its whole attribute out of the markup. Removing the body from
+    the page also removes its hash from a hash-based policy.
+    """
+    groups = {}
+    for filepath, record in records.items():
+        for kind, items in (('script', record['scripts']), ('handler', record['handlers'])):
+            for item in items:
+                if item.get('dynamic'):
+                    continue
+                label = kind if kind == 'script' else item['attr']
+                group = groups.setdefault((label, item['hash']), [item.get('size', 0), set()])
+                group[1].add(filepath)
+
+    candidates = []
+    for (label, content_hash), (size, pages) in groups.items():
+        if label == 'script':
+            saved = size - EXTERNAL_SCRIPT_TAG_BYTES
+        else:
+            saved = size + len(label) + 4         # ' onclick=""'
+        candidates.append((label, content_hash, size, len(pages), saved, len(content_hash) + 1))
+    return sorted(candidates, key=lambda c: (-c[3] * c[2], c[1]))
+
+
+SRI_EXTENSIONS = ('.js', '.css')
+SRI_ALGORITHMS = ('sha256', 'sha384', 'sha512')
+
+
+def sri_digest(filepath, algorithms=('sha384',), chunk_size=1024 * 1024):
+    """Subresource Integrity values ('sha384-...') for a file
+
+    Large files are hashed through mmap, small ones with one read, so memory
+    stays flat on multi-megabyte bundles. hashlib releases the GIL, so this
+    parallelizes well in threads.
+    """
+    hashers = [hashlib.new(name) for name in algorithms]
+    with open(filepath, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size > chunk_size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                for offset in range(0, size, chunk_size):
+                    block = data[offset:offset + chunk_size]
+                    for hasher in hashers:
+                        hasher.update(block)
+        else:
+            block = f.read()
+            for hasher in hashers:
+                hasher.update(block)
+    return {name: f"{name}-{base64.b64encode(h.digest()).decode('ascii')}"
+            for name, h in zip(algorithms, hashers)}
+
+
+def file_identity(st):
+    """What must be unchanged for a cached digest to be reused
+
+    mtime can be set back with touch; ctime cannot be set from user space,
+    so an edit whose mtime was restored still changes the identity.
+    """
+    return [st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns]
+
+
+def build_sri_manifest(root, previous=None, algorithms=('sha384',), workers=8, verify=False):
+    """Digest every .js/.css under root; returns (manifest, report)
+
+    Digests from the previous manifest are reused when the file identity
+    (device, inode, size, mtime, ctime) is unchanged, unless verify is set, in
+    which case everything is rehashed. report lists 'added', 'removed',
+    'changed' (content changed) and 'tampered' (content changed although
+    size and mtime were preserved) relative paths.
+    """
+    previous_files = (previous or {}).get('files', {})
+    files = {}
+    todo = []
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            if not filename.lower().endswith(SRI_EXTENSIONS):
+                continue
+            filepath = os.path.join(dirpath, filename)
+            relpath = os.path.relpath(filepath, root).replace(os.sep, '/')
+            try:
+                identity = file_identity(os.stat(filepath))
+            except OSError:
+                continue
+            cached = previous_files.get(relpath)
+            if (not verify and cached and cached.get('identity') == identity
+                    and all(name in cached for name in algorithms)):
+                files[relpath] = cached
+            else:
+                files[relpath] = {'identity': identity}
+                todo.append((relpath, filepath))
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for (relpath, filepath), digests in zip(todo, pool.map(
+                lambda item: _safe_sri_digest(item[1], algorithms), todo)):
+            if digests is None:
+                del files[relpath]
+            else:
+                files[relpath].update(digests)
+
+    report = {'added': [], 'removed': [], 'changed': [], 'tampered': [], 'hashed': len(todo)}
+    for relpath in sorted(set(previous_files) | set(files)):
+        old, new = previous_files.get(relpath), files.get(relpath)
+        if old is None:
+            report['added'].append(relpath)
+        elif new is None:
+            report['removed'].append(relpath)
+        else:
+            common = [name for name in algorithms if name in old]
+            if any(old[name] != new[name] for name in common):
+                same_stat = old.get('identity', [None] * 4)[2:4] == new['identity'][2:4]
+                report['tampered' if same_stat else 'changed'].append(relpath)
+
+    manifest = {'version': 1, 'root': root, 'algorithms': list(algorithms),
+                'generated': datetime.now().strftime('%Y-%m-%d %H:%M:%S'), 'files': files}
+    return manifest, report
+
+
+def _safe_sri_digest(filepath, algorithms):
+    try:
+        return sri_digest(filepath, algorithms)
+    except OSError as e:
+        print(f"Warning: Error reading {filepath}: {e}", file=sys.stderr)
+        return None
+
+
+# Zimbra proxy templates that get a CSP include, and the block it goes into:
+# every server{} of the vhost templates, the http{} block of the main one
+CSP_TEMPLATES = (
+    ('nginx.conf.web.https.template', 'server'),
+    ('nginx.conf.web.https.default.template', 'server'),
+    ('nginx.conf.web.http.template', 'server'),
+    ('nginx.conf.web.http.default.template', 'server'),
+    ('nginx.conf.web.admin.template', 'server'),
+    ('nginx.conf.web.admin.default.template', 'server'),
+    ('nginx.conf.web.template', 'http'),
+)
+
+# Where the include goes inside a block: after the mail mode include of a
+# server{} (the historical spot), before the vhost includes of http{}
+TEMPLATE_ANCHORS = {
+    'server': (r'^\s*include\s+\$\{core\.includes\}/\$\{core\.cprefix\}\.web\.\S*mode-', 'after'),
+    'http': (r'^\s*include\s+\$\{core\.includes\}/\$\{core\.cprefix\}\.web\.http', 'before'),
+}
+
+
+# Asks the upstream (Jetty) for an identity-encoded response; sub_filter can
+# only rewrite uncompressed bodies
+ACCEPT_ENCODING_CLEARED = re.compile(r'^\s*proxy_set_header\s+Accept-Encoding\s+(?:""|\'\')\s*;', re.I)
+
+
+def atomic_write(path, content):
+    """Replace path with content via a temporary file, keeping mode and owner"""
+    tmp = f"{path}.tmp"
+    with open(tmp, 'w') as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    if os.path.exists(path):
+        shutil.copystat(path, tmp)
+        st = os.stat(path)
+        try:
+            os.chown(tmp, st.st_uid, st.st_gid)
+        except OSError:
+            pass
+    os.replace(tmp, path)
+
+
+class NginxTemplate:
+    """A Zimbra nginx template parsed into nested blocks
+
+    Line based: Zimbra's ${var} and !{explode ...} expressions are removed
+    before counting braces, and a block may open on the line after its
+    name ("server" / "{"). Each block is a dict with name, start (line of
+    the opening brace), end (line of the closing brace), depth and parent.
+    """
+
+    expression = re.compile(r'[$!]\{[^}]*\}')
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'r') as f:
+            self.text = f.read()
+        self.lines = self.text.split('\n')
+        self.blocks = []
+        self.balanced = self._parse()
+
+    def _parse(self):
+        stack = []
+        statement = ''
+        for number, line in enumerate(self.lines):
+            code = self.expression.sub('', line.split('#', 1)[0])
+            for char in code:
+                if char == '{':
+                    words = statement.split()
+                    block = {'name': words[0] if words else '', 'start': number, 'end': None,
+                             'depth': len(stack), 'parent': stack[-1] if stack else None}
+                    self.blocks.append(block)
+                    stack.append(block)
+                    statement = ''
+                elif char == '}':
+                    if not stack:
+                        return False
+                    stack.pop()['end'] = number
+                    statement = ''
+                elif char == ';':
+                    statement = ''
+                else:
+                    statement += char
+            statement += ' '
+        return not stack
+
+    def contexts(self, context):
+        """Outermost blocks of the given kind (server blocks inside http{} included)"""
+        return [b for b in self.blocks if b['name'] == context and b['end'] is not None
+                and not any(a['name'] == context for a in self._ancestors(b))]
+
+    def _ancestors(self, block):
+        while block['parent'] is not None:
+            block = block['parent']
+            yield block
+
+    def own_lines(self, block):
+        """Line numbers directly inside block (not inside its child blocks)"""
+        children = [b for b in self.blocks if b['parent'] is block]
+        for number in range(block['start'] + 1, block['end']):
+            if not any(c['start'] <= number <= c['end'] for c in children):
+                yield number
+
+    def insertion_point(self, block, context):
+        """(line index to insert before, indentation) for a new directive in block"""
+        own = list(self.own_lines(block))
+        directives = [n for n in own if self.lines[n].strip() and not self.lines[n].strip().startswith('#')]
+        indent = re.match(r'\s*', self.lines[directives[0]]).group(0) if directives else '    '
+        pattern, where = TEMPLATE_ANCHORS[context]
+        anchor = next((n for n in own if re.match(pattern, self.lines[n])), None)
+        if anchor is not None:
+            return (anchor + 1 if where == 'after' else anchor), indent
+        # Otherwise ahead of the first nested block (location{} etc.) or at the end
+        children = [b['start'] for b in self.blocks if b['parent'] is block]
+        if children:
+            first = min(children)
+            # Back up to the line holding the child's name when "{" is on its own line
+            while first > block['start'] + 1 and self.lines[first].strip() == '{':
+                first -= 1
+            return first, indent
+        return block['end'], indent
+
+
+class TemplateManager:
+    """Adds or removes the CSP includes in every Zimbra proxy template in one pass
+
+    Templates missing from the directory are skipped. Each file is parsed
+    once, all its edits are applied in memory and it is replaced
+    atomically (after a timestamped backup). verify() re-reads the files
+    and checks that each target block holds the include exactly once.
+    """
+
+    def __init__(self, directory, includes, comment, templates=CSP_TEMPLATES, extra=()):
+        self.directory = directory
+        self.includes = includes            # context -> include file path
+        self.comment = comment.strip()
+        self.templates = list(templates)
+        names = {name for name, _ in self.templates}
+        for path in extra:
+            if os.path.dirname(path) == directory and os.path.basename(path) not in names:
+                self.templates.insert(0, (os.path.basename(path), 'server'))
+
+    def include_line(self, context):
+        return f"include {self.includes[context]};"
+
+    def _is_include(self, line, context=None):
+        """Any include of one of our files (csp-header.conf, csp-http.conf)"""
+        contexts = [context] if context else list(self.includes)
+        return any(re.match(rf'^\s*include\s+\S*{re.escape(os.path.basename(self.includes[c]))}\s*;\s*$', line)
+                   for c in contexts)
+
+    def paths(self):
+        for name, context in self.templates:
+            path = os.path.join(self.directory, name)
+            if os.path.exists(path):
+                yield path, context
+
+    def install(self, dry_run=False):
+        return self._apply(self._install_edits, dry_run)
+
+    def remove(self, dry_run=False):
+        return self._apply(self._remove_edits, dry_run)
+
+    def _install_edits(self, template, context):
+        """(inserts {line index: [lines]}, deletes set(), problem or None)"""
+        blocks = template.contexts(context)
+        if not blocks:
+            if context == 'http':
+                # Template already included inside http{}: use the top level vhost includes
+                pattern, _ = TEMPLATE_ANCHORS['http']
+                top = [n for n, line in enumerate(template.lines)
+                       if re.match(pattern, line)
+                       and not any(b['start'] < n < b['end'] for b in template.blocks if b['end'] is not None)]
+                if top:
+                    if any(self._is_include(line, context) for line in template.lines):
+                        return {}, set(), None
+                    indent = re.match(r'\s*', template.lines[top[0]]).group(0)
+                    return {top[0]: [indent + self.comment, indent + self.include_line(context)]}, set(), None
+            return {}, set(), f"no {context}{{}} block"
+        inserts = {}
+        for block in blocks:
+            if any(self._is_include(template.lines[n], context) for n in template.own_lines(block)):
+                continue
+            index, indent = template.insertion_point(block, context)
+            inserts.setdefault(index, []).extend([indent + self.comment, indent + self.include_line(context)])
+        return inserts, set(), None
+
+    def _remove_edits(self, template, context):
+        deletes = set()
+        for n, line in enumerate(template.lines):
+            if self._is_include(line):
+                deletes.add(n)
+                if n > 0 and template.lines[n - 1].strip() == self.comment:
+                    deletes.add(n - 1)
+        return {}, deletes, None
+
+    def _apply(self, planner, dry_run):
+        """Plan and write all templates; returns [(path, action, detail)]"""
+        results = []
+        stamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        for path, context in self.paths():
+            try:
+                template = NginxTemplate(path)
+            except OSError as e:
+                results.append((path, 'error', f"cannot read: {e}"))
+                continue
+            if not template.balanced:
+                results.append((path, 'error', "unbalanced braces, not touched"))
+                continue
+            inserts, deletes, problem = planner(template, context)
+            if problem:
+                results.append((path, 'error', problem))
+                continue
+            if not inserts and not deletes:
+                results.append((path, 'unchanged', ''))
+                continue
+            lines = []
+            for n, line in enumerate(template.lines + ['']):
+                lines.extend(inserts.get(n, []))
+                if n < len(template.lines) and n not in deletes:
+                    lines.append(line)
+            added = sum(len(v) for v in inserts.values()) // 2
+            detail = f"+{added} include(s)" if inserts else f"-{len(deletes)} line(s)"
+            if dry_run:
+                results.append((path, 'would change', detail))
+                continue
+            try:
+                shutil.copy2(path, f"{path}.backup.{stamp}")
+                atomic_write(path, '\n'.join(lines))
+                results.append((path, 'changed', detail))
+            except OSError as e:
+                results.append((path, 'error', f"cannot write: {e}"))
+        return results
+
+    def verify(self, installed=True):
+        """[(path, context, blocks, blocks with the include, ok)] for the present templates"""
+        report = []
+        for path, context in self.paths():
+            try:
+                template = NginxTemplate(path)
+            except OSError:
+                report.append((path, context, 0, 0, False))
+                continue
+            blocks = template.contexts(context)
+            if blocks:
+                counts = [sum(1 for n in template.own_lines(b) if self._is_include(template.lines[n], context))
+                          for b in blocks]
+            else:
+                # http-level template without its own http{} block
+                counts = [sum(1 for line in template.lines if self._is_include(line, context))]
+            with_include = sum(1 for c in counts if c)
+            if installed:
+                ok = template.balanced and all(c == 1 for c in counts)
+            else:
+                ok = template.balanced and not any(self._is_include(line) for line in template.lines)
+            report.append((path, context, len(counts), with_include, ok))
+        return report
+
 
 class ZimbraCSPGenerator:
     def __init__(self):
@@ -43,8 +1522,21 @@ class ZimbraCSPGenerator:
         self.csp_include_line = '    include /opt/zimbra/conf/nginx/includes/csp-header.conf;'
         self.csp_comment = '    # CSP Security Header'
         self.output_file = '/opt/zimbra/conf/nginx/includes/csp-header.conf'
-        self.target_line = '    include                 ${core.includes}/${core.cprefix}.web.https.mode-${web.mailmode};'
+
+        # http{} level include for split_clients/map blocks (not allowed inside server{})
+        self.http_template_file = '/opt/zimbra/conf/nginx/templates/nginx.conf.web.template'
+        self.http_output_file = '/opt/zimbra/conf/nginx/includes/csp-http.conf'
+        self.http_include_line = '    include /opt/zimbra/conf/nginx/includes/csp-http.conf;'
+        # Persistent per-file scan results (--scan-index, --infer-strict)
+        self.scan_index_file = '/opt/zimbra/conf/nginx/includes/csp-scan-index.json'
         
+        # Zimbra webapp served at url_prefix (matches the strict location regex)
+        self.webapp_root = '/opt/zimbra/jetty_base/webapps/zimbra'
+        self.url_prefix = '/zimbra'
+
+        # Rendered pages fetched by --crawl (login, classic, mobile and modern UI)
+        self.crawl_paths = ['/', f'{self.url_prefix}/h/', f'{self.url_prefix}/m/', '/modern/']
+
         # Zimbra directories to scan for inline scripts
         self.scan_directories = [
             '/opt/zimbra/jetty_base/webapps/zimbra/public',
@@ -57,60 +1549,259 @@ class ZimbraCSPGenerator:
             '/opt/zimbra/jetty_base/webapps/zimbra/modern'
         ]
 
-    def generate_hashes(self):
-        """Scan Zimbra files and generate CSP hashes for inline scripts"""
-        all_hashes = set()
-        total_processed = 0
-        
+    def set_output(self, output_file):
+        """Write the policy (and csp-http.conf next to it) somewhere else"""
+        self.output_file = os.path.abspath(output_file)
+        self.csp_include_line = f'    include {self.output_file};'
+        self.http_output_file = os.path.join(os.path.dirname(self.output_file), 'csp-http.conf')
+        self.http_include_line = f'    include {self.http_output_file};'
+        self.scan_index_file = os.path.join(os.path.dirname(self.output_file), 'csp-scan-index.json')
+
+    def set_template(self, template_file):
+        """Patch another https template (nginx.conf.web.template is taken from its directory)"""
+        self.template_file = os.path.abspath(template_file)
+        self.http_template_file = os.path.join(os.path.dirname(self.template_file),
+                                               'nginx.conf.web.template')
+
+    def set_webapp_root(self, root):
+        """Scan an extracted webapp tree at root instead of the live install"""
+        root = os.path.abspath(root)
+        self.scan_directories = [os.path.join(root, os.path.relpath(d, self.webapp_root))
+                                 for d in self.scan_directories]
+        self.webapp_root = root
+
+    def find_scan_files(self):
+        """List (scan directory, file) pairs for every file that may carry inline scripts"""
+        found = []
         for directory in self.scan_directories:
             if not os.path.exists(directory):
                 continue
-            
-            processed_files = 0
             for root, _, files in os.walk(directory):
                 for filename in files:
-                    if filename.lower().endswith(('.html', '.htm', '.jsp', '.jspf', '.tag', '.jspx')):
-                        filepath = os.path.join(root, filename)
-                        try:
-                            with open(filepath, 'r', encoding='utf-8') as f:
-                                soup = BeautifulSoup(f, 'html.parser')
-                                
-                                # Hash inline script content
-                                for script in soup.find_all('script'):
-                                    if script.string and not script.get('src'):
-                                        content = script.string.strip()
-                                        if content:
-                                            hash_obj = hashlib.sha256(content.encode('utf-8'))
-                                            b64_hash = base64.b64encode(hash_obj.digest()).decode('utf-8')
-                                            all_hashes.add(f"'sha256-{b64_hash}'")
-                                
-                                # Hash inline event handlers
-                                for tag in soup.find_all():
-                                    for attr in ['onclick', 'onload', 'onerror', 'onsubmit', 'onchange', 
-                                               'onfocus', 'onblur', 'onmouseover', 'onmouseout', 'onkeydown', 'onkeyup']:
-                                        if tag.get(attr):
-                                            content = tag[attr].strip()
-                                            if content:
-                                                hash_obj = hashlib.sha256(content.encode('utf-8'))
-                                                b64_hash = base64.b64encode(hash_obj.digest()).decode('utf-8')
-                                                all_hashes.add(f"'sha256-{b64_hash}'")
-                                
-                                processed_files += 1
-                        except Exception as e:
-                            print(f"Warning: Error reading {filepath}: {e}", file=sys.stderr)
-                            continue
-            
+                    if filename.lower().endswith(SCAN_EXTENSIONS):
+                        found.append((directory, os.path.join(root, filename)))
+        return found
+
+    def scan_tree(self, workers=None, cache=None):
+        """Scan all Zimbra files in parallel; returns {filepath: scan record}"""
+        scan_files = self.find_scan_files()
+        records = scan_paths([filepath for _, filepath in scan_files], workers, cache)
+        results = {}
+        for filepath, record in records.items():
+            if 'error' in record:
+                print(f"Warning: Error reading {filepath}: {record['error']}", file=sys.stderr)
+            else:
+                results[filepath] = record
+
+        for directory in self.scan_directories:
+            processed_files = sum(1 for d, filepath in scan_files if d == directory and filepath in results)
             if processed_files > 0:
                 print(f"Scanned {processed_files} files in {directory}", file=sys.stderr)
-            total_processed += processed_files
+        return results
+
+    def generate_hashes(self, records=None):
+        """Scan Zimbra files and generate CSP hashes for inline scripts
+
+        JSP-dynamic scripts and handlers are left out: their source hash can
+        never match the rendered output. They are kept in self.dynamic_inline
+        as (filepath, kind, line, reason) for dynamic_report().
+        """
+        all_hashes = set()
+        self.dynamic_inline = []
+        records = self.scan_tree() if records is None else records
+        for filepath in sorted(records):
+            record = records[filepath]
+            for item in record['scripts'] + record['handlers']:
+                if item.get('dynamic'):
+                    self.dynamic_inline.append((filepath, item.get('attr', 'script'),
+                                                item['line'], item['dynamic']))
+                else:
+                    all_hashes.add(item['hash'])
         
-        print(f"Total: {total_processed} files scanned, {len(all_hashes)} unique script hashes found", file=sys.stderr)
+        print(f"Total: {len(records)} files scanned, {len(all_hashes)} unique script hashes found", file=sys.stderr)
+        if self.dynamic_inline:
+            pages = len({entry[0] for entry in self.dynamic_inline})
+            print(f"Excluded {len(self.dynamic_inline)} dynamic JSP scripts/handlers in {pages} files", file=sys.stderr)
         return sorted(all_hashes)
 
-    def generate_csp_config(self, report_uri=None):
-        """Generate the proven CSP configuration (no hashes needed)"""
+    def dynamic_report(self):
+        """Text report of pages whose inline content needs a nonce or location relaxation"""
+        lines = [
+            "# Zimbra CSP - JSP-dynamic inline scripts and handlers",
+            f"# Generated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}",
+            "#",
+            "# These contain scriptlets, EL expressions or JSP tags, so their",
+            "# source hash never matches the rendered page. The pages need a",
+            "# nonce or a location-level relaxation ('unsafe-inline').",
+            ""
+        ]
+        current = None
+        for filepath, kind, line, reason in self.dynamic_inline:
+            if filepath != current:
+                current = filepath
+                url = self.url_for(filepath)
+                lines.append(f"{filepath}" + (f"  ({url})" if url else "  (WEB-INF fragment)"))
+            lines.append(f"    {kind:12} line {line:<6} {reason}")
+        return '\n'.join(lines) + '\n'
+
+    def url_for(self, filepath):
+        """URL path a scanned file is served at, or None for WEB-INF fragments"""
+        relpath = os.path.relpath(filepath, self.webapp_root).replace(os.sep, '/')
+        if relpath.startswith('../') or relpath.split('/', 1)[0] == 'WEB-INF':
+            return None
+        return f"{self.url_prefix}/{relpath}"
+
+    def simulate(self, config_text, index, uncompressed=False):
+        """Evaluate a generated CSP config against every page of a ScanIndex
+
+        Each page is checked with what it renders: its static and dynamic
+        includes and tag files are followed (ScanIndex.rendered()), so a
+        WEB-INF fragment is checked under the policy of every page using it.
+        Scripts only count as nonced when the upstream response is known to
+        be uncompressed (in the config or, with uncompressed, the templates).
+        Returns (pages, fragments, blocked): pages is a list of
+        (url, location, findings, unresolved) for served pages, fragments
+        counts the scanned files that are not pages of their own.
+        """
+        config = NginxCSPConfig(config_text)
+        nonced = config.nonce_injection and (config.upstream_uncompressed or bool(uncompressed))
+        if config.nonce_injection and not nonced:
+            print("WARNING: Nonce sub_filter without proxy_set_header Accept-Encoding \"\": "
+                  "gzipped upstream responses get no nonce, inline scripts are evaluated "
+                  "without one", file=sys.stderr)
+        pages = []
+        fragments = 0
+        blocked = 0
+        for relpath in sorted(index.files):
+            url = self.url_for(os.path.join(index.root, relpath))
+            if url is None or not relpath.lower().endswith(PAGE_EXTENSIONS):
+                fragments += 1
+                continue
+            record = index.rendered(relpath)
+            location, csp_headers = config.match(url)
+            findings = evaluate_page(record, csp_headers, nonced)
+            blocked += sum(1 for f in findings if f[0] == 'BLOCK')
+            pages.append((url, location, findings, record['unresolved']))
+        return pages, fragments, blocked
+
+    def crawl(self, base_url, paths=None, concurrency=4, verify_tls=True, cookie=None):
+        """Fetch rendered pages from a live server and hash their inline scripts
+
+        JSPs emit scripts that a file scan cannot see; the rendered HTML is
+        run through the same extract_inline() as the file scan.
+        """
+        paths = paths or self.crawl_paths
+        headers = {'Cookie': cookie} if cookie else None
+        records, connections = asyncio.run(
+            crawl_pages(base_url, paths, concurrency, verify_tls, headers))
+
+        hashes = set()
+        for path in paths:
+            record = records[path]
+            if 'error' in record:
+                print(f"Warning: Cannot crawl {path}: {record['error']}", file=sys.stderr)
+                continue
+            hashes.update(script['hash'] for script in record['scripts'])
+            print(f"Crawled {path}: {len(record['scripts'])} inline scripts", file=sys.stderr)
+        print(f"Total: {len(paths)} pages over {connections} connections, "
+              f"{len(hashes)} unique script hashes found", file=sys.stderr)
+        return sorted(hashes)
+
+    def scope_policies(self, hashes=None, canary=None):
+        """Compiled policies (no report-uri) by scope: default, strict, nonce, canary"""
+        base = CSPPolicy()
+        base.add('script-src', "'self'", "'unsafe-inline'", "'unsafe-eval'")
+        base.add('object-src', "'none'")
+        base.add('base-uri', "'self'")
+        policies = {
+            'default': base,
+            # Hashes only go into the strict scope: next to 'unsafe-inline' they would
+            # make CSP2+ browsers ignore it and break the default scope
+            'strict': base.override(CSPPolicy().add('script-src', "'self'", "'unsafe-eval'",
+                                                    hashes or [])),
+            # $request_id is 32 hex characters, unique per request
+            'nonce': base.override(CSPPolicy().add('script-src', "'self'", "'nonce-$request_id'",
+                                                   "'unsafe-eval'")),
+        }
+        if canary is not None:
+            policies['canary'] = base.override(canary)
+        return {name: policy.compile() for name, policy in policies.items()}
+
+    def header_value(self, policy, report_uri=None, sample_rate=None, report_only=False):
+        """Header value for a compiled policy, reporting to <report_uri>/<version>"""
+        version = policy_version(policy, report_only)
+        if report_uri and sample_rate is not None:
+            # "; report-uri .../<version>" for sampled clients, see csp-http.conf
+            return policy.serialize(f"$csp_report_uri_{version}")
+        if report_uri:
+            return policy.copy().add('report-uri', f"{report_uri.rstrip('/')}/{version}").serialize()
+        return policy.serialize()
+
+    def infer_strict_scope(self, index, hashes=False):
+        """URL scope that can take the strict policy, from a ScanIndex
+
+        A served page qualifies when nothing it renders (includes and tag
+        files followed) has an inline event handler or a JSP-dynamic script,
+        every reference could be resolved, and it has no inline script at
+        all, or only static ones when their hashes are in the policy.
+        Returns (regex or None, strict urls, {url: reason} for the rest).
+        """
+        strict, kept = [], {}
+        for relpath in sorted(index.files):
+            if not relpath.lower().endswith(PAGE_EXTENSIONS):
+                continue
+            url = self.url_for(os.path.join(index.root, relpath))
+            if url is None:
+                continue
+            surface = index.surface(relpath)
+            if surface['unresolved']:
+                kept[url] = f"unresolved {surface['unresolved'][0]}"
+            elif surface['handlers']:
+                kept[url] = f"{surface['handlers']} event handlers"
+            elif surface['dynamic']:
+                kept[url] = f"{surface['dynamic']} dynamic scripts"
+            elif surface['scripts'] and not hashes:
+                kept[url] = f"{surface['scripts']} inline scripts"
+            else:
+                strict.append(url)
+        return merge_url_scopes(strict), strict, kept
+
+    def nonce_compatibility(self, index):
+        """Split served pages of a ScanIndex by whether the nonce policy fits them
+
+        sub_filter can put the nonce on every <script> tag, but nothing
+        authorizes inline event handlers under a nonce policy. A page is
+        compatible when nothing it renders (includes and tag files followed,
+        as for infer_strict_scope) has a handler and every reference could
+        be resolved. Returns (sorted compatible urls, {url: reason} for the rest).
+        """
+        compatible, kept = [], {}
+        for relpath in sorted(index.files):
+            if not relpath.lower().endswith(PAGE_EXTENSIONS):
+                continue
+            url = self.url_for(os.path.join(index.root, relpath))
+            if url is None:
+                continue
+            surface = index.surface(relpath)
+            if surface['unresolved']:
+                kept[url] = f"unresolved {surface['unresolved'][0]}"
+            elif surface['handlers']:
+                kept[url] = f"{surface['handlers']} event handlers"
+            else:
+                compatible.append(url)
+        return sorted(compatible), kept
+
+    def generate_csp_config(self, report_uri=None, sample_rate=None, hashes=None, nonce_pages=None,
+                            canary=None, canary_rate=None, inferred=None):
+        """Generate the proven CSP configuration (no hashes needed)
+
+        inferred is (regex, pages) from infer_strict_scope(): the pages
+        the scan index found clean get the strict policy through the
+        $csp_policy map of csp-http.conf (a location would take them out
+        of Zimbra's proxied location /).
+        """
         config_lines = []
-        
+        policies = self.scope_policies(hashes, canary)
         # Header comments
         config_lines.extend([
             "# Zimbra CSP Protection - FOSS Community Edition",
@@ -133,8 +1824,23 @@ class ZimbraCSPGenerator:
         ])
         
         if report_uri:
+            config_lines.append(f"# CSP Violation Reporting: {report_uri}")
+            if sample_rate is not None:
+                # Parsed by catch-CSP-reports.py to scale counts back up - keep the format
+                config_lines.extend([
+                    f"# Report-Sample-Rate: {sample_rate:g}",
+                    f"# Only {sample_rate * 100:g}% of clients (split_clients in {self.http_output_file})",
+                    "# send reports; multiply observed counts by 1/rate.",
+                ])
+            # Also parsed by catch-CSP-reports.py: reports arrive at <report-uri>/<version>
+            config_lines.append("#")
+            for name in ('default', 'strict', 'nonce', 'canary'):
+                if name in policies and (name != 'nonce' or nonce_pages):
+                    line = f"# Policy-Version: {policy_version(policies[name], name == 'canary')} {name}"
+                    if name == 'canary':
+                        line += " report-only" + (f" {canary_rate:g}" if canary_rate is not None else "")
+                    config_lines.append(line)
             config_lines.extend([
-                f"# CSP Violation Reporting: {report_uri}",
                 "# Start Flask reporter with:",
                 "#   python3 -c \"",
                 "#     from flask import Flask, request; import syslog",
@@ -155,28 +1861,75 @@ class ZimbraCSPGenerator:
             "# This policy permits inline scripts and eval() required by Zimbra's architecture"
         ])
         
-        default_policy = "script-src 'self' 'unsafe-inline' 'unsafe-eval'; object-src 'none'; base-uri 'self'"
-        if report_uri:
-            default_policy += f"; report-uri {report_uri}"
-        default_policy += ";"
+        default_policy = self.header_value(policies['default'], report_uri, sample_rate)
+        
+        if inferred:
+            regex, pages = inferred
+            config_lines.extend([
+                "#",
+                "# INFERRED STRICT - $csp_policy (map in csp-http.conf) is the strict policy",
+                "# for the pages whose scan (includes and tag files followed) found no inline",
+                "# event handlers and no inline/dynamic scripts:",
+                f"# {pages} pages, each matched exactly (from {self.scan_index_file})",
+            ])
+        if nonce_pages:
+            # Header size no longer grows with the number of inline scripts
+            config_lines.extend([
+                "#",
+                "# NONCE MODE - $csp_policy (map in csp-http.conf) is the nonce policy for:",
+                *[f"#   {page}" for page in nonce_pages],
+                "# and the default policy everywhere else. sub_filter tags every <script",
+                "# in HTML responses with the per-request nonce ($request_id).",
+                "# CAVEATS: a <script> tag injected into the HTML also gets the nonce, so",
+                "# this guards against handler/attribute injection, not raw <script>.",
+                "# REQUIRED: sub_filter cannot rewrite gzipped upstream responses; every",
+                "# proxied location must have   proxy_set_header Accept-Encoding \"\";",
+                "# or Jetty's gzip leaves the scripts without a nonce and they are blocked.",
+                'add_header Content-Security-Policy $csp_policy always;',
+                "sub_filter_once off;",
+                "sub_filter '<script' '<script nonce=\"$request_id\"';",
+            ])
+        elif inferred:
+            config_lines.append('add_header Content-Security-Policy $csp_policy always;')
+        else:
+            config_lines.append(f'add_header Content-Security-Policy "{default_policy}" always;')
+        
+        if canary is not None:
+            # Candidate policy measured under real load before it is enforced
+            config_lines.extend([
+                "",
+                "# CANARY - candidate stricter policy, reported but not enforced",
+                "# Not sent where a location sets its own headers (the STRICT scope)",
+            ])
+            if canary_rate is not None:
+                config_lines.extend([
+                    f"# Only {canary_rate * 100:g}% of clients ($csp_canary, split_clients in {self.http_output_file})",
+                    'add_header Content-Security-Policy-Report-Only $csp_canary always;',
+                ])
+            else:
+                canary_policy = self.header_value(policies['canary'], report_uri, report_only=True)
+                config_lines.append(f'add_header Content-Security-Policy-Report-Only "{canary_policy}" always;')
         
         config_lines.extend([
-            f'add_header Content-Security-Policy "{default_policy}" always;',
             "",
             "# STRICT CSP - Calendar/Mail Views (PRIMARY XSS PROTECTION)",
             "# Blocks calendar invite XSS attacks by removing 'unsafe-inline'",
             "# Applies to: printcalendar, printmessage, imessage, printvoicemails",
+        ])
+        if hashes:
+            config_lines.append(f"# Allows {len(hashes)} known static/rendered inline script hashes")
+        config_lines.extend([
             "location ~ ^/zimbra/h/(printcalendar|printmessage|imessage|printvoicemails) {"
         ])
         
-        strict_policy = "script-src 'self' 'unsafe-eval'; object-src 'none'; base-uri 'self'"
-        if report_uri:
-            strict_policy += f"; report-uri {report_uri}"
-        strict_policy += ";"
+        strict_policy = self.header_value(policies['strict'], report_uri, sample_rate)
         
         config_lines.extend([
             f'    add_header Content-Security-Policy "{strict_policy}" always;',
             "}",
+        ])
+        
+        config_lines.extend([
             "",
             "# This configuration provides:",
             "# ✓ Protection against calendar invite XSS (the primary threat)",
@@ -193,108 +1946,188 @@ class ZimbraCSPGenerator:
         
         return '\n'.join(config_lines)
 
-    def init_nginx_template(self, dry_run=False):
-        """Initialize nginx template to include CSP header"""
+    def generate_http_config(self, report_uri=None, sample_rate=None, nonce_pages=None,
+                             hashes=None, canary=None, canary_rate=None, inferred=None):
+        """Generate the http{} level companion config (report sampling, per-page policies, canary)"""
+        policies = self.scope_policies(hashes, canary)
+        config_lines = [
+            "# Zimbra CSP Protection - http{} level definitions",
+            f"# Generated: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}",
+            f"# Version: {__version__}",
+            "#",
+            f"# Included from {self.http_template_file};",
+            f"# the server{{}} level policy lives in {self.output_file}",
+            "#",
+            ""
+        ]
+
+        if report_uri and sample_rate is not None:
+            # Hash on address + user agent so a given client is consistently in or out
+            config_lines.extend([
+                f"# Report-Sample-Rate: {sample_rate:g}",
+                f"# Only {sample_rate * 100:g}% of clients get the report-uri directive",
+                'split_clients "${remote_addr}${http_user_agent}" $csp_report_sampled {',
+                f'    {sample_rate * 100:g}%    1;',
+                '    *        "";',
+                "}",
+                ""
+            ])
+            # One variable per enforced policy so each reports to its own version path
+            for name in ('default', 'strict', 'nonce'):
+                if name == 'nonce' and not nonce_pages:
+                    continue
+                version = policy_version(policies[name])
+                config_lines.extend([
+                    f"map $csp_report_sampled $csp_report_uri_{version} {{    # {name}",
+                    '    ""         "";',
+                    f'    default    "; report-uri {report_uri.rstrip("/")}/{version}";',
+                    "}",
+                    ""
+                ])
+
+        if canary is not None and canary_rate is not None:
+            # Different key order than the report sampling so the two samples are independent
+            config_lines.extend([
+                f"# Canary-Sample-Rate: {canary_rate:g}",
+                f"# Only {canary_rate * 100:g}% of clients get the Report-Only candidate policy",
+                'split_clients "${http_user_agent}${remote_addr}" $csp_canary {',
+                f'    {canary_rate * 100:g}%    "{self.header_value(policies["canary"], report_uri, report_only=True)}";',
+                '    *        "";',
+                "}",
+                ""
+            ])
+
+        if nonce_pages or inferred:
+            # Regex keys are tried in order: a page in both scopes gets the strict policy
+            config_lines.extend([
+                "# Per-page policy: strict for the pages inferred clean, nonce for the pages",
+                "# that render no inline event handlers (matched exactly: unscanned URLs",
+                "# keep the default policy)",
+                "map $uri $csp_policy {",
+                f'    default "{self.header_value(policies["default"], report_uri, sample_rate)}";',
+            ])
+            if inferred:
+                config_lines.append(f'    "~{inferred[0]}" '
+                                    f'"{self.header_value(policies["strict"], report_uri, sample_rate)}";')
+            if nonce_pages:
+                config_lines.append(f'    "~{merge_url_scopes(nonce_pages)}" '
+                                    f'"{self.header_value(policies["nonce"], report_uri, sample_rate)}";')
+            config_lines.extend([
+                "}",
+                ""
+            ])
+
+        config_lines.append("# End of Zimbra CSP http Configuration")
+        return '\n'.join(config_lines)
+
+    def template_manager(self):
+        """TemplateManager for the directory of the https template"""
+        return TemplateManager(os.path.dirname(self.template_file),
+                               {'server': self.output_file, 'http': self.http_output_file},
+                               self.csp_comment, extra=[self.template_file])
+
+    def http_include_configured(self):
+        """True when the http{} level template already includes csp-http.conf"""
+        report = self.template_manager().verify()
+        return any(context == 'http' and ok for _, context, _, _, ok in report)
+
+    def upstream_uncompressed(self):
+        """Whether every proxied location of the server{} templates clears Accept-Encoding
+
+        The nonce sub_filter cannot rewrite a response Jetty gzipped. A
+        location's proxy_set_header lines replace those of the enclosing
+        blocks, so the ones in effect are looked up the way nginx does.
+        Returns False when a proxied location still forwards the client's
+        Accept-Encoding, None when there are no templates to check.
+        """
+        checked = 0
+        for path, context in self.template_manager().paths():
+            if context != 'server':
+                continue
+            try:
+                template = NginxTemplate(path)
+            except OSError:
+                continue
+            for block in template.blocks:
+                if block['name'] != 'location' or block['end'] is None:
+                    continue
+                if not any(re.match(r'\s*proxy_pass\s', template.lines[n]) for n in template.own_lines(block)):
+                    continue
+                checked += 1
+                scope = block
+                while scope is not None:
+                    headers = [template.lines[n] for n in template.own_lines(scope)
+                               if re.match(r'\s*proxy_set_header\s', template.lines[n])]
+                    if headers:
+                        break
+                    scope = scope['parent']
+                if not any(ACCEPT_ENCODING_CLEARED.match(line) for line in headers or []):
+                    return False
+        return True if checked else None
+
+    def print_template_report(self, installed=True):
+        """Print the verification table; True when every template checks out"""
+        report = self.template_manager().verify(installed)
+        if not report:
+            print(f"ERROR: No Zimbra nginx templates found in {os.path.dirname(self.template_file)}",
+                  file=sys.stderr)
+            return False
+        print(f"\n{'Template':40} {'Context':8} {'Blocks':>6} {'Included':>8}  Status")
+        for path, context, blocks, included, ok in report:
+            print(f"{os.path.basename(path):40} {context:8} {blocks:6} {included:8}  {'OK' if ok else 'FAIL'}")
+        return all(ok for *_, ok in report)
+
+    def _print_template_results(self, results):
+        for path, action, detail in results:
+            if action == 'error':
+                print(f"ERROR: {path}: {detail}", file=sys.stderr)
+            elif action == 'unchanged':
+                print(f"✓ {path}: already up to date")
+            elif action == 'would change':
+                print(f"DRY-RUN: Would update {path} ({detail})")
+            else:
+                print(f"✓ Updated {path} ({detail}, backup kept)")
+        return not any(action == 'error' for _, action, _ in results)
+
+    def init_templates(self, dry_run=False):
+        """Add the CSP includes to every Zimbra proxy template (server{} and http{})"""
         if not os.path.exists(self.template_file):
             print(f"ERROR: Zimbra nginx template not found: {self.template_file}", file=sys.stderr)
             print("Make sure Zimbra is properly installed.", file=sys.stderr)
             return False
         
-        try:
-            with open(self.template_file, 'r') as f:
-                content = f.read()
-        except Exception as e:
-            print(f"ERROR: Cannot read nginx template: {e}", file=sys.stderr)
-            return False
-        
-        # Check if already configured
-        if self.csp_include_line.strip() in content or '# CSP Security Header' in content:
-            print("✓ CSP include already configured in nginx template")
-            return True
-        
-        # Check if target line exists
-        if self.target_line not in content:
-            print(f"ERROR: Expected nginx configuration line not found", file=sys.stderr)
-            print(f"Looking for: {self.target_line}", file=sys.stderr)
-            print("Manual configuration required.", file=sys.stderr)
-            return False
-        
-        if dry_run:
-            print("DRY-RUN: Would add CSP include to nginx template:")
-            print(f"  File: {self.template_file}")
-            print(f"  After: {self.target_line}")
-            print(f"  Add: {self.csp_comment}")
-            print(f"       {self.csp_include_line}")
-            return True
-        
-        # Create backup
-        backup_file = f"{self.template_file}.backup.{datetime.now().strftime('%Y%m%d_%H%M%S')}"
-        try:
-            shutil.copy2(self.template_file, backup_file)
-            print(f"✓ Created backup: {backup_file}")
-        except Exception as e:
-            print(f"WARNING: Could not create backup: {e}", file=sys.stderr)
-        
-        # Add CSP include
-        new_content = content.replace(
-            self.target_line,
-            self.target_line + '\n' + self.csp_comment + '\n' + self.csp_include_line
-        )
-        
-        try:
-            with open(self.template_file, 'w') as f:
-                f.write(new_content)
-            print(f"✓ Added CSP include to nginx template")
-            return True
-        except Exception as e:
-            print(f"ERROR: Cannot write nginx template: {e}", file=sys.stderr)
+        results = self.template_manager().install(dry_run)
+        if not self._print_template_results(results):
+            print("Manual configuration required for the templates above:", file=sys.stderr)
+            print(f"  {self.csp_include_line.strip()}   (inside server {{}})", file=sys.stderr)
+            print(f"  {self.http_include_line.strip()}   (inside http {{}})", file=sys.stderr)
             return False
+        return dry_run or self.print_template_report(installed=True)
 
     def uninstall(self, dry_run=False):
         """Remove CSP configuration"""
-        changes_made = False
+        # Only include directives of our files (and the comment above them) go
+        results = self.template_manager().remove(dry_run)
+        changes_made = any(action == 'changed' for _, action, _ in results)
+        success = self._print_template_results(results)
         
-        # Remove from nginx template
-        if os.path.exists(self.template_file):
-            try:
-                with open(self.template_file, 'r') as f:
-                    content = f.read()
-                
-                if self.csp_include_line.strip() in content or '# CSP Security Header' in content:
-                    if dry_run:
-                        print("DRY-RUN: Would remove CSP include from nginx template")
-                    else:
-                        # Remove CSP lines
-                        lines = content.split('\n')
-                        new_lines = []
-                        for line in lines:
-                            if ('# CSP Security Header' not in line and 
-                                'csp-header.conf' not in line):
-                                new_lines.append(line)
-                            else:
-                                changes_made = True
-                        
-                        with open(self.template_file, 'w') as f:
-                            f.write('\n'.join(new_lines))
-                        print("✓ Removed CSP include from nginx template")
+        # Remove CSP config files
+        for output_file in (self.output_file, self.http_output_file):
+            if os.path.exists(output_file):
+                if dry_run:
+                    print(f"DRY-RUN: Would remove CSP config file: {output_file}")
                 else:
-                    print("✓ CSP include not found in nginx template")
-            except Exception as e:
-                print(f"ERROR: Cannot modify nginx template: {e}", file=sys.stderr)
-        
-        # Remove CSP config file
-        if os.path.exists(self.output_file):
-            if dry_run:
-                print(f"DRY-RUN: Would remove CSP config file: {self.output_file}")
+                    try:
+                        os.remove(output_file)
+                        print(f"✓ Removed CSP config file: {output_file}")
+                        changes_made = True
+                    except Exception as e:
+                        print(f"ERROR: Cannot remove CSP config: {e}", file=sys.stderr)
             else:
-                try:
-                    os.remove(self.output_file)
-                    print(f"✓ Removed CSP config file: {self.output_file}")
-                    changes_made = True
-                except Exception as e:
-                    print(f"ERROR: Cannot remove CSP config: {e}", file=sys.stderr)
-        else:
-            print("✓ CSP config file not found")
+                print(f"✓ CSP config file not found: {output_file}")
+        
+        if not dry_run and results:
+            success = self.print_template_report(installed=False) and success
         
         if dry_run:
             print("\nDRY-RUN: After uninstall, restart Zimbra with:")
@@ -302,24 +2135,25 @@ class ZimbraCSPGenerator:
             print("\nTo complete uninstall, restart Zimbra proxy:")
         else:
             print("\n✓ No CSP configuration found to remove")
-            return True
+            return success
         
         print("  su - zimbra")
         print("  zmproxyctl restart")
-        return True
+        return success
 
-    def write_config(self, config_content, dry_run=False):
+    def write_config(self, config_content, dry_run=False, output_file=None):
         """Write or display CSP configuration"""
+        output_file = output_file or self.output_file
         if dry_run:
             print("# DRY-RUN: CSP configuration that would be written to:")
-            print(f"# {self.output_file}")
+            print(f"# {output_file}")
             print("#" + "="*70)
             print(config_content)
             print("#" + "="*70)
             return True
         
         # Ensure output directory exists
-        output_dir = os.path.dirname(self.output_file)
+        output_dir = os.path.dirname(output_file)
         if not os.path.exists(output_dir):
             try:
                 os.makedirs(output_dir, exist_ok=True)
@@ -328,14 +2162,267 @@ class ZimbraCSPGenerator:
                 return False
         
         try:
-            with open(self.output_file, 'w') as f:
+            with open(output_file, 'w') as f:
                 f.write(config_content)
-            print(f"✓ Generated CSP configuration: {self.output_file}")
+            print(f"✓ Generated CSP configuration: {output_file}")
             return True
         except Exception as e:
             print(f"ERROR: Cannot write CSP config: {e}", file=sys.stderr)
             return False
 
+def run_sri_manifest(generator, args):
+    """Write (or verify) the SRI manifest and report changed/tampered bundles"""
+    algorithms = tuple(a.strip().lower() for a in args.sri_algorithms.split(',') if a.strip())
+    unknown = [a for a in algorithms if a not in SRI_ALGORITHMS]
+    if unknown or not algorithms:
+        print(f"ERROR: Unsupported SRI algorithm(s): {', '.join(unknown) or 'none'}", file=sys.stderr)
+        return 1
+    
+    previous = None
+    if os.path.exists(args.sri_manifest):
+        try:
+            with open(args.sri_manifest, 'r') as f:
+                previous = json.load(f)
+        except Exception as e:
+            print(f"WARNING: Ignoring unreadable manifest {args.sri_manifest}: {e}", file=sys.stderr)
+    if args.sri_verify and previous is None:
+        print(f"ERROR: --sri-verify needs an existing manifest: {args.sri_manifest}", file=sys.stderr)
+        return 1
+    
+    manifest, report = build_sri_manifest(generator.webapp_root, previous, algorithms,
+                                          workers=args.workers or 8, verify=args.sri_verify)
+    print(f"SRI: {len(manifest['files'])} assets under {generator.webapp_root} "
+          f"({report['hashed']} hashed, {len(manifest['files']) - report['hashed']} unchanged)")
+    if previous is not None:
+        for title in ('added', 'removed', 'changed', 'tampered'):
+            if report[title]:
+                print(f"\n{title.upper()} ({len(report[title])}):")
+                for relpath in report[title]:
+                    print(f"  {relpath}")
+    if report['tampered']:
+        print("\nWARNING: content changed while size and mtime were preserved", file=sys.stderr)
+    
+    if not args.sri_verify and not args.dry_run:
+        try:
+            tmp = f"{args.sri_manifest}.tmp"
+            with open(tmp, 'w') as f:
+                json.dump(manifest, f, indent=1, sort_keys=True)
+            os.replace(tmp, args.sri_manifest)
+            print(f"✓ SRI manifest: {args.sri_manifest}")
+        except Exception as e:
+            print(f"ERROR: Cannot write SRI manifest: {e}", file=sys.stderr)
+            return 1
+    return 1 if report['tampered'] else 0
+
+def run_externalize_advice(generator, args, cache):
+    """Print the inline scripts/handlers whose externalization saves the most"""
+    records = generator.scan_tree(args.workers, cache)
+    if cache:
+        cache.save()
+    candidates = externalization_candidates(records)
+    dynamic = sum(1 for r in records.values() for i in r['scripts'] + r['handlers'] if i.get('dynamic'))
+    
+    print(f"Inline bodies: {len(candidates)} unique in {len(records)} files "
+          f"({dynamic} JSP-dynamic items not considered)")
+    print(f"\n{'Rank':>4} {'Kind':12} {'Pages':>5} {'Size':>6} {'Score':>8} {'Saved/page':>10}  Hash")
+    top = candidates[:args.advise_externalize]
+    for rank, (kind, content_hash, size, pages, saved, _) in enumerate(top, 1):
+        print(f"{rank:>4} {kind:12} {pages:>5} {size:>6} {pages * size:>8} {saved:>10}  {content_hash}")
+    
+    worthwhile = [c for c in top if c[4] > 0]
+    page_bytes = sum(c[3] * c[4] for c in worthwhile)
+    header_bytes = sum(c[5] for c in worthwhile)
+    print(f"\nExternalizing the {len(worthwhile)} listed bodies that save bytes:")
+    print(f"  {page_bytes} bytes less markup summed over the {len(records)} scanned pages "
+          f"(~{page_bytes // max(len(records), 1)} per page)")
+    print(f"  {len(worthwhile)} fewer hashes, {header_bytes} bytes off every hash-based CSP header")
+    print("Use --manifest to see the files and lines of each hash.")
+    return 0
+
+def run_batch(args, report_uri, cache):
+    """Scan many webapp trees through one pool and cache; write a policy per tree"""
+    generators = []
+    for root in args.batch:
+        if not os.path.isdir(root):
+            print(f"ERROR: Not a directory: {root}", file=sys.stderr)
+            return 1
+        tree = ZimbraCSPGenerator()
+        tree.set_webapp_root(root)
+        generators.append(tree)
+    
+    # One pass over the union of all trees keeps every worker busy and lets
+    # files common to several builds be parsed once
+    scan_lists = [tree.find_scan_files() for tree in generators]
+    all_paths = [filepath for scan_list in scan_lists for _, filepath in scan_list]
+    records = scan_paths(all_paths, args.workers, cache)
+    cache.save()
+    print(f"Scanned {len(all_paths)} files in {len(generators)} trees "
+          f"({cache.misses} parsed, {cache.hits} from cache)", file=sys.stderr)
+    
+    os.makedirs(args.batch_output, exist_ok=True)
+    for name, tree, scan_list in zip(batch_names(args.batch), generators, scan_lists):
+        tree_records = {}
+        for _, filepath in scan_list:
+            record = records.get(filepath, {'error': 'not scanned'})
+            if 'error' in record:
+                print(f"Warning: Error reading {filepath}: {record['error']}", file=sys.stderr)
+            else:
+                tree_records[filepath] = record
+        hashes = tree.generate_hashes(tree_records) if args.hashes else None
+        tree.set_output(os.path.join(args.batch_output, f"{name}.csp-header.conf"))
+        tree.http_output_file = os.path.join(args.batch_output, f"{name}.csp-http.conf")
+        manifest = os.path.join(args.batch_output, f"{name}.manifest")
+        written = [tree.output_file, manifest]
+        try:
+            write_manifest(manifest_entries(tree_records, tree.webapp_root), manifest, tree.webapp_root)
+            config = tree.generate_csp_config(report_uri, args.report_sample_rate, hashes)
+            with open(tree.output_file, 'w') as f:
+                f.write(config)
+            # The sampled report-uri variables the policy refers to are defined at http{} level
+            if args.report_sample_rate is not None:
+                with open(tree.http_output_file, 'w') as f:
+                    f.write(tree.generate_http_config(report_uri, args.report_sample_rate, hashes=hashes))
+                written.append(tree.http_output_file)
+        except Exception as e:
+            print(f"ERROR: Cannot write batch output for {tree.webapp_root}: {e}", file=sys.stderr)
+            return 1
+        print(f"✓ {tree.webapp_root}: {', '.join(written)}")
+    return 0
+
+def run_manifest_diff(generator, args):
+    """Print added/removed/moved inline scripts between two manifests or trees"""
+    sides = []
+    for source in args.diff_manifest:
+        if os.path.isdir(source):
+            tree = ZimbraCSPGenerator()
+            tree.set_webapp_root(source)
+            sides.append(manifest_entries(tree.scan_tree(args.workers), tree.webapp_root))
+        else:
+            try:
+                sides.append(list(read_manifest(source)))
+            except Exception as e:
+                print(f"ERROR: Cannot read manifest {source}: {e}", file=sys.stderr)
+                return 2
+    old, new = sides
+    added, removed, moved = diff_manifests(old, new)
+    
+    print(f"Inline script surface: {args.diff_manifest[0]} -> {args.diff_manifest[1]}")
+    for title, sign, entries in (("ADDED", '+', added), ("REMOVED", '-', removed)):
+        if entries:
+            print(f"\n{title}:")
+            for h, kind, locations in entries:
+                print(f"  {sign} {kind:16} {h}  {', '.join(locations)}")
+    if moved:
+        print("\nMOVED:")
+        for h, kind, old_locations, new_locations in moved:
+            print(f"  ~ {kind:16} {h}")
+            print(f"      was: {', '.join(old_locations)}")
+            print(f"      now: {', '.join(new_locations)}")
+    
+    old_hashes, new_hashes = policy_hashes(old), policy_hashes(new)
+    # Each hash costs its source expression plus the separating space in the header
+    delta = sum(len(h) + 1 for h in new_hashes - old_hashes) - sum(len(h) + 1 for h in old_hashes - new_hashes)
+    print(f"\nAdded: {len(added)}  Removed: {len(removed)}  Moved: {len(moved)}")
+    print(f"Policy hashes: {len(old_hashes)} -> {len(new_hashes)} ({delta:+d} header bytes)")
+    if old_hashes != new_hashes:
+        print("Hash-based policies must be regenerated for the new build")
+        return 1
+    print("Hash-based policies do not need to be regenerated")
+    return 0
+
+def read_csp_config(generator, path):
+    """Text of an installed CSP config, preceded by the http{} level file next to it
+    (the report sampling variables and the $csp_policy map of nonce mode live there)"""
+    with open(path, 'r') as f:
+        config_text = f.read()
+    http_file = os.path.join(os.path.dirname(path), os.path.basename(generator.http_output_file))
+    if os.path.exists(http_file):
+        with open(http_file, 'r') as f:
+            config_text = f.read() + "\n" + config_text
+    return config_text
+
+def run_simulation(generator, args, report_uri, index, hashes=None, nonce_pages=None, canary=None,
+                   inferred=None):
+    """Print which inline scripts/handlers/sources each page would have blocked"""
+    if args.simulate:
+        try:
+            config_text = read_csp_config(generator, args.simulate)
+        except Exception as e:
+            print(f"ERROR: Cannot read CSP config: {e}", file=sys.stderr)
+            return 1
+        print(f"Simulating {args.simulate} against {generator.webapp_root}")
+    else:
+        config_text = generator.generate_http_config(report_uri, args.report_sample_rate, nonce_pages,
+                                                     hashes, canary, args.canary_sample_rate,
+                                                     inferred) + "\n" + \
+            generator.generate_csp_config(report_uri, args.report_sample_rate, hashes, nonce_pages,
+                                          canary, args.canary_sample_rate, inferred)
+        print(f"Simulating generated CSP configuration against {generator.webapp_root}")
+    
+    pages, fragments, blocked = generator.simulate(config_text, index, generator.upstream_uncompressed())
+    reported = 0
+    affected = 0
+    unknown = 0
+    for url, location, findings, unresolved in pages:
+        if not findings and not unresolved:
+            continue
+        affected += 1 if findings else 0
+        unknown += 1 if unresolved else 0
+        reported += sum(1 for f in findings if f[0] == 'REPORT')
+        print(f"\n{url}  [{location}]")
+        for disposition, kind, line, detail in findings:
+            where = f"line {line}" if line else ""
+            print(f"    {disposition:6} {kind:12} {where:10} {detail}")
+        for reference in unresolved:
+            # Whatever this pulls in was not checked
+            print(f"    {'UNKNOWN':6} {'include':12} {'':10} {reference}")
+    
+    print(f"\nPages evaluated: {len(pages)} with their includes and tag files "
+          f"({fragments} fragments and other files not served as pages)")
+    print(f"Pages affected:  {affected}")
+    print(f"Pages unknown:   {unknown} (unresolved includes or tags)")
+    print(f"Blocked items:   {blocked}")
+    if reported:
+        print(f"Report-only:     {reported}")
+    return 1 if blocked else 2 if unknown else 0
+
+def run_access_log_report(generator, args, report_uri, hashes=None):
+    """Print CSP header bytes per day and location, and the biggest scoping wins"""
+    if os.path.exists(generator.output_file):
+        config_text = read_csp_config(generator, generator.output_file)
+        print(f"Policy: {generator.output_file}")
+    else:
+        config_text = generator.generate_http_config(report_uri, args.report_sample_rate, hashes=hashes) + \
+            "\n" + generator.generate_csp_config(report_uri, args.report_sample_rate, hashes)
+        print("Policy: generated CSP configuration (none installed)")
+    
+    analyzer = AccessLogAnalyzer(NginxCSPConfig(config_text), area_depth=args.area_depth)
+    for path in args.access_log:
+        try:
+            analyzer.feed(path)
+        except Exception as e:
+            print(f"Warning: Error reading {path}: {e}", file=sys.stderr)
+    print(f"Read {analyzer.lines} lines ({analyzer.skipped} unparsed) from {len(args.access_log)} logs")
+    
+    print("\nCSP HEADER BYTES PER DAY:")
+    print(f"  {'Day':12} {'Hits':>10} {'Bytes':>12}  Location")
+    for day in analyzer.days():
+        for (d, location), (hits, header_bytes) in sorted(analyzer.daily.items(), key=lambda i: -i[1][1]):
+            if d == day:
+                print(f"  {day:12} {hits:>10} {header_bytes:>12.0f}  {location}")
+    
+    print("\nTRAFFIC BY URL AREA:")
+    print(f"  {'Hits':>10} {'Non-doc':>8}  {'Area':30} Location")
+    for (area, location), (hits, resources) in sorted(analyzer.areas.items(), key=lambda i: -i[1][0])[:25]:
+        print(f"  {hits:>10} {resources:>8}  {area:30} {location}")
+    
+    wins = [w for w in analyzer.scope_wins() if w[2] > 0][:10]
+    if wins:
+        print("\nBIGGEST HEADER-SIZE WINS (bytes/day):")
+        for area, change, saved in wins:
+            print(f"  {saved:>12}  {area:30} {change}")
+    return 0
+
 def show_help():
     """Show detailed help information"""
     help_text = f"""
@@ -363,10 +2450,107 @@ USAGE:
 
 OPTIONS:
   --help              Show this help message
-  --init              Setup nginx template to include CSP headers
-  --uninstall         Remove all CSP configuration  
+  --init              Add the CSP includes to every Zimbra proxy template
+                      (https, http, admin and their default vhosts get
+                      csp-header.conf in each server{{}}, nginx.conf.web.template
+                      gets csp-http.conf in http{{}}); idempotent, atomic
+  --uninstall         Remove all CSP configuration (only the include lines)
+  --verify-templates  Report per template whether each server{{}}/http{{}}
+                      block holds the include exactly once
   --report            Enable CSP violation reporting (port 7777)
+  --report-sample-rate RATE
+                      Only add report-uri for this share of clients (0-1),
+                      selected with nginx split_clients in csp-http.conf.
+                      Rounded to 0.01% steps (the finest split_clients
+                      takes); the rounded rate goes into Report-Sample-Rate
   --dry-run           Preview changes without modifying files
+  --simulate [CONFIG] Evaluate CONFIG (default: the config that would be
+                      generated) against the scanned webapp, listing the
+                      inline scripts, handlers and sources it would block.
+                      Pages are checked with what they render: includes and
+                      tag files are followed. Exits 1 when anything is
+                      blocked, 2 when pages have includes or tags that
+                      could not be resolved (listed as UNKNOWN)
+  --workers N         Number of parallel scan processes (default: CPUs)
+  --access-log LOG... Read nginx access logs (plain or .gz) and report CSP
+                      header bytes per day and location, traffic per URL
+                      area and the scopes with the biggest header savings
+  --area-depth N      URL path segments per area (default: 2)
+  --hashes            Add hashes of static inline scripts found by the file
+                      scan to the strict scope. Scripts containing JSP
+                      scriptlets, EL or tags are left out (they never match)
+  --dynamic-report F  With --hashes, write the excluded JSP-dynamic scripts
+                      to F: pages that need a nonce or location relaxation
+  --manifest FILE     Write a sorted manifest of inline scripts and handlers
+                      (hash, kind, file:line:col) for comparing builds
+  --diff-manifest OLD NEW
+                      Compare two manifests (or extracted webapp trees):
+                      added, removed and moved inline scripts and the change
+                      in header size. Exits 1 when policy hashes changed
+  --root DIR          Webapp root to scan instead of the live install
+  --output FILE       CSP config to write (csp-http.conf goes next to it)
+  --template FILE     nginx https template for --init/--uninstall; the
+                      other templates are taken from its directory
+  --batch ROOT...     Scan several extracted webapp trees (one per patch
+                      level or node image) concurrently and write
+                      <name>.csp-header.conf and <name>.manifest per tree
+                      (plus <name>.csp-http.conf with --report-sample-rate)
+  --batch-output DIR  Where --batch writes its files (default: .)
+  --cache FILE        Persistent content-addressed scan cache; files shared
+                      between trees or runs are parsed once
+  --advise-externalize [N]
+                      Rank identical inline scripts and handlers repeated
+                      across files by occurrences x size (top N, default
+                      20) with the bytes per page and policy header bytes
+                      moving each into a cacheable .js file would save
+  --sri-manifest FILE Write SRI digests of every .js/.css asset under the
+                      webapp root to FILE (JSON). Unchanged files (same
+                      inode, size, mtime, ctime) reuse the digest from the
+                      last run; added/removed/changed bundles are listed,
+                      edits with a restored mtime as tampered
+  --sri-algorithms A  Digests to compute: sha256,sha384,sha512 (default sha384)
+  --sri-verify        Rehash everything and compare with FILE without
+                      rewriting it; exits 1 on content changed under a
+                      preserved size and mtime (tampering)
+  --crawl URL         Fetch rendered pages from a Zimbra server and add the
+                      hashes of their inline scripts to the strict scope
+  --crawl-path PATH   Page to crawl, repeatable (default: /, /zimbra/h/,
+                      /zimbra/m/, /modern/)
+  --crawl-cookie C    Cookie header for authenticated views
+  --crawl-concurrency N  Concurrent keep-alive connections (default: 4)
+  --insecure          Skip TLS certificate verification when crawling
+  --canary [POLICY]   Also send a candidate policy as
+                      Content-Security-Policy-Report-Only (default: the
+                      STRICT script-src everywhere); requires --report.
+                      Every policy reports to <report-uri>/<version> so
+                      catch-CSP-reports.py counts violations per version
+  --canary-sample-rate R
+                      Send the canary to only this fraction of clients
+                      (rounded to 0.01% steps like --report-sample-rate)
+  --nonce             Serve a per-request nonce policy (no 'unsafe-inline')
+                      to the pages that render no inline event handlers
+                      (includes and tag files followed, each page matched
+                      exactly); nginx adds the nonce to every <script tag
+                      with sub_filter. Needs the csp-http.conf include.
+                      Scripts injected into the HTML get the nonce too.
+                      sub_filter cannot rewrite gzipped upstream responses:
+                      refused unless every proxied location of the
+                      templates has proxy_set_header Accept-Encoding "";
+  --scan-index FILE   Keep per-file scan results in FILE (JSON) and only
+                      rescan files whose size or mtime changed, e.g. after
+                      an upgrade (default: csp-scan-index.json next to
+                      --output). csp_index.py --serve keeps it in memory
+                      and answers hash/file/prefix queries on a socket
+  --infer-strict      Give the strict policy (through the $csp_policy map
+                      in csp-http.conf) to every served page whose scan, following <%@ include%>, <jsp:include>
+                      and tag files (tagdir or TLD <tag-file>), found no
+                      inline handlers and no inline scripts (static scripts
+                      are fine with --hashes). The pages are merged into
+                      one regex that matches each of them exactly, so
+                      unscanned URLs (servlets, extensionless views, files
+                      added later) keep the default policy. Java tag
+                      handlers are not followed. Needs the csp-http.conf
+                      include
   --version           Show version information
 
 WORKFLOW:
@@ -392,9 +2576,35 @@ EXAMPLES:
   # Test reporting setup
   ./zm_generate_CSP3.py --report --dry-run
 
+  # Only 5% of clients send reports (busy servers)
+  ./zm_generate_CSP3.py --report --report-sample-rate 0.05
+
+  # Measure the strict policy on 10% of clients before enforcing it
+  ./zm_generate_CSP3.py --report --hashes --canary --canary-sample-rate 0.1
+
   # Remove all CSP protection
   ./zm_generate_CSP3.py --uninstall
 
+  # Check a config before deploying it (no restart needed)
+  ./zm_generate_CSP3.py --simulate /opt/zimbra/conf/nginx/includes/csp-header.conf
+
+  # Policies for several extracted builds at once
+  ./zm_generate_CSP3.py --batch /srv/zimbra/10.0.*/webapps/zimbra --hashes \\
+      --batch-output /srv/csp --cache /srv/csp/scan-cache.json
+
+  # Before an upgrade: does the inline surface change?
+  ./zm_generate_CSP3.py --manifest /root/csp-manifest-current.txt
+  ./zm_generate_CSP3.py --diff-manifest /root/csp-manifest-current.txt /tmp/zimbra-new/webapps/zimbra
+
+  # Allow the inline scripts the live server actually renders
+  ./zm_generate_CSP3.py --crawl https://mail.example.com --crawl-cookie "ZM_AUTH_TOKEN=..."
+
+  # Strict policy wherever the scan allows it; rerun after upgrades
+  ./zm_generate_CSP3.py --infer-strict --hashes --dry-run
+
+  # What the CSP headers cost on real traffic
+  ./zm_generate_CSP3.py --access-log /opt/zimbra/log/nginx.access.log*
+
 SECURITY APPROACH:
 - DEFAULT: Permissive CSP allows normal Zimbra functionality
 - STRICT: Calendar/mail views block XSS attacks  
@@ -402,7 +2612,10 @@ SECURITY APPROACH:
 
 FILES MODIFIED:
 - /opt/zimbra/conf/nginx/templates/nginx.conf.web.https.template
+- /opt/zimbra/conf/nginx/templates/nginx.conf.web.template
 - /opt/zimbra/conf/nginx/includes/csp-header.conf
+- /opt/zimbra/conf/nginx/includes/csp-http.conf
+- /opt/zimbra/conf/nginx/includes/csp-scan-index.json (--infer-strict)
 
 For more information, visit: https://github.com/zimbra-community/csp-protection
 """
@@ -417,12 +2630,107 @@ def main():
     parser.add_argument('--help', action='store_true', help='Show detailed help')
     parser.add_argument('--init', action='store_true', help='Setup nginx template')
     parser.add_argument('--uninstall', action='store_true', help='Remove CSP configuration')
+    parser.add_argument('--verify-templates', action='store_true',
+                        help='Check that every nginx template holds the CSP include once')
     parser.add_argument('--report', action='store_true', help='Enable CSP violation reporting')
+    parser.add_argument('--report-sample-rate', type=float, default=None,
+                        help='Share of clients (0-1) that send violation reports')
     parser.add_argument('--dry-run', action='store_true', help='Preview changes without applying')
+    parser.add_argument('--simulate', nargs='?', const='', metavar='CONFIG',
+                        help='Evaluate a CSP config (default: the one that would be generated) offline')
+    parser.add_argument('--workers', type=int, default=None, help='Parallel scan processes')
+    parser.add_argument('--access-log', nargs='+', metavar='LOG',
+                        help='Report CSP header bytes per day/location from nginx access logs')
+    parser.add_argument('--area-depth', type=int, default=2,
+                        help='URL path segments that make up an area (default: 2)')
+    parser.add_argument('--hashes', action='store_true',
+                        help='Add static inline script hashes from the file scan to the strict scope')
+    parser.add_argument('--dynamic-report', metavar='FILE',
+                        help='Write the JSP-dynamic inline scripts excluded by --hashes to FILE')
+    parser.add_argument('--manifest', metavar='FILE',
+                        help='Write a sorted inline-script manifest (hash -> files, offsets) to FILE')
+    parser.add_argument('--diff-manifest', nargs=2, metavar=('OLD', 'NEW'),
+                        help='Compare two manifests or two extracted webapp trees')
+    parser.add_argument('--root', metavar='DIR',
+                        help='Zimbra webapp root to scan (default: /opt/zimbra/jetty_base/webapps/zimbra)')
+    parser.add_argument('--output', metavar='FILE',
+                        help='CSP config to write (default: /opt/zimbra/conf/nginx/includes/csp-header.conf)')
+    parser.add_argument('--template', metavar='FILE',
+                        help='nginx https template to patch (default: .../nginx.conf.web.https.template)')
+    parser.add_argument('--batch', nargs='+', metavar='ROOT',
+                        help='Scan several extracted webapp trees and write a policy per tree')
+    parser.add_argument('--batch-output', metavar='DIR', default='.',
+                        help='Directory for --batch policies and manifests (default: .)')
+    parser.add_argument('--cache', metavar='FILE',
+                        help='Persistent content-addressed scan cache (JSON)')
+    parser.add_argument('--advise-externalize', nargs='?', const=20, type=int, metavar='N',
+                        help='Rank repeated inline scripts/handlers worth moving to external .js (top N)')
+    parser.add_argument('--sri-manifest', metavar='FILE',
+                        help='Write Subresource Integrity digests of every .js/.css asset to FILE')
+    parser.add_argument('--sri-algorithms', default='sha384',
+                        help='Comma separated digests for --sri-manifest (sha256,sha384,sha512)')
+    parser.add_argument('--sri-verify', action='store_true',
+                        help='Rehash everything and compare with --sri-manifest without rewriting it')
+    parser.add_argument('--crawl', metavar='URL',
+                        help='Hash inline scripts of rendered pages from this server (e.g. https://mail.example.com)')
+    parser.add_argument('--crawl-path', action='append', metavar='PATH',
+                        help='Page to crawl (repeatable, default: login, /h/, /m/, /modern/)')
+    parser.add_argument('--crawl-cookie', metavar='COOKIE',
+                        help='Cookie header for authenticated views (e.g. ZM_AUTH_TOKEN=...)')
+    parser.add_argument('--crawl-concurrency', type=int, default=4,
+                        help='Concurrent crawl connections (default: 4)')
+    parser.add_argument('--insecure', action='store_true',
+                        help='Do not verify the TLS certificate when crawling')
+    parser.add_argument('--nonce', action='store_true',
+                        help='Per-request nonce policy for pages without inline event handlers')
+    parser.add_argument('--canary', nargs='?', const='', metavar='POLICY',
+                        help='Also send a candidate policy as Content-Security-Policy-Report-Only '
+                             '(default: the STRICT script-src everywhere)')
+    parser.add_argument('--canary-sample-rate', type=float, default=None, metavar='RATE',
+                        help='Send the canary policy to this fraction of clients (0-1)')
+    parser.add_argument('--scan-index', metavar='FILE',
+                        help='Persistent per-file scan index, updated incrementally '
+                             '(default with --infer-strict: csp-scan-index.json next to --output)')
+    parser.add_argument('--infer-strict', action='store_true',
+                        help='Also give the strict policy to every page the scan index finds free of '
+                             'inline handlers and scripts')
     parser.add_argument('--version', action='store_true', help='Show version')
     
     args = parser.parse_args()
     
+    if args.report_sample_rate is not None:
+        if not args.report:
+            parser.error('--report-sample-rate requires --report')
+        if not 0 < args.report_sample_rate <= 1:
+            parser.error('--report-sample-rate must be between 0 and 1')
+        rate = split_clients_rate(args.report_sample_rate)
+        if rate is None:
+            parser.error(f'--report-sample-rate must be at least {SPLIT_CLIENTS_STEP:g} '
+                         f'(0.01%, the finest split_clients step)')
+        if rate != args.report_sample_rate:
+            print(f"Note: --report-sample-rate {args.report_sample_rate:g} rounded to {rate:g} "
+                  f"(split_clients takes 0.01% steps)", file=sys.stderr)
+            args.report_sample_rate = rate
+        if args.report_sample_rate == 1:
+            args.report_sample_rate = None
+    if args.canary is not None and not args.report:
+        parser.error('--canary requires --report')
+    if args.canary_sample_rate is not None:
+        if args.canary is None:
+            parser.error('--canary-sample-rate requires --canary')
+        if not 0 < args.canary_sample_rate <= 1:
+            parser.error('--canary-sample-rate must be between 0 and 1')
+        rate = split_clients_rate(args.canary_sample_rate)
+        if rate is None:
+            parser.error(f'--canary-sample-rate must be at least {SPLIT_CLIENTS_STEP:g} '
+                         f'(0.01%, the finest split_clients step)')
+        if rate != args.canary_sample_rate:
+            print(f"Note: --canary-sample-rate {args.canary_sample_rate:g} rounded to {rate:g} "
+                  f"(split_clients takes 0.01% steps)", file=sys.stderr)
+            args.canary_sample_rate = rate
+        if args.canary_sample_rate == 1:
+            args.canary_sample_rate = None
+    
     # Handle special options
     if args.help:
         show_help()
@@ -435,6 +2743,13 @@ def main():
     
     # Initialize generator
     generator = ZimbraCSPGenerator()
+    if args.root:
+        generator.set_webapp_root(args.root)
+    if args.output:
+        generator.set_output(args.output)
+    if args.template:
+        generator.set_template(args.template)
+    cache = ScanCache(args.cache) if (args.cache or args.batch) else None
     
     # Handle uninstall
     if args.uninstall:
@@ -444,10 +2759,13 @@ def main():
         else:
             return 1
     
+    if args.verify_templates:
+        return 0 if generator.print_template_report(installed=True) else 1
+    
     # Handle init
     if args.init:
         print("Setting up Zimbra nginx template for CSP...")
-        if generator.init_nginx_template(args.dry_run):
+        if generator.init_templates(args.dry_run):
             if not args.dry_run:
                 print("\nNext steps:")
                 print("1. Generate CSP: ./zm_generate_CSP3.py")
@@ -456,28 +2774,173 @@ def main():
         else:
             return 1
     
+    # Set up reporting if requested
+    report_uri = 'http://127.0.0.1:7777/csp-violation' if args.report else None
+    
+    # Inline surface change between two Zimbra builds
+    if args.diff_manifest:
+        return run_manifest_diff(generator, args)
+    
+    # Fingerprint the external JS/CSS bundles 'self' allows
+    if args.sri_manifest:
+        return run_sri_manifest(generator, args)
+    
+    # Which inline bodies to move into cacheable files
+    if args.advise_externalize:
+        return run_externalize_advice(generator, args, cache)
+    
+    # One policy per extracted tree
+    if args.batch:
+        return run_batch(args, report_uri, cache)
+    
+    # Inline script hashes from the file scan (static only) and rendered JSP output
+    hashes = None
+    index = None
+    if args.scan_index or args.infer_strict or args.nonce or args.simulate is not None:
+        # Only files changed since the last run are parsed again. --nonce and
+        # --simulate alone keep the index in memory: they need includes and tag
+        # files followed
+        if args.scan_index:
+            generator.scan_index_file = os.path.abspath(args.scan_index)
+        persistent = args.scan_index or args.infer_strict
+        index = ScanIndex(generator.scan_index_file if persistent else None, generator.webapp_root)
+        rescanned, removed = index.update([filepath for _, filepath in generator.find_scan_files()],
+                                          args.workers, cache)
+        if persistent:
+            index.save()
+            print(f"Scan index {index.path}: {len(index.files)} files, {rescanned} rescanned, "
+                  f"{removed} removed", file=sys.stderr)
+        else:
+            print(f"Scanned {len(index.files)} files in {generator.webapp_root}", file=sys.stderr)
+        records = index.records()
+    else:
+        records = generator.scan_tree(args.workers, cache) \
+            if (args.hashes or args.manifest) else None
+    if cache:
+        cache.save()
+    if args.manifest:
+        try:
+            write_manifest(manifest_entries(records, generator.webapp_root), args.manifest,
+                           generator.webapp_root)
+            print(f"✓ Inline manifest: {args.manifest}", file=sys.stderr)
+        except Exception as e:
+            print(f"ERROR: Cannot write manifest: {e}", file=sys.stderr)
+            return 1
+    if args.hashes:
+        hashes = generator.generate_hashes(records)
+        if args.dynamic_report:
+            try:
+                with open(args.dynamic_report, 'w') as f:
+                    f.write(generator.dynamic_report())
+                print(f"✓ Dynamic JSP report: {args.dynamic_report}", file=sys.stderr)
+            except Exception as e:
+                print(f"ERROR: Cannot write dynamic report: {e}", file=sys.stderr)
+                return 1
+    nonce_pages = None
+    if args.nonce:
+        nonce_pages, incompatible = generator.nonce_compatibility(index)
+        print(f"Nonce-compatible pages: {len(nonce_pages)}", file=sys.stderr)
+        for page in nonce_pages:
+            print(f"  {page}", file=sys.stderr)
+        if incompatible:
+            print(f"Kept on the default policy: {len(incompatible)}", file=sys.stderr)
+            for page, reason in incompatible.items():
+                print(f"  {page}  {reason}", file=sys.stderr)
+        if not nonce_pages:
+            print("WARNING: No nonce-compatible pages, nonce mode disabled", file=sys.stderr)
+            nonce_pages = None
+        elif not generator.upstream_uncompressed():
+            print("WARNING: Nonce mode needs uncompressed upstream responses, but not every proxied",
+                  file=sys.stderr)
+            print(f"  location in {os.path.dirname(generator.template_file)} has "
+                  "proxy_set_header Accept-Encoding \"\";", file=sys.stderr)
+            print("  sub_filter cannot add the nonce to gzipped responses: their inline scripts",
+                  file=sys.stderr)
+            print("  would be blocked. Add the line to those locations first.", file=sys.stderr)
+            if not (args.dry_run or args.simulate is not None or args.access_log):
+                print("ERROR: Refusing to install nonce mode (preview with --dry-run or --simulate)",
+                      file=sys.stderr)
+                return 1
+    inferred = None
+    if args.infer_strict:
+        regex, strict_pages, kept = generator.infer_strict_scope(index, args.hashes)
+        print(f"Strict-compatible pages: {len(strict_pages)}", file=sys.stderr)
+        if regex:
+            print(f"  map $uri $csp_policy: ~{regex}", file=sys.stderr)
+            inferred = (regex, len(strict_pages))
+        else:
+            print("WARNING: No strict-compatible pages found", file=sys.stderr)
+        if kept:
+            print(f"Kept on the default policy: {len(kept)}", file=sys.stderr)
+            for url, reason in kept.items():
+                print(f"  {url}  {reason}", file=sys.stderr)
+    if args.crawl:
+        try:
+            crawled = generator.crawl(args.crawl, args.crawl_path, args.crawl_concurrency,
+                                      not args.insecure, args.crawl_cookie)
+        except Exception as e:
+            print(f"ERROR: Crawl failed: {e}", file=sys.stderr)
+            return 1
+        hashes = sorted(set(hashes or []) | set(crawled))
+    
+    # Candidate policy for the Report-Only canary
+    canary = None
+    if args.canary is not None:
+        canary = CSPPolicy.parse(args.canary) if args.canary else \
+            CSPPolicy().add('script-src', "'self'", "'unsafe-eval'", hashes or [])
+    
+    # Header cost accounting from real traffic
+    if args.access_log:
+        return run_access_log_report(generator, args, report_uri, hashes)
+    
+    # Offline simulation against the scanned webapp tree
+    if args.simulate is not None:
+        return run_simulation(generator, args, report_uri, index, hashes, nonce_pages, canary, inferred)
+    
     # Generate CSP configuration
     print("Generating Zimbra CSP protection...")
     
     # No need to scan for hashes anymore - using proven configuration
-    print("Using proven CSP configuration (no hash scanning required)", file=sys.stderr)
+    if not hashes:
+        print("Using proven CSP configuration (no hash scanning required)", file=sys.stderr)
     
-    # Set up reporting if requested
-    report_uri = 'http://127.0.0.1:7777/csp-violation' if args.report else None
+    # Sampling, per-page policies and the sampled canary rely on variables defined at http{} level
+    http_level = args.report_sample_rate is not None or nonce_pages or inferred or \
+        (canary is not None and args.canary_sample_rate is not None)
+    if http_level and not args.dry_run \
+            and not generator.http_include_configured():
+        print(f"ERROR: {generator.http_template_file} does not include csp-http.conf", file=sys.stderr)
+        print("Run ./zm_generate_CSP3.py --init first.", file=sys.stderr)
+        return 1
     
     # Generate configuration
     try:
-        config_content = generator.generate_csp_config(report_uri)
+        config_content = generator.generate_csp_config(report_uri, args.report_sample_rate, hashes,
+                                                       nonce_pages, canary, args.canary_sample_rate,
+                                                       inferred)
+        http_content = generator.generate_http_config(report_uri, args.report_sample_rate, nonce_pages,
+                                                      hashes, canary, args.canary_sample_rate, inferred)
     except Exception as e:
         print(f"ERROR: Failed to generate CSP config: {e}", file=sys.stderr)
         return 1
     
     # Write or display configuration  
-    if generator.write_config(config_content, args.dry_run):
+    if (generator.write_config(config_content, args.dry_run) and
+            generator.write_config(http_content, args.dry_run, generator.http_output_file)):
         if not args.dry_run:
             print(f"\n✓ CSP protection configured with proven security approach")
             if report_uri:
                 print(f"✓ Violation reporting: {report_uri}")
+            if args.report_sample_rate is not None:
+                print(f"✓ Report sampling: {args.report_sample_rate * 100:g}% of clients")
+            if nonce_pages:
+                print(f"✓ Nonce policy: {len(nonce_pages)} pages")
+            if inferred:
+                print(f"✓ Inferred strict scope: {inferred[1]} pages")
+            if canary is not None:
+                share = f"{args.canary_sample_rate * 100:g}% of clients" \
+                    if args.canary_sample_rate is not None else "all clients"
+                print(f"✓ Report-Only canary: {share}")
             print("\nTo activate protection:")
             print("  su - zimbra")
             print("  zmproxyctl restart")